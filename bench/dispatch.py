@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/dispatch.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Event dispatch cost
+#
+# Sends an event none of the loaded modules subscribed to, with 1 to 50
+# modules loaded. Broadcast offers it to every module's handle_event(),
+# which then ignores it, as all modules did before they declared their
+# subscriptions. Indexed is core.modules.send_event().
+#
+#   python3 bench/dispatch.py [tree]
+
+import sys, timeit, types
+
+import harness
+
+harness.setup(sys.argv)
+
+import core.modules as _modules
+
+def makemod(i):
+	m = types.ModuleType('bench' + str(i))
+	m.name = 'bench' + str(i)
+
+	def handle_event(loop, module, sender, protocol, event, data):
+		if module.name != 'irc':
+			return
+		if not event in ['CHANNEL_MESSAGE']:
+			return
+
+	m.handle_event = handle_event
+	m.subscriptions = [('minecraft', None, 'BENCH' + str(i))]
+	return m
+
+def broadcast(loop, module, sender, protocol, event, data):
+	for name in _modules.mods:
+		if hasattr(_modules.mods[name], 'handle_event'):
+			_modules.mods[name].handle_event(loop, module, sender, protocol, event, data)
+
+src = types.SimpleNamespace(name='minecraft')
+
+print('modules  broadcast    indexed')
+for count in [1, 6, 20, 50]:
+	_modules.mods = {'bench' + str(i): makemod(i) for i in range(count)}
+	_modules._buildsubscribers()
+
+	old = min(timeit.repeat(lambda: broadcast(None, src, 'MC', 'log', 'MESSAGE', None), number=100000, repeat=5))
+	new = min(timeit.repeat(lambda: _modules.send_event(None, src, 'MC', 'log', 'MESSAGE', None), number=100000, repeat=5))
+	print('%7d  %7.2f us  %7.2f us' % (count, old * 10, new * 10))
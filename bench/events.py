@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/events.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Event object size and cost
+#
+# Follows one server log line that is relayed to IRC: the parsed LogLine,
+# the Death event matched from its message and the IrcCommand sent on. Old
+# builds the dicts modules passed around before core/events.py, new builds
+# the event classes. Reports the memory 10000 relayed lines keep alive and
+# the time per line.
+#
+#   python3 bench/events.py [tree]
+
+import gc, re, sys, timeit, tracemalloc
+
+import harness
+
+harness.setup(sys.argv)
+
+import core.events as _events
+
+# As in modules/minecraft/logprotocol.py and loghandler.py
+logre = re.compile('^\[(?P<time>[^\]]+)\] \[(?P<thread>[^\]]+?)(?: #[0-9]+)?/(?P<level>[A-Z]+)\]: (?P<message>[^\\r\\n]+)$')
+deathre = re.compile('^(?P<message>(?P<name>[^ ]*?) fell from a high place)$')
+
+line = '[10:00:02] [Server thread/INFO]: Steve fell from a high place'
+
+def old():
+	match = logre.match(line)
+	log = match.groupdict()
+	data = match.groupdict()
+	evt = deathre.match(log['message']).groupdict()
+	cmd = {'command': 'PRIVMSG #minecraft :' + evt['message'], 'callback': None}
+	return data, evt, cmd
+
+def new():
+	data = _events.LogLine.frommatch(logre.match(line))
+	evt = _events.Death.frommatch(deathre.match(data.message))
+	cmd = _events.IrcCommand('PRIVMSG #minecraft :' + evt.message)
+	return data, evt, cmd
+
+for func in [old, new]:
+	gc.collect()
+	tracemalloc.start()
+	keep = [func() for i in range(10000)]
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	del keep
+
+	elapsed = min(timeit.repeat(func, number=100000, repeat=5))
+	print('%s: %4.0f bytes retained per relayed line, %.2f us/line' % (func.__name__, size / 10000, elapsed * 10))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/harness.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shared setup for the benchmarks
+#
+# The benchmarks take the tree to measure as their first argument, default
+# the one they are in. Measuring a checkout of an older commit, for example
+#
+#   git worktree add /tmp/before <commit>^
+#   python3 bench/<name>.py /tmp/before
+#
+# gives the before figures with the same script. Scripts that carry a copy
+# of the old code compare both in one run instead.
+
+import argparse, asyncio, os, sys
+import xml.etree.ElementTree as ET
+
+def setup(argv):
+	root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+	if len(argv) > 1:
+		root = argv[1]
+	sys.path.insert(0, os.path.abspath(root))
+
+	# Console output at INFO, as a production config would have it
+	import core.logging as _logging
+	_logging.init_logging(argparse.Namespace(debug=False, nofork=True))
+
+	return argv[2:]
+
+# Just enough of an IRC server to register a client and join its channels
+class IRCd(asyncio.Protocol):
+	last = None
+
+	def __init__(self, skip):
+		self.skip = skip
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.buf = b''
+		self.nick = '*'
+		IRCd.last = self
+
+	def send(self, line):
+		self.transport.write((line + '\r\n').encode('utf-8'))
+
+	def data_received(self, data):
+		self.buf += data
+		while b'\r\n' in self.buf:
+			line, self.buf = self.buf.split(b'\r\n', 1)
+			parts = line.decode('utf-8').split(' ')
+			if parts[0] == 'NICK':
+				self.nick = parts[1]
+			elif parts[0] == 'USER':
+				self.send(':irc.test 001 ' + self.nick + ' :Welcome')
+				self.send(':irc.test 005 ' + self.nick + ' CHANTYPES=# PREFIX=(ov)@+ :are supported by this server')
+			elif parts[0] == 'JOIN':
+				for chan in parts[1].split(','):
+					if not chan in self.skip:
+						self.send(':' + self.nick + '!bot@irc.test JOIN ' + chan)
+						self.send(':irc.test 366 ' + self.nick + ' ' + chan + ' :End of /NAMES list.')
+
+class Module:
+	name = 'irc'
+
+# Returns the connected client for an IRC config named Net with the given
+# channels, the server never lets the client into those in skip
+async def connect(loop, channels, skip=(), nick='RelayBot'):
+	import modules.irc as _irc
+	import modules.irc.protocol as _protocol
+
+	server = await loop.create_server(lambda: IRCd(skip), '127.0.0.1', 0)
+	port = server.sockets[0].getsockname()[1]
+
+	xml = '<config><irc name="Net">'
+	xml += '<server host="127.0.0.1" port="' + str(port) + '" tls="0"/>'
+	xml += '<user nick="' + nick + '" user="relay" gecos="RelayBot"/>'
+	xml += '<flood burst="100000" rate="100000"/>'
+	for chan in channels:
+		xml += '<channel name="' + chan + '"/>'
+	xml += '</irc></config>'
+	confs = _irc._loadconfigs(ET.fromstring(xml))
+
+	_protocol.createclient(loop, confs['Net'], Module())
+	for i in range(100):
+		await asyncio.sleep(0.05)
+		client = _protocol.clients.get('Net', None)
+		if client is not None and client.transport is not None:
+			break
+	# Let registration and the joins finish
+	await asyncio.sleep(0.5)
+	return client, server, confs['Net']
+
+async def disconnect(loop, client, server, conf):
+	conf['removed'] = True
+	client.shutdown(loop)
+	server.close()
+	await asyncio.sleep(0.1)
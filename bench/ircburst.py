@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/ircburst.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reading a large burst from an IRC server
+#
+# Feeds a connected client the NAMES and WHO replies for a 10000 user
+# channel in 4 KiB reads, so most lines are split across two reads. Reports
+# the time for the whole burst, with and without the message handlers, the
+# number of reads that raised and how many users the channel ended up with.
+# See harness.py for measuring an older tree.
+#
+#   python3 bench/ircburst.py [tree]
+
+import asyncio, sys, timeit
+
+import harness
+
+harness.setup(sys.argv)
+
+def burst():
+	nicks = ['user%05d' % i for i in range(10000)]
+
+	lines = []
+	names = []
+	for nick in nicks:
+		if nick.endswith('7'):
+			names.append('@' + nick)
+		else:
+			names.append(nick)
+		if len(' '.join(names)) > 380:
+			lines.append(':irc.test 353 RelayBot = #big :' + ' '.join(names))
+			names = []
+	if names:
+		lines.append(':irc.test 353 RelayBot = #big :' + ' '.join(names))
+	lines.append(':irc.test 366 RelayBot #big :End of /NAMES list.')
+	for nick in nicks:
+		lines.append(':irc.test 354 RelayBot 696 ' + nick + ' acct' + nick[-3:])
+	lines.append(':irc.test 315 RelayBot #big :End of /WHO list.')
+
+	data = ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+	return len(lines), len(data), [data[i:i + 4096] for i in range(0, len(data), 4096)]
+
+def members(client):
+	if hasattr(client, 'state'):
+		return len(client.state.members('#big'))
+	return len(client.chans['#big']['users'])
+
+async def main(loop):
+	client, server, conf = await harness.connect(loop, ['#big'])
+	client.haswhox = True
+
+	count, size, chunks = burst()
+	print('Burst of %d lines, %d bytes in %d reads' % (count, size, len(chunks)))
+
+	errors = [0]
+	def run():
+		errors[0] = 0
+		for chunk in chunks:
+			try:
+				client.data_received(chunk)
+			except Exception:
+				errors[0] += 1
+
+	elapsed = min(timeit.repeat(run, number=1, repeat=5))
+	print('End to end: %.1f ms, %d reads raised, %d users tracked' % (elapsed * 1e3, errors[0], members(client)))
+
+	handlers = client.handlers
+	client.handlers = {}
+	elapsed = min(timeit.repeat(run, number=1, repeat=5))
+	print('Framing and parsing only: %.1f ms' % (elapsed * 1e3))
+	client.handlers = handlers
+
+	await harness.disconnect(loop, client, server, conf)
+
+loop = asyncio.new_event_loop()
+loop.run_until_complete(main(loop))
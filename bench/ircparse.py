@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/ircparse.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# IRC line parser check and benchmark
+#
+# Runs the word by word parser modules/irc/protocol.py used before
+# modules/irc/message.py and the current parse() over every untagged line in
+# ircparse_corpus.txt, reports any line they disagree on, checks IRCv3 tag
+# parsing and then times both. Run from the top of the tree:
+#
+#   python3 bench/ircparse.py
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import modules.irc.message as _message
+
+# IRCProtocol._parse_raw_irc() as it was
+def oldparse(line):
+	ret = {'source': {'full': '', 'name': '', 'ident': '', 'host': ''}, 'msg': '', 'params': []}
+	stat = 0
+	words = line.split(' ')
+
+	for word in words:
+		if ((stat < 3) and (len(word) == 0)):
+			continue
+
+		if (stat == 0):
+			stat += 1
+			if (word[0] == ':'):
+				ret['source']['full'] = word[1:]
+			else:
+				ret['msg'] = word
+				stat += 1
+		elif (stat == 1):
+			ret['msg'] = word
+			stat += 1
+		elif (stat == 2):
+			if (word[0] == ':'):
+				ret['params'].append(word[1:])
+				stat += 1
+			else:
+				ret['params'].append(word)
+		else:
+			ret['params'][-1] = ret['params'][-1] + ' ' + word
+
+	if (len(ret['source']['full']) > 0):
+		src = ret['source']['full']
+		if (src.find('@') >= 0):
+			ret['source']['host'] = src[src.find('@')+1:]
+			src = src[:src.find('@')]
+		if (src.find('!') >= 0):
+			ret['source']['ident'] = src[src.find('!')+1:]
+			src = src[:src.find('!')]
+		ret['source']['name'] = src
+
+	return ret
+
+def compare(lines):
+	bad = 0
+	for line in lines:
+		old = oldparse(line)
+		new = _message.parse(line)
+		src = new.source
+		if (old['msg'], old['params'], old['source']['full'], old['source']['name'], old['source']['ident'], old['source']['host']) != (new.command, new.params, src.full, src.name, src.ident, src.host):
+			bad += 1
+			print('Mismatch: ' + repr(line))
+			print('  old: ' + repr(old))
+			print('  new: ' + repr(new))
+	return bad
+
+# Examples from the IRCv3 message tags and parser test suites
+def checktags():
+	msg = _message.parse('@a=b;c=32;k;rt=ql7 :nick!ident@host CMD a b :trailing here')
+	assert msg.tags == {'a': 'b', 'c': '32', 'k': '', 'rt': 'ql7'}
+	assert msg.command == 'CMD' and msg.params == ['a', 'b', 'trailing here']
+	assert msg.source.ident == 'ident'
+	assert _message.parse(r'@a=b\\and\nk;c=72\s45;d=gh\:764 foo').tags == {'a': 'b\\and\nk', 'c': '72 45', 'd': 'gh;764'}
+	assert _message.parse(r'@tag1=value\1;tag2=value\ :src CMD').tags == {'tag1': 'value1', 'tag2': 'value'}
+	assert _message.parse('@time=2023-01-01T00:00:00.000Z :n!u@h PRIVMSG #c :hi  there ').params == ['#c', 'hi  there ']
+
+def rate(func, lines, count):
+	start = time.perf_counter()
+	for i in range(count):
+		for line in lines:
+			func(line)
+	return len(lines) * count / (time.perf_counter() - start)
+
+def main():
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ircparse_corpus.txt')
+	with open(path, encoding='utf-8') as f:
+		lines = [line.rstrip('\r\n') for line in f if line.strip()]
+
+	bad = compare(lines)
+	print('Compared ' + str(len(lines)) + ' lines, ' + str(bad) + ' mismatches')
+	checktags()
+	print('Tag checks passed')
+
+	longmsg = ':nick!u@h PRIVMSG #chan :' + ' '.join(['word'] * 100)
+	for name, sample in [('corpus', lines), ('400-char PRIVMSG', [longmsg])]:
+		count = max(1, 200000 // len(sample))
+		old = rate(oldparse, sample, count)
+		new = rate(_message.parse, sample, count)
+		print('%-18s old %8.0f lines/s  new %8.0f lines/s  x%.2f' % (name, old, new, new / old))
+
+	if bad:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/ircusers.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tracking the users of many IRC channels
+#
+# Fills the channels of a connected client with NAMES and WHOX replies,
+# each user in one channel plus up to 200 shared with the next, then
+# times 500 QUIT, NICK and ACCOUNT lines. Reports the memory the user
+# tracking keeps, as seen by tracemalloc, and the time for each batch. The
+# layouts are given as channels x users per channel. The quit reason does
+# not look like a netsplit, so each QUIT removes its user straight away
+# instead of waiting for the split window. See harness.py for measuring an
+# older tree.
+#
+#   python3 bench/ircusers.py [tree [channels x users ...]]
+
+import asyncio, gc, sys, time, tracemalloc
+
+import harness
+
+layouts = harness.setup(sys.argv)
+if not layouts:
+	layouts = ['5x2000', '50x200', '200x50']
+
+def burst(nchans, per):
+	lines = []
+	for c in range(nchans):
+		users = ['user%05d' % (c * per + i) for i in range(per)]
+		users += ['user%05d' % (((c + 1) % nchans) * per + i) for i in range(min(200, per))]
+		for i in range(0, len(users), 40):
+			names = []
+			for j in range(i, min(i + 40, len(users))):
+				if j % 50 == 0:
+					names.append('@' + users[j])
+				else:
+					names.append(users[j])
+			lines.append(':irc.test 353 RelayBot = #c' + str(c) + ' :' + ' '.join(names))
+		for user in users:
+			lines.append(':irc.test 354 RelayBot 696 ' + user + ' acct' + user[4:])
+	return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+def changes(total):
+	quits = ''.join(':user%05d!u@h QUIT :Quit: leaving\r\n' % (i * 17 % total) for i in range(500))
+	nicks = ''.join(':user%05d!u@h NICK :renamed%05d\r\n' % (i * 13 % total, i) for i in range(500))
+	accounts = ''.join(':user%05d!u@h ACCOUNT :newacct\r\n' % (i * 7 % total) for i in range(500))
+	return [('500 QUIT', quits.encode('utf-8')), ('500 NICK', nicks.encode('utf-8')), ('500 ACCOUNT', accounts.encode('utf-8'))]
+
+async def main(loop):
+	for layout in layouts:
+		nchans, per = [int(i) for i in layout.split('x')]
+		client, server, conf = await harness.connect(loop, ['#c' + str(c) for c in range(nchans)])
+		client.haswhox = True
+
+		data = burst(nchans, per)
+		gc.collect()
+		tracemalloc.start()
+		base = tracemalloc.get_traced_memory()[0]
+		for i in range(0, len(data), 65536):
+			client.data_received(data[i:i + 65536])
+		gc.collect()
+		size = tracemalloc.get_traced_memory()[0] - base
+		tracemalloc.stop()
+
+		result = []
+		for name, lines in changes(nchans * per):
+			start = time.perf_counter()
+			client.data_received(lines)
+			result.append('%s %.2f ms' % (name, (time.perf_counter() - start) * 1e3))
+
+		print('%3d x %4d users: %5.1f MiB, %s' % (nchans, per, size / 1048576, ', '.join(result)))
+		await harness.disconnect(loop, client, server, conf)
+
+loop = asyncio.new_event_loop()
+loop.run_until_complete(main(loop))
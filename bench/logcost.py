@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/logcost.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cost of disabled logging on the hot paths
+#
+# Times the handling of one IRC PRIVMSG line, one RCON reply and one sent
+# RCON command, and one server log line, with output at INFO so debug and
+# protocol logging are off. Nothing subscribes to the resulting events. See
+# harness.py for measuring an older tree.
+#
+#   python3 bench/logcost.py [tree]
+
+import asyncio, sys, timeit
+import xml.etree.ElementTree as ET
+
+import harness
+
+harness.setup(sys.argv)
+
+import modules.minecraft as _minecraft
+import modules.minecraft.loghandler as _loghandler
+import modules.minecraft.logprotocol as _logprotocol
+import modules.minecraft.rconprotocol as _rconprotocol
+
+count = 50000
+
+class Transport:
+	def write(self, data):
+		pass
+
+	def close(self):
+		pass
+
+def report(name, func):
+	elapsed = min(timeit.repeat(func, number=count, repeat=3))
+	print('%-18s %6.2f us' % (name, elapsed / count * 1e6))
+
+async def main(loop):
+	client, server, conf = await harness.connect(loop, ['#minecraft'])
+	line = b':Op!o@host.example PRIVMSG #minecraft :hello there this is a normal chat line\r\n'
+	report('IRC PRIVMSG line', lambda: client.data_received(line))
+	await harness.disconnect(loop, client, server, conf)
+
+	xml = '<config><minecraft name="MC"><rcon host="127.0.0.1" port="25575" password="x"/><logreader file="latest.log"/></minecraft></config>'
+	mcconf = _minecraft._loadconfigs(ET.fromstring(xml))['MC']
+	module = harness.Module()
+	module.name = 'minecraft'
+
+	rcon = _rconprotocol.MCRConProtocol(loop, mcconf, module)
+	rcon.transport = Transport()
+	packet = rcon._rconpacket(0, 0, 'There are 1 of a max of 20 players online: Steve')
+
+	def reply():
+		rcon.rconwaitid = 0
+		rcon.rconcallbacks[0] = lambda pkt: None
+		rcon.id = 0
+		rcon.data_received(packet)
+	report('RCON reply packet', reply)
+
+	def send():
+		rcon.rconwaitid = -1
+		rcon._sendcmd('tellraw @a ["hello"]')
+	report('RCON send command', send)
+
+	handler = _loghandler.LogHandler(loop, mcconf, module, 'log')
+	logprot = _logprotocol.MCLogProtocol(loop, mcconf, module, handler)
+	logline = b'[10:00:01] [Server thread/INFO]: <Steve> hi irc\n'
+	report('Server log line', lambda: logprot.pipe_data_received(1, logline))
+
+loop = asyncio.new_event_loop()
+loop.run_until_complete(main(loop))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, bench/timers.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Event loop timers per IRC line
+#
+# Connects a client to a stand-in server that refuses one of its 100
+# channels, then feeds it one line per read the way a quiet network
+# delivers them. Reports the time per line and what is left on the loop's
+# timer heap, cancelled handles included. See harness.py for measuring an
+# older tree.
+#
+#   python3 bench/timers.py [tree]
+
+import asyncio, sys, time
+
+import harness
+
+harness.setup(sys.argv)
+
+count = 200000
+
+async def main(loop):
+	channels = ['#c' + str(i) for i in range(100)]
+	client, server, conf = await harness.connect(loop, channels, skip=['#c0'])
+	print('After joining ' + str(len(channels)) + ' channels (1 unjoinable): ' + str(len(loop._scheduled)) + ' handles scheduled')
+
+	line = b':someone!u@host.example PRIVMSG #c5 :hello there, this is a relayed line\r\n'
+	start = time.perf_counter()
+	for i in range(count):
+		client.data_received(line)
+	elapsed = time.perf_counter() - start
+	print('%d one-line reads: %.2f us/line, %d handles scheduled, %d of them cancelled' % (count, elapsed / count * 1e6, len(loop._scheduled), loop._timer_cancelled_count))
+
+	await harness.disconnect(loop, client, server, conf)
+
+loop = asyncio.new_event_loop()
+loop.run_until_complete(main(loop))
@@ -22,7 +22,11 @@
 from xml.etree.ElementTree import ElementTree
 
 import core.logging as _logging
+import core.executor as _executor
 import core.modules as _modules
+import core.connect as _connect
+import core.reconnect as _reconnect
+import core.shard as _shard
 
 import os
 
@@ -50,6 +54,28 @@ def load(loop, args):
 			loop.stop()
 			return
 
+		if _shard.isworker():
+			log.debug('Loading shard assignments')
+			_shard.loadconfig(config)
+
+		log.debug('Loading executor configuration')
+		if not _executor.loadconfig(config):
+			log.error('Unable to load executor configuration')
+			loop.stop()
+			return
+
+		log.debug('Loading reconnect configuration')
+		if not _reconnect.loadconfig(config):
+			log.error('Unable to load reconnect configuration')
+			loop.stop()
+			return
+
+		log.debug('Loading connect configuration')
+		if not _connect.loadconfig(config):
+			log.error('Unable to load connect configuration')
+			loop.stop()
+			return
+
 		log.debug('Loading modules')
 		if _modules.loadconfig(config):
 			loop.call_soon(_modules.applyconfig, loop)
@@ -66,6 +92,42 @@ def load(loop, args):
 		loop.stop()
 		return
 
+def reload(loop):
+	global config, configpath
+	try:
+		log.info('Reloading configuration from ' + configpath)
+		tree = ElementTree()
+		newconfig = tree.parse(configpath)
+	except Exception as e:
+		log.error('Error parsing configuration, keeping the current configuration: ' + str(e))
+		return
+
+	try:
+		config = newconfig
+
+		if _shard.isworker():
+			log.debug('Reloading shard assignments')
+			_shard.loadconfig(config)
+
+		log.debug('Reloading reconnect configuration')
+		if not _reconnect.loadconfig(config):
+			log.error('Unable to reload reconnect configuration')
+			return
+
+		log.debug('Reloading connect configuration')
+		if not _connect.loadconfig(config):
+			log.error('Unable to reload connect configuration')
+			return
+
+		log.debug('Reloading modules')
+		if not _modules.reloadconfig(loop, config):
+			log.error('Unable to reload modules')
+			return
+
+		log.info('Configuration successfully reloaded')
+	except Exception as e:
+		log.exception('Error reloading configuration: ' + str(e))
+
 def checkoverrides(args):
 	global config, configpath
 	try:
@@ -84,6 +146,12 @@ def checkoverrides(args):
 		nfconf = config.findall('nofork')
 		if len(nfconf) > 0:
 			args.nofork = True
+
+		shconf = config.find('shards')
+		if shconf is not None:
+			attrs = getattrs(shconf, log, {'workers': {'type': TYPE_INT, 'def': 1}})
+			if attrs is not None and attrs['workers'] > 1:
+				args.shards = attrs['workers']
 	except Exception as e:
 		log.error('Error checking configuration for debug mode: ' + str(e))
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, core/connect.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Outgoing TCP connections shared by every client
+#
+# Host names are resolved once and the addresses kept for 'ttl' seconds,
+# or until every one of them fails. Addresses are tried in the order
+# happy eyeballs (RFC 8305) uses: address families take turns, and the
+# address that worked last time for a host and port goes first. A new
+# attempt starts every 'delay' seconds, or as soon as the last one fails,
+# while earlier attempts carry on, and the first to connect wins. A 'delay'
+# of 0 tries one address at a time. Connecting, including any TLS
+# handshake, gives up after 'timeout' seconds.
+
+import core.logging as _logging
+import asyncio, socket
+
+log = _logging.log.getChild(__name__)
+
+conf = {'timeout': 30.0, 'delay': 0.25, 'interleave': 1, 'ttl': 300.0}
+
+# (host, port): [expiry loop time, getaddrinfo results]
+resolved = {}
+# (host, port): address that last connected
+lastgood = {}
+
+stats = {'lookups': 0, 'hits': 0, 'connects': 0, 'failures': 0, 'fallbacks': 0}
+
+def loadconfig(config):
+	global conf
+
+	import core.config as _config
+
+	concfg = config.find('connect')
+	if concfg is None:
+		return True
+
+	attrs = _config.getattrs(concfg, log, {
+		'timeout': {'type': _config.TYPE_FLOAT, 'def': conf['timeout']},
+		'delay': {'type': _config.TYPE_FLOAT, 'def': conf['delay']},
+		'interleave': {'type': _config.TYPE_INT, 'def': conf['interleave']},
+		'ttl': {'type': _config.TYPE_FLOAT, 'def': conf['ttl']}
+		})
+	if attrs is None:
+		return False
+
+	for key in ['timeout', 'interleave']:
+		if attrs[key] > 0:
+			conf[key] = attrs[key]
+		else:
+			log.warning('Invalid connect ' + key + ' value, using ' + str(conf[key]))
+
+	for key in ['delay', 'ttl']:
+		if attrs[key] >= 0:
+			conf[key] = attrs[key]
+		else:
+			log.warning('Invalid connect ' + key + ' value, using ' + str(conf[key]))
+
+	log.debug('Loaded config: ' + str(conf))
+	return True
+
+# Connects like loop.create_connection(), using cached addresses
+async def connect(loop, factory, host, port, ssl=None):
+	return await asyncio.wait_for(_connect(loop, factory, host, port, ssl), conf['timeout'])
+
+async def _connect(loop, factory, host, port, ssl):
+	global stats
+
+	key = (host, str(port))
+	infos = await _resolve(loop, key)
+
+	try:
+		sock = await _race(loop, _order(key, infos))
+	except:
+		# The host may have moved, look it up again next time
+		resolved.pop(key, None)
+		stats['failures'] += 1
+		raise
+
+	lastgood[key] = sock.getpeername()
+	stats['connects'] += 1
+
+	hostname = None
+	if ssl:
+		hostname = host
+	return await loop.create_connection(factory, sock=sock, ssl=ssl, server_hostname=hostname)
+
+async def _resolve(loop, key):
+	global resolved, stats
+
+	entry = resolved.get(key, None)
+	now = loop.time()
+	if entry is not None and entry[0] > now:
+		stats['hits'] += 1
+		return entry[1]
+
+	infos = await loop.getaddrinfo(key[0], key[1], type=socket.SOCK_STREAM)
+	if not infos:
+		raise OSError('getaddrinfo() returned empty list')
+	stats['lookups'] += 1
+	resolved[key] = [now + conf['ttl'], infos]
+	return infos
+
+def _order(key, infos):
+	infos = list(infos)
+
+	good = lastgood.get(key, None)
+	if good is not None:
+		for i in range(len(infos)):
+			if infos[i][4] == good:
+				infos.insert(0, infos.pop(i))
+				break
+
+	# 'interleave' addresses of the first family, then one of the next
+	families = {}
+	for info in infos:
+		families.setdefault(info[0], []).append(info)
+	lists = list(families.values())
+	ret = lists[0][:conf['interleave'] - 1]
+	del lists[0][:conf['interleave'] - 1]
+	while lists:
+		for addrs in lists:
+			if addrs:
+				ret.append(addrs.pop(0))
+		lists = [addrs for addrs in lists if addrs]
+	return ret
+
+async def _attempt(loop, info):
+	family, type, proto, canonname, addr = info
+	sock = socket.socket(family, type, proto)
+	try:
+		sock.setblocking(False)
+		await loop.sock_connect(sock, addr)
+	except BaseException:
+		sock.close()
+		raise
+	return sock
+
+async def _race(loop, infos):
+	global stats
+
+	delay = None
+	if conf['delay'] > 0:
+		delay = conf['delay']
+
+	pending = list(infos)
+	running = set()
+	errors = []
+	sock = None
+	try:
+		while pending or running:
+			if pending:
+				if running:
+					stats['fallbacks'] += 1
+				running.add(loop.create_task(_attempt(loop, pending.pop(0))))
+			timeout = None
+			if pending:
+				timeout = delay
+			done, running = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				exc = task.exception()
+				if exc is not None:
+					errors.append(exc)
+				elif sock is None:
+					sock = task.result()
+				else:
+					task.result().close()
+			if sock is not None:
+				return sock
+	finally:
+		for task in running:
+			task.cancel()
+
+	if len(errors) == 1:
+		raise errors[0]
+	raise OSError('Multiple exceptions: ' + ', '.join(str(exc) for exc in errors))
+
+def getstats():
+	global stats, lastgood
+
+	ret = dict(stats)
+	ret['cached'] = len(resolved)
+	ret['addresses'] = {'[' + key[0] + ']:' + key[1]: lastgood[key][0] for key in lastgood}
+	return ret
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, core/events.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['Event', 'IrcSource', 'ChannelMessage', 'ChannelAction', 'UserMessage', 'UserAction',
+	'LogLine', 'PlayerIP', 'PlayerUUID', 'PlayerConnect', 'PlayerDisconnect', 'WhitelistFail',
+	'Message', 'Action', 'Advancement', 'Death', 'RconCommand', 'RconPacket', 'IrcCommand',
+	'IRC_PRIORITY_CRITICAL', 'IRC_PRIORITY_INTERACTIVE', 'IRC_PRIORITY_BULK']
+
+# Base class for event data passed between modules
+#
+# Fields are stored in __slots__ so an event costs one small object rather
+# than a dict. Fields that were never set behave like missing dict keys, and
+# the dict style accessors below let existing handlers keep using data['key'].
+# Any other key is kept in a dict that is only created when one is set.
+class Event:
+	__slots__ = ('_extra',)
+	_fields = ()
+
+	def __init__(self, *args, **kwargs):
+		for key, val in zip(self._fields, args):
+			setattr(self, key, val)
+		for key in kwargs:
+			self[key] = kwargs[key]
+
+	@classmethod
+	def frommatch(cls, match):
+		obj = cls.__new__(cls)
+		groups = match.groups()
+		for key, idx in match.re.groupindex.items():
+			setattr(obj, key, groups[idx - 1])
+		return obj
+
+	def _getextra(self):
+		try:
+			return self._extra
+		except AttributeError:
+			return None
+
+	def __getitem__(self, key):
+		if key in self._fields:
+			try:
+				return getattr(self, key)
+			except AttributeError:
+				pass
+		else:
+			extra = self._getextra()
+			if extra is not None and key in extra:
+				return extra[key]
+		raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		if key in self._fields:
+			setattr(self, key, value)
+			return
+		extra = self._getextra()
+		if extra is None:
+			extra = self._extra = {}
+		extra[key] = value
+
+	def __delitem__(self, key):
+		if key in self._fields:
+			try:
+				delattr(self, key)
+				return
+			except AttributeError:
+				pass
+		else:
+			extra = self._getextra()
+			if extra is not None and key in extra:
+				del extra[key]
+				return
+		raise KeyError(key)
+
+	def __contains__(self, key):
+		if key in self._fields:
+			return hasattr(self, key)
+		extra = self._getextra()
+		return extra is not None and key in extra
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def __repr__(self):
+		return type(self).__name__ + repr(self.todict())
+
+	def get(self, key, default=None):
+		if key in self._fields:
+			return getattr(self, key, default)
+		extra = self._getextra()
+		if extra is None:
+			return default
+		return extra.get(key, default)
+
+	def keys(self):
+		ret = [key for key in self._fields if hasattr(self, key)]
+		extra = self._getextra()
+		if extra:
+			ret.extend(extra)
+		return ret
+
+	def values(self):
+		return [self[key] for key in self.keys()]
+
+	def items(self):
+		return [(key, self[key]) for key in self.keys()]
+
+	def copy(self):
+		obj = type(self).__new__(type(self))
+		for key in self._fields:
+			if hasattr(self, key):
+				setattr(obj, key, getattr(self, key))
+		extra = self._getextra()
+		if extra:
+			obj._extra = dict(extra)
+		return obj
+
+	def todict(self):
+		return {key: self[key] for key in self.keys()}
+
+# IRC events
+class IrcSource(Event):
+	_fields = ('full', 'name', 'ident', 'host', 'modes')
+	__slots__ = _fields
+
+class ChannelMessage(Event):
+	_fields = ('name', 'target', 'message', 'source')
+	__slots__ = _fields
+
+class ChannelAction(ChannelMessage):
+	__slots__ = ()
+
+class UserMessage(Event):
+	_fields = ('name', 'target', 'message', 'source')
+	__slots__ = _fields
+
+class UserAction(UserMessage):
+	__slots__ = ()
+
+# Send queue lanes for IrcCommand, replies to a user's command should use
+# IRC_PRIORITY_INTERACTIVE so they are not stuck behind relayed chat
+IRC_PRIORITY_CRITICAL = 0
+IRC_PRIORITY_INTERACTIVE = 1
+IRC_PRIORITY_BULK = 2
+
+class IrcCommand(Event):
+	_fields = ('command', 'callback', 'priority')
+	__slots__ = _fields
+
+	def __init__(self, command, callback=None, priority=IRC_PRIORITY_BULK):
+		self.command = command
+		self.callback = callback
+		self.priority = priority
+
+# Minecraft events
+class LogLine(Event):
+	_fields = ('time', 'thread', 'level', 'message')
+	__slots__ = _fields
+
+class PlayerIP(Event):
+	_fields = ('name', 'ip', 'port')
+	__slots__ = _fields
+
+class PlayerUUID(Event):
+	_fields = ('name', 'uuid')
+	__slots__ = _fields
+
+class PlayerConnect(Event):
+	_fields = ('name', 'uuid', 'ip', 'port', 'message')
+	__slots__ = _fields
+
+class PlayerDisconnect(PlayerConnect):
+	__slots__ = ()
+
+class WhitelistFail(Event):
+	_fields = ('name', 'ip', 'port', 'uuid')
+	__slots__ = _fields
+
+class Message(Event):
+	_fields = ('raw', 'name', 'message')
+	__slots__ = _fields
+
+class Action(Message):
+	__slots__ = ()
+
+class Advancement(Event):
+	_fields = ('name', 'message', 'advancement')
+	__slots__ = _fields
+
+class Death(Event):
+	_fields = ('message', 'name')
+	__slots__ = _fields
+
+class RconCommand(Event):
+	_fields = ('command', 'callback')
+	__slots__ = _fields
+
+	def __init__(self, command, callback=None):
+		self.command = command
+		self.callback = callback
+
+class RconPacket(Event):
+	_fields = ('id', 'type', 'payload')
+	__slots__ = _fields
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, core/executor.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import core.logging as _logging
+import asyncio, concurrent.futures
+
+log = _logging.log.getChild(__name__)
+
+TYPE_THREAD = 'thread'
+TYPE_PROCESS = 'process'
+
+conf = {'type': TYPE_THREAD, 'workers': 4, 'timeout': 30.0}
+pool = None
+
+def loadconfig(config):
+	global conf
+
+	import core.config as _config
+
+	execcfg = config.find('executor')
+	if execcfg is None:
+		return True
+
+	attrs = _config.getattrs(execcfg, log, {
+		'type': {'type': _config.TYPE_STRING, 'def': conf['type']},
+		'workers': {'type': _config.TYPE_INT, 'def': conf['workers']},
+		'timeout': {'type': _config.TYPE_FLOAT, 'def': conf['timeout']}
+		})
+	if attrs is None:
+		return False
+
+	if attrs['type'].lower() in [TYPE_THREAD, TYPE_PROCESS]:
+		conf['type'] = attrs['type'].lower()
+	else:
+		log.warning('Invalid executor type "' + attrs['type'] + '", using ' + conf['type'])
+
+	if attrs['workers'] > 0:
+		conf['workers'] = attrs['workers']
+	else:
+		log.warning('Invalid executor workers value, using ' + str(conf['workers']))
+
+	if attrs['timeout'] > 0:
+		conf['timeout'] = attrs['timeout']
+	else:
+		log.warning('Invalid executor timeout value, using ' + str(conf['timeout']))
+
+	log.debug('Loaded config: ' + str(conf))
+	return True
+
+def getpool():
+	global conf, pool
+
+	if pool is None:
+		log.debug('Creating ' + conf['type'] + ' pool with ' + str(conf['workers']) + ' worker(s)')
+		if conf['type'] == TYPE_PROCESS:
+			pool = concurrent.futures.ProcessPoolExecutor(max_workers=conf['workers'])
+		else:
+			pool = concurrent.futures.ThreadPoolExecutor(max_workers=conf['workers'], thread_name_prefix='relaybot')
+
+	return pool
+
+async def run(loop, func, *args, timeout=None):
+	# Run blocking func(*args) in the shared pool and wait for the result,
+	# raises asyncio.TimeoutError if it takes longer than timeout seconds
+	global conf
+
+	if timeout is None:
+		timeout = conf['timeout']
+
+	return await asyncio.wait_for(loop.run_in_executor(getpool(), func, *args), timeout)
+
+def shutdown():
+	global pool
+
+	if pool is None:
+		return
+
+	log.debug('Shutting down ' + conf['type'] + ' pool')
+	pool.shutdown(wait=False, cancel_futures=True)
+	pool = None
@@ -28,7 +28,7 @@ import logging, logging.handlers, sys, time, re, os
 #logging.DEBUG = 10
 #logging.NOTSET = 0
 
-__all__ = ['log', 'LOG_CRITICAL', 'LOG_ERROR', 'LOG_WARNING', 'LOG_INFO', 'LOG_DEBUG']
+__all__ = ['log', 'lazy', 'LOG_CRITICAL', 'LOG_ERROR', 'LOG_WARNING', 'LOG_INFO', 'LOG_DEBUG']
 
 LOG_CRITICAL = logging.CRITICAL
 LOG_ERROR = logging.ERROR
@@ -55,6 +55,21 @@ def leveltoname(level):
 class UTCFormatter(logging.Formatter):
 	converter = time.gmtime
 
+# Log argument that only calls func(*args) if the message is formatted, e.g.
+# log.protocol('Data: %s', lazy(binascii.hexlify, data))
+class lazy:
+	__slots__ = ('func', 'args')
+
+	def __init__(self, func, *args):
+		self.func = func
+		self.args = args
+
+	def __str__(self):
+		ret = self.func(*self.args)
+		if isinstance(ret, bytes):
+			return ret.decode('utf-8', 'replace')
+		return str(ret)
+
 # Relay Bot Logger Class
 class RBLogger(logging.Logger):
 	def protocol(self, message, *args, **kws):
@@ -152,6 +167,21 @@ def applyconfig(loop, args):
 		root.removeHandler(defloghandler)
 		mylog.debug('Default logging handler no longer needed')
 
+	setlevel()
+
+# Lets isEnabledFor() turn away records no output would write before any
+# LogRecord is created
+def setlevel():
+	global root, log
+
+	level = LOG_CRITICAL
+	for handler in root.handlers:
+		if handler.level < level:
+			level = handler.level
+
+	root.setLevel(level)
+	log.setLevel(LOG_NOTSET)
+
 def init_logging(args):
 	global rblog, levels, root, defloghandler, deflogformatter, cliargs
 	cliargs = args
@@ -170,9 +200,8 @@ def init_logging(args):
 	else:
 		defloghandler.setLevel(LOG_INFO)
 
-	root.setLevel(LOG_NOTSET)
-	log.setLevel(LOG_NOTSET)
 	root.addHandler(defloghandler)
+	setlevel()
 
 	if args.debug:
 		log.debug('Debug logging enabled')
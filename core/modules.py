@@ -19,14 +19,119 @@
 # You should have received a copy of the GNU General Public License
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import namedtuple
+from collections import namedtuple, deque
 
 import core.logging as _logging
-import importlib
+import core.shard as _shard
+import asyncio, functools, importlib, sys
 
 log = _logging.log.getChild(__name__)
 
 mods = {}
+subscriptions = []
+dispatchtable = {}
+targettable = {}
+subscribers = {}
+
+# Connected clients by module name, then client name, then protocol
+clients = {}
+
+OVERFLOW_DROPOLDEST = 'dropoldest'
+OVERFLOW_DROPNEWEST = 'dropnewest'
+OVERFLOW_COALESCE = 'coalesce'
+
+overflows = [OVERFLOW_DROPOLDEST, OVERFLOW_DROPNEWEST, OVERFLOW_COALESCE]
+
+eventdefaults = {'maxbatch': 100, 'queuesize': 1000, 'overflow': OVERFLOW_DROPOLDEST, 'concurrency': 4, 'control': ['PLAYERS_OFFLINE', 'PLAYER_CONNECT', 'PLAYER_DISCONNECT']}
+eventconf = eventdefaults.copy()
+modconfs = {}
+controlevents = frozenset(eventconf['control'])
+
+ready = deque()
+drainhandle = None
+
+class Subscriber:
+	def __init__(self, module, queuesize, overflow, concurrency):
+		self.module = module
+		self.name = module.name
+		self.queuesize = queuesize
+		self.overflow = overflow
+		self.concurrency = concurrency
+
+		self.queue = deque()
+
+		# Coroutine handlers are run as tasks, at most concurrency at a time
+		self.asyncevent = asyncio.iscoroutinefunction(getattr(module, 'handle_event', None))
+		self.asynctarget = asyncio.iscoroutinefunction(getattr(module, 'handle_event_target', None))
+		self.tasks = set()
+		self.parked = 0
+
+		self.delivered = 0
+		self.dropped = 0
+		self.coalesced = 0
+		self.highwater = 0
+		self.nextwarn = 1
+
+	def put(self, item, control=False):
+		# Returns True if the number of pending items grew
+		q = self.queue
+
+		if len(q) < self.queuesize:
+			q.append(item)
+			if len(q) > self.highwater:
+				self.highwater = len(q)
+			return True
+
+		# Control events keep their place in the queue, they are only exempt
+		# from being dropped in favour of normal ones
+		if self.overflow == OVERFLOW_COALESCE and not control:
+			key = item[:5]
+			for i in range(len(q) - 1, -1, -1):
+				if q[i][:5] == key:
+					q[i] = item
+					self.coalesced += 1
+					return False
+
+		if self.overflow == OVERFLOW_DROPNEWEST and not control:
+			self._drop(item)
+			return False
+
+		# The oldest normal event makes way, only a queue holding nothing but
+		# control events drops one of those
+		for i in range(len(q)):
+			if not q[i][4] in controlevents:
+				break
+		else:
+			if not control:
+				self._drop(item)
+				return False
+			i = 0
+		self._drop(q[i])
+		del q[i]
+		q.append(item)
+		return False
+
+	def get(self):
+		if self.queue:
+			return self.queue.popleft()
+		return None
+
+	def depth(self):
+		return len(self.queue)
+
+	def isbusy(self):
+		if not self.asyncevent and not self.asynctarget:
+			return False
+		return len(self.tasks) >= self.concurrency
+
+	def getstats(self):
+		return {'depth': len(self.queue), 'control': sum(1 for item in self.queue if item[4] in controlevents), 'highwater': self.highwater, 'delivered': self.delivered, 'dropped': self.dropped, 'coalesced': self.coalesced, 'running': len(self.tasks)}
+
+	def _drop(self, item):
+		self.dropped += 1
+		if self.dropped >= self.nextwarn:
+			log.warning('Event queue for module ' + self.name + ' is full, ' + str(self.dropped) + ' event(s) dropped so far (latest: ' + item[4] + ')')
+			self.nextwarn *= 10
 
 def loadmod(name):
 	global mods
@@ -47,8 +152,59 @@ def loadmod(name):
 	log.debug('Loaded module ' + name)
 	return m
 
+def _loadqueueconfig(node, defaults):
+	import core.config as _config
+
+	attrs = _config.getattrs(node, log, {
+		'maxbatch': {'type': _config.TYPE_INT, 'def': defaults['maxbatch']},
+		'queuesize': {'type': _config.TYPE_INT, 'def': defaults['queuesize']},
+		'overflow': {'type': _config.TYPE_STRING, 'def': defaults['overflow']},
+		'concurrency': {'type': _config.TYPE_INT, 'def': defaults['concurrency']}
+		})
+	if attrs is None:
+		return defaults.copy()
+
+	conf = defaults.copy()
+
+	if attrs['maxbatch'] > 0:
+		conf['maxbatch'] = attrs['maxbatch']
+	else:
+		log.warning('Invalid maxbatch value for ' + node.tag + ', using ' + str(defaults['maxbatch']))
+
+	if attrs['queuesize'] > 0:
+		conf['queuesize'] = attrs['queuesize']
+	else:
+		log.warning('Invalid queuesize value for ' + node.tag + ', using ' + str(defaults['queuesize']))
+
+	if attrs['overflow'].lower() in overflows:
+		conf['overflow'] = attrs['overflow'].lower()
+	else:
+		log.warning('Invalid overflow value "' + attrs['overflow'] + '" for ' + node.tag + ', using ' + defaults['overflow'])
+
+	if attrs['concurrency'] > 0:
+		conf['concurrency'] = attrs['concurrency']
+	else:
+		log.warning('Invalid concurrency value for ' + node.tag + ', using ' + str(defaults['concurrency']))
+
+	return conf
+
+def _loadeventconfig(config):
+	global eventdefaults, eventconf, controlevents
+
+	eventconf = eventdefaults.copy()
+
+	evtcfg = config.find('events')
+	if evtcfg is not None:
+		eventconf = _loadqueueconfig(evtcfg, eventdefaults)
+		if 'control' in evtcfg.attrib:
+			eventconf['control'] = [evt.strip() for evt in evtcfg.attrib['control'].split(',') if evt.strip()]
+
+	controlevents = frozenset(eventconf['control'])
+
 def loadconfig(config):
-	global mods
+	global mods, eventconf, modconfs
+
+	_loadeventconfig(config)
 
 	modcfgs = config.findall('module')
 
@@ -59,6 +215,8 @@ def loadconfig(config):
 		name = mod.attrib['name']
 
 		m = loadmod(name)
+		if m:
+			modconfs[name] = _loadqueueconfig(mod, eventconf)
 
 	for name in mods:
 		m = mods[name]
@@ -69,6 +227,134 @@ def loadconfig(config):
 
 	return True
 
+def reloadconfig(loop, config):
+	global mods, eventconf, modconfs, subscribers
+
+	_loadeventconfig(config)
+
+	names = []
+	for mod in config.findall('module'):
+		if not 'name' in mod.attrib:
+			log.warning('Missing name attribute for module')
+			continue
+		if not mod.attrib['name'] in names:
+			names.append(mod.attrib['name'])
+			modconfs[mod.attrib['name']] = _loadqueueconfig(mod, eventconf)
+
+	for name in list(mods):
+		if not name in names:
+			unloadmod(loop, name)
+
+	added = []
+	for name in names:
+		if not name in mods:
+			if loadmod(name):
+				added.append(name)
+			else:
+				del modconfs[name]
+
+	_buildsubscribers()
+
+	for name in mods:
+		m = mods[name]
+		cfg = config.findall(name)
+		if name in added:
+			if hasattr(m, 'loadconfig'):
+				m.loadconfig(cfg, m)
+			if hasattr(m, 'applyconfig'):
+				log.debug('Applying configuration for module ' + name)
+				m.applyconfig(loop, m)
+		elif hasattr(m, 'reloadconfig'):
+			log.debug('Reloading configuration for module ' + name)
+			m.reloadconfig(loop, cfg, m)
+		else:
+			log.warning('Module ' + name + ' does not support reloading its configuration, restart to apply any changes')
+
+	return True
+
+def unloadmod(loop, name):
+	global mods, modconfs, subscribers
+
+	if not name in mods:
+		return
+
+	log.info('Unloading module ' + name)
+	m = mods.pop(name)
+	modconfs.pop(name, None)
+
+	if hasattr(m, 'shutdown'):
+		m.shutdown(loop)
+
+	if name in subscribers:
+		sub = subscribers[name]
+		sub.queue.clear()
+		for task in list(sub.tasks):
+			task.cancel()
+
+	# Forget the module so loading it again starts from a clean slate
+	for key in list(sys.modules):
+		if key == 'modules.' + name or key.startswith('modules.' + name + '.'):
+			del sys.modules[key]
+
+def register_client(modname, name, protocol, client):
+	global clients
+
+	if not modname in clients:
+		clients[modname] = {}
+	if not name in clients[modname]:
+		clients[modname][name] = {}
+
+	clients[modname][name][protocol] = client
+	log.debug('Registered client ' + modname + '/' + name + '/' + protocol)
+
+def unregister_client(modname, name, protocol, client):
+	global clients
+
+	# A replacement may already have registered under the same key
+	byname = clients.get(modname, {}).get(name, None)
+	if byname is None or byname.get(protocol, None) is not client:
+		return
+
+	del byname[protocol]
+	if not byname:
+		del clients[modname][name]
+	log.debug('Unregistered client ' + modname + '/' + name + '/' + protocol)
+
+def getclient(modname, name, protocol):
+	global clients
+
+	return clients.get(modname, {}).get(name, {}).get(protocol, None)
+
+def getclients(modname, name=None, protocol=None):
+	# Returns (name, protocol, client) tuples for the connected clients of a
+	# module, optionally limited to one client name and/or protocol
+	global clients
+
+	bymod = clients.get(modname, None)
+	if not bymod:
+		return ()
+
+	if name is not None:
+		byname = bymod.get(name, None)
+		if byname is None:
+			return ()
+		if protocol is not None:
+			if not protocol in byname:
+				return ()
+			return ((name, protocol, byname[protocol]),)
+		return [(name, p, byname[p]) for p in byname]
+
+	ret = []
+	for n in bymod:
+		byname = bymod[n]
+		if protocol is not None:
+			if protocol in byname:
+				ret.append((n, protocol, byname[protocol]))
+			continue
+		for p in byname:
+			ret.append((n, p, byname[p]))
+	return ret
+
 def getmodule(name):
 	global mods
 
@@ -79,40 +365,215 @@ def getmodule(name):
 def applyconfig(loop):
 	global mods
 
+	_buildsubscribers()
+
 	for name in mods:
 		if hasattr(mods[name], 'applyconfig'):
 			log.debug('Applying configuration for module ' + name)
 			mods[name].applyconfig(loop, mods[name])
 
 def shutdown(loop):
-	global mods
+	global mods, subscribers
 	for name in mods:
 		if hasattr(mods[name], 'shutdown'):
 			log.debug('Shutting down module ' + name)
 			mods[name].shutdown(loop)
 
+	for name in subscribers:
+		for task in list(subscribers[name].tasks):
+			task.cancel()
+
+def getstats():
+	global mods, subscribers, ready
+
+	stats = {'pending': len(ready), 'subscribers': {}, 'modules': {}}
+
+	for name in subscribers:
+		stats['subscribers'][name] = subscribers[name].getstats()
+
+	for name in mods:
+		if hasattr(mods[name], 'getstats'):
+			stats['modules'][name] = mods[name].getstats()
+
+	return stats
+
 def send_event(loop, module, sender, protocol, event, data):
-	loop.call_soon(_dispatch_event, loop, module, sender, protocol, event, data)
+	log.debug('Event %s from %s/%s/%s: %s', event, module.name, sender, protocol, data)
+
+	_queue_event(loop, _gethandlers(module.name, protocol, event), None, module, sender, protocol, event, data)
 
 def send_event_target(loop, target, module, sender, protocol, event, data):
-	loop.call_soon(_dispatch_event_target, loop, target, module, sender, protocol, event, data)
+	log.debug('Event %s from %s/%s/%s to %s: %s', event, module.name, sender, protocol, target, data)
 
-def _dispatch_event(loop, module, sender, protocol, event, data):
-	global mods
+	# In sharded mode the target may belong to another worker
+	if _shard.route_event_target(loop, target, module, sender, protocol, event, data):
+		return
 
-	evt = {'event': event, 'module': module.name, 'sender': sender, 'protocol': protocol}
-	log.debug('Event ' + str(evt) + ': ' + str(data))
+	deliver_event_target(loop, target, module, sender, protocol, event, data)
 
-	for name in mods:
-		if hasattr(mods[name], 'handle_event'):
-			mods[name].handle_event(loop, module, sender, protocol, event, data)
+def deliver_event_target(loop, target, module, sender, protocol, event, data):
+	_queue_event(loop, _gettargets(target), target, module, sender, protocol, event, data)
 
-def _dispatch_event_target(loop, target, module, sender, protocol, event, data):
-	global mods
+async def send_request(loop, target, module, sender, protocol, event, data, timeout=None):
+	# Send a targeted event whose data has a callback slot, such as
+	# RCON_SENDCMD, and wait for the callback to be called with the reply
+	fut = loop.create_future()
+	data['callback'] = functools.partial(_setresult, fut)
+
+	send_event_target(loop, target, module, sender, protocol, event, data)
+
+	return await asyncio.wait_for(fut, timeout)
+
+def _setresult(fut, result):
+	if not fut.done():
+		fut.set_result(result)
+
+def _queue_event(loop, subs, target, module, sender, protocol, event, data):
+	global ready, drainhandle, controlevents
 
-	evt = {'event': event, 'module': module.name, 'sender': sender, 'protocol': protocol, 'target': target}
-	log.debug('Event ' + str(evt) + ': ' + str(data))
+	item = (target, module, sender, protocol, event, data)
+	control = event in controlevents
+
+	for sub in subs:
+		if sub.put(item, control):
+			ready.append(sub)
+
+	if ready and drainhandle is None:
+		drainhandle = loop.call_soon(_drain_events, loop)
+
+def _drain_events(loop):
+	global ready, drainhandle, eventconf
+
+	drainhandle = None
+	count = 0
+	maxbatch = eventconf['maxbatch']
+
+	# Each entry in ready stands for one pending item of that subscriber, so
+	# items are delivered in the order they were queued
+	while ready and count < maxbatch:
+		sub = ready.popleft()
+		if sub.isbusy():
+			# Picked up again when one of its tasks finishes
+			sub.parked += 1
+			continue
+		item = sub.get()
+		if item is None:
+			continue
+		count += 1
+		_deliver(loop, sub, item)
+
+	# Leave anything left over for the next loop iteration
+	if ready:
+		drainhandle = loop.call_soon(_drain_events, loop)
+
+def _deliver(loop, sub, item):
+	target, module, sender, protocol, event, data = item
+	sub.delivered += 1
+
+	try:
+		if target is None:
+			ret = sub.module.handle_event(loop, module, sender, protocol, event, data)
+			isasync = sub.asyncevent
+		else:
+			ret = sub.module.handle_event_target(loop, target, module, sender, protocol, event, data)
+			isasync = sub.asynctarget
+	except Exception as e:
+		log.exception('Exception in module ' + sub.name + ' handling event ' + event + ': ' + str(e))
+		return
+
+	if isasync:
+		task = loop.create_task(ret)
+		sub.tasks.add(task)
+		task.add_done_callback(functools.partial(_task_done, loop, sub, event))
+
+def _task_done(loop, sub, event, task):
+	global ready, drainhandle
+
+	sub.tasks.discard(task)
+
+	if not task.cancelled() and task.exception() is not None:
+		exc = task.exception()
+		log.error('Exception in module ' + sub.name + ' handling event ' + event + ': ' + str(exc), exc_info=exc)
+
+	if sub.parked > 0:
+		sub.parked -= 1
+		ready.append(sub)
+		if drainhandle is None:
+			drainhandle = loop.call_soon(_drain_events, loop)
+
+def _buildsubscribers():
+	global mods, modconfs, eventconf, subscribers, subscriptions, dispatchtable, targettable
+
+	old = subscribers
+	subscribers = {}
+	subs = []
 
 	for name in mods:
-		if hasattr(mods[name], 'handle_event_target'):
-			mods[name].handle_event_target(loop, target, module, sender, protocol, event, data)
+		m = mods[name]
+		if not hasattr(m, 'handle_event') and not hasattr(m, 'handle_event_target'):
+			continue
+
+		conf = modconfs.get(name, eventconf)
+		sub = old.get(name, None)
+		if sub is not None and sub.module is m:
+			# Keep anything already queued when the config is reloaded
+			sub.queuesize = conf['queuesize']
+			sub.overflow = conf['overflow']
+			sub.concurrency = conf['concurrency']
+		else:
+			sub = Subscriber(m, conf['queuesize'], conf['overflow'], conf['concurrency'])
+		subscribers[name] = sub
+
+		if not hasattr(m, 'handle_event'):
+			continue
+		if hasattr(m, 'subscriptions'):
+			for s in m.subscriptions:
+				subs.append((tuple(s), sub))
+		else:
+			# Modules that do not declare subscriptions receive every event
+			subs.append(((None, None, None), sub))
+		log.debug('Module ' + name + ' subscribed to: ' + str(getattr(m, 'subscriptions', 'all events')))
+
+	subscriptions = subs
+	dispatchtable = {}
+	targettable = {}
+
+def _gethandlers(modname, protocol, event):
+	global subscriptions, dispatchtable
+
+	key = (modname, protocol, event)
+	if key in dispatchtable:
+		return dispatchtable[key]
+
+	handlers = []
+	for (smod, sprot, sevent), sub in subscriptions:
+		if smod is not None and smod != modname:
+			continue
+		if sprot is not None and sprot != protocol:
+			continue
+		if sevent is not None and sevent != event:
+			continue
+		if not sub in handlers:
+			handlers.append(sub)
+
+	handlers = tuple(handlers)
+	dispatchtable[key] = handlers
+	return handlers
+
+def _gettargets(target):
+	global subscribers, targettable
+
+	key = target.get('module', None)
+	if key in targettable:
+		return targettable[key]
+
+	handlers = []
+	for name in subscribers:
+		if key is not None and key != name:
+			continue
+		if hasattr(subscribers[name].module, 'handle_event_target'):
+			handlers.append(subscribers[name])
+
+	handlers = tuple(handlers)
+	targettable[key] = handlers
+	return handlers
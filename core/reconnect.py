@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, core/reconnect.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reconnect delays shared by every client
+#
+# The first retry after a connection drops is immediate, most drops are
+# short blips. After that the delay starts at 'initial' seconds and is
+# multiplied by 'factor' each time, up to 'max'. Each delay is cut by a
+# random amount of up to 'jitter' of itself so clients that dropped
+# together do not all come back at the same moment. A client that stays
+# working for 'stable' seconds starts over with an immediate retry the next
+# time it drops, one that keeps dropping straight away keeps backing off.
+
+import core.logging as _logging
+import random
+
+log = _logging.log.getChild(__name__)
+
+conf = {'initial': 2.0, 'max': 300.0, 'factor': 2.0, 'jitter': 0.5, 'stable': 60.0}
+
+# Name: Backoff
+backoffs = {}
+
+def loadconfig(config):
+	global conf
+
+	import core.config as _config
+
+	reccfg = config.find('reconnect')
+	if reccfg is None:
+		return True
+
+	attrs = _config.getattrs(reccfg, log, {
+		'initial': {'type': _config.TYPE_FLOAT, 'def': conf['initial']},
+		'max': {'type': _config.TYPE_FLOAT, 'def': conf['max']},
+		'factor': {'type': _config.TYPE_FLOAT, 'def': conf['factor']},
+		'jitter': {'type': _config.TYPE_FLOAT, 'def': conf['jitter']},
+		'stable': {'type': _config.TYPE_FLOAT, 'def': conf['stable']}
+		})
+	if attrs is None:
+		return False
+
+	for key in ['initial', 'max', 'stable']:
+		if attrs[key] > 0:
+			conf[key] = attrs[key]
+		else:
+			log.warning('Invalid reconnect ' + key + ' value, using ' + str(conf[key]))
+
+	if attrs['factor'] >= 1:
+		conf['factor'] = attrs['factor']
+	else:
+		log.warning('Invalid reconnect factor value, using ' + str(conf['factor']))
+
+	if attrs['jitter'] >= 0 and attrs['jitter'] <= 1:
+		conf['jitter'] = attrs['jitter']
+	else:
+		log.warning('Invalid reconnect jitter value, using ' + str(conf['jitter']))
+
+	log.debug('Loaded config: ' + str(conf))
+	return True
+
+def backoff(name):
+	global backoffs
+
+	if not name in backoffs:
+		backoffs[name] = Backoff(name)
+	return backoffs[name]
+
+def forget(name):
+	global backoffs
+
+	backoffs.pop(name, None)
+
+class Backoff:
+	def __init__(self, name):
+		self.name = name
+		self.attempts = 0
+		# Loop time the connection was lost, None while it is working
+		self.lost = None
+		# Loop time the connection last started working
+		self.up = None
+
+		self.drops = 0
+		self.retries = 0
+		self.lastdown = None
+		self.maxdown = 0.0
+
+	# Returns the number of seconds to wait before the next attempt
+	def delay(self, loop):
+		if self.lost is None:
+			self.lost = loop.time()
+			self.drops += 1
+			if self.up is not None and self.lost - self.up >= conf['stable']:
+				self.attempts = 0
+
+		attempt = self.attempts
+		self.attempts += 1
+		self.retries += 1
+		if attempt == 0:
+			return 0.0
+
+		delay = min(conf['max'], conf['initial'] * conf['factor'] ** (attempt - 1))
+		return delay * (1.0 - conf['jitter'] * random.random())
+
+	# The client is fully working again, returns how long it was down for or
+	# None if it had not been lost
+	def success(self, loop):
+		self.up = loop.time()
+		if self.lost is None:
+			return None
+
+		down = self.up - self.lost
+		self.lost = None
+		self.lastdown = down
+		if down > self.maxdown:
+			self.maxdown = down
+		return down
+
+	def getstats(self):
+		lastdown = None
+		if self.lastdown is not None:
+			lastdown = round(self.lastdown, 3)
+		return {'drops': self.drops, 'retries': self.retries, 'down': self.lost is not None, 'lastdown': lastdown, 'maxdown': round(self.maxdown, 3)}
+
+def getstats():
+	global backoffs
+
+	return {name: backoffs[name].getstats() for name in backoffs}
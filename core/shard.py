@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, core/shard.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Sharded mode
+#
+# A supervisor process forks a number of workers. Every worker loads the
+# full configuration but only creates the <irc> and <minecraft> clients it
+# owns. Broadcast events stay inside the worker that produced them, while
+# targeted events for a client owned by another worker are sent to that
+# worker through the supervisor.
+#
+# Workers and the supervisor talk over socket pairs. Each frame is:
+#   4 byte length, 2 byte destination, 2 byte source, pickled payload
+# The supervisor only reads the header and passes frames on untouched.
+
+import core.logging as _logging
+import asyncio, atexit, os, pickle, selectors, signal, socket, struct, sys, time, zlib
+
+log = _logging.log.getChild(__name__)
+
+HEADER = struct.Struct('!IHH')
+DEST_ALL = 0xffff
+
+KIND_EVENT = 0
+KIND_CALLBACK = 1
+
+shardmodules = ['irc', 'minecraft']
+
+count = 1
+index = None
+sock = None
+assignments = {}
+
+# Worker state
+transport = None
+pending = []
+callbacks = {}
+callbackid = 0
+callbacktimeout = 600
+
+def isworker():
+	return index is not None
+
+def loadconfig(config):
+	global count, assignments
+
+	if not isworker():
+		return True
+
+	assignments = {}
+	for modname in shardmodules:
+		for node in config.findall(modname):
+			if not 'name' in node.attrib:
+				continue
+			name = node.attrib['name']
+			owner = None
+			if 'shard' in node.attrib:
+				try:
+					owner = int(node.attrib['shard']) % count
+				except:
+					log.warning('Invalid shard attribute for ' + modname + ' config ' + name + ', assigning automatically')
+			if owner is None:
+				owner = zlib.crc32((modname + '/' + name).encode('utf-8')) % count
+			assignments[(modname, name)] = owner
+
+	log.debug('Shard ' + str(index) + ' owns: ' + ', '.join(m + '/' + n for (m, n) in assignments if assignments[(m, n)] == index))
+	return True
+
+def owner(modname, name):
+	if not isworker():
+		return None
+	return assignments.get((modname, name), index)
+
+def owns(modname, name):
+	if not isworker():
+		return True
+	return owner(modname, name) == index
+
+# Returns True if the targeted event was fully handled by another worker,
+# otherwise the caller should also deliver it locally
+def route_event_target(loop, target, module, sender, protocol, event, data):
+	if not isworker():
+		return False
+
+	modname = target.get('module', None)
+	if not modname in shardmodules:
+		return False
+
+	if 'name' in target:
+		dest = owner(modname, target['name'])
+		if dest == index:
+			return False
+		_forward(dest, target, module, sender, protocol, event, data)
+		return True
+
+	_forward(DEST_ALL, target, module, sender, protocol, event, data)
+	return False
+
+# Supervisor
+def supervise(args):
+	global count
+
+	count = args.shards
+	sup = Supervisor(count)
+
+	# Only returns in a newly forked worker
+	sup.run()
+
+class Supervisor:
+	def __init__(self, count):
+		self.count = count
+		self.workers = {}
+		self.pids = {}
+		self.respawn = {}
+		self.stopping = False
+		self.sel = selectors.DefaultSelector()
+
+	def run(self):
+		for i in range(self.count):
+			if self._spawn(i):
+				return
+
+		signal.signal(signal.SIGINT, self._stop)
+		signal.signal(signal.SIGTERM, self._stop)
+		signal.signal(signal.SIGHUP, self._forward_signal)
+		signal.signal(signal.SIGUSR1, self._forward_signal)
+		signal.signal(signal.SIGUSR2, self._forward_signal)
+
+		log.info('Supervising ' + str(self.count) + ' worker(s)')
+
+		while True:
+			for key, mask in self.sel.select(timeout=1):
+				if mask & selectors.EVENT_READ:
+					self._read(key.data)
+				if mask & selectors.EVENT_WRITE:
+					self._write(key.data)
+
+			self._reap()
+
+			if self.stopping:
+				if not self.pids:
+					log.info('All workers stopped')
+					sys.exit(0)
+				continue
+
+			now = time.monotonic()
+			for i in list(self.respawn):
+				if self.respawn[i] <= now:
+					del self.respawn[i]
+					if self._spawn(i):
+						return
+
+	def _spawn(self, i):
+		global index, sock
+
+		psock, csock = socket.socketpair()
+		pid = os.fork()
+
+		if pid == 0:
+			# Worker: drop everything belonging to the supervisor
+			signal.signal(signal.SIGINT, signal.SIG_DFL)
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			signal.signal(signal.SIGHUP, signal.SIG_DFL)
+			signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+			signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+			for w in self.workers:
+				self.workers[w]['sock'].close()
+			self.sel.close()
+			psock.close()
+			atexit.unregister(_delpidfile())
+			index = i
+			sock = csock
+			return True
+
+		csock.close()
+		psock.setblocking(False)
+		worker = {'index': i, 'sock': psock, 'pid': pid, 'inbuf': bytearray(), 'outbuf': bytearray()}
+		self.workers[i] = worker
+		self.pids[pid] = i
+		self.sel.register(psock, selectors.EVENT_READ, worker)
+		log.info('Started worker ' + str(i) + ' with pid ' + str(pid))
+		return False
+
+	def _read(self, worker):
+		try:
+			data = worker['sock'].recv(65536)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b''
+
+		if not data:
+			self._close(worker)
+			return
+
+		buf = worker['inbuf']
+		buf += data
+		pos = 0
+
+		while len(buf) - pos >= HEADER.size:
+			length, dest, src = HEADER.unpack_from(buf, pos)
+			end = pos + HEADER.size + length
+			if len(buf) < end:
+				break
+			frame = bytes(buf[pos:end])
+			pos = end
+
+			if dest == DEST_ALL:
+				for i in self.workers:
+					if i != worker['index']:
+						self._send(self.workers[i], frame)
+			elif dest in self.workers:
+				self._send(self.workers[dest], frame)
+			else:
+				log.warning('Dropping message from worker ' + str(src) + ' for unavailable worker ' + str(dest))
+
+		del buf[:pos]
+
+	def _send(self, worker, frame):
+		if not worker['outbuf']:
+			try:
+				sent = worker['sock'].send(frame)
+			except (BlockingIOError, InterruptedError):
+				sent = 0
+			except OSError:
+				return
+			if sent == len(frame):
+				return
+			frame = frame[sent:]
+			self.sel.modify(worker['sock'], selectors.EVENT_READ | selectors.EVENT_WRITE, worker)
+		worker['outbuf'] += frame
+
+	def _write(self, worker):
+		try:
+			sent = worker['sock'].send(worker['outbuf'])
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			return
+		del worker['outbuf'][:sent]
+		if not worker['outbuf']:
+			self.sel.modify(worker['sock'], selectors.EVENT_READ, worker)
+
+	def _close(self, worker):
+		if self.workers.get(worker['index']) is not worker:
+			return
+		del self.workers[worker['index']]
+		try:
+			self.sel.unregister(worker['sock'])
+		except:
+			pass
+		worker['sock'].close()
+
+	def _reap(self):
+		while self.pids:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				self.pids = {}
+				return
+			if pid == 0:
+				return
+			if not pid in self.pids:
+				continue
+
+			i = self.pids.pop(pid)
+			if i in self.workers and self.workers[i]['pid'] == pid:
+				self._close(self.workers[i])
+
+			if self.stopping:
+				log.info('Worker ' + str(i) + ' stopped')
+				continue
+
+			log.warning('Worker ' + str(i) + ' exited with status ' + str(status) + ', restarting in 5 seconds')
+			self.respawn[i] = time.monotonic() + 5
+
+	def _stop(self, signum, frame):
+		log.info('Shutting down: Received signal ' + signal.Signals(signum).name)
+		self.stopping = True
+		self.respawn = {}
+		self._forward_signal(signal.SIGTERM, frame)
+
+	def _forward_signal(self, signum, frame):
+		for pid in list(self.pids):
+			try:
+				os.kill(pid, signum)
+			except OSError:
+				pass
+
+def _delpidfile():
+	import core.daemon as _daemon
+	return _daemon.delpidfile
+
+# Worker
+class ShardProtocol(asyncio.Protocol):
+	def __init__(self, loop):
+		self.loop = loop
+		self.buf = bytearray()
+
+	def connection_made(self, tp):
+		global transport, pending
+
+		transport = tp
+		log.debug('Shard ' + str(index) + ' connected to supervisor')
+		for frame in pending:
+			transport.write(frame)
+		pending = []
+
+	def connection_lost(self, exc):
+		global transport
+
+		transport = None
+		log.error('Lost connection to supervisor, shutting down')
+
+		import core.signals as _signals
+		_signals.handle_sigterm(self.loop)
+
+	def data_received(self, data):
+		buf = self.buf
+		buf += data
+		pos = 0
+
+		while len(buf) - pos >= HEADER.size:
+			length, dest, src = HEADER.unpack_from(buf, pos)
+			end = pos + HEADER.size + length
+			if len(buf) < end:
+				break
+			payload = bytes(buf[pos + HEADER.size:end])
+			pos = end
+
+			try:
+				self._handle(src, pickle.loads(payload))
+			except Exception as e:
+				log.exception('Error handling message from shard ' + str(src) + ': ' + str(e))
+
+		del buf[:pos]
+
+	def _handle(self, src, msg):
+		import core.modules as _modules
+
+		if msg[0] == KIND_EVENT:
+			kind, target, modname, sender, protocol, event, data = msg
+			module = _modules.getmodule(modname)
+			if module is None:
+				log.warning('Dropping event ' + event + ' from shard ' + str(src) + ' for unknown module ' + modname)
+				return
+			_modules.deliver_event_target(self.loop, target, module, sender, protocol, event, data)
+		elif msg[0] == KIND_CALLBACK:
+			kind, cbid, result = msg
+			if cbid in callbacks:
+				cb = callbacks.pop(cbid)[0]
+				cb(result)
+
+# Stands in for a callback that lives in another worker
+class RemoteCallback:
+	__slots__ = ('shard', 'id')
+
+	def __init__(self, shard, id):
+		self.shard = shard
+		self.id = id
+
+	def __call__(self, result):
+		_send(self.shard, (KIND_CALLBACK, self.id, result))
+
+def start(loop):
+	loop.create_task(loop.create_connection(lambda: ShardProtocol(loop), sock=sock))
+
+def _forward(dest, target, module, sender, protocol, event, data):
+	if data is not None and 'callback' in data and callable(data['callback']):
+		data = data.copy()
+		data['callback'] = _wrapcallback(data['callback'])
+
+	_send(dest, (KIND_EVENT, target, module.name, sender, protocol, event, data))
+
+def _wrapcallback(cb):
+	global callbacks, callbackid, callbacktimeout
+
+	if isinstance(cb, RemoteCallback):
+		return cb
+
+	now = time.monotonic()
+
+	# Forget callbacks that were never answered, oldest first
+	for cbid in list(callbacks):
+		if callbacks[cbid][1] > now - callbacktimeout:
+			break
+		del callbacks[cbid]
+
+	callbackid += 1
+	callbacks[callbackid] = (cb, now)
+	return RemoteCallback(index, callbackid)
+
+def _send(dest, msg):
+	global transport, pending
+
+	try:
+		payload = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+	except Exception as e:
+		log.warning('Unable to send message to shard ' + str(dest) + ': ' + str(e))
+		return
+
+	frame = HEADER.pack(len(payload), dest, index) + payload
+
+	if transport is None:
+		pending.append(frame)
+	else:
+		transport.write(frame)
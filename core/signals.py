@@ -20,7 +20,11 @@
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
 import core.logging as _logging
+import core.config as _config
+import core.connect as _connect
+import core.executor as _executor
 import core.modules as _modules
+import core.reconnect as _reconnect
 
 import os, signal
 
@@ -29,13 +33,16 @@ log = _logging.log.getChild(__name__)
 def handle_sigint(loop):
 	log.info('Shutting down: Received signal SIGINT')
 	_modules.shutdown(loop)
+	_executor.shutdown()
 	loop.call_later(2, loop.stop)
 
 def handle_sighup(loop):
-	log.info('Received signal SIGHUP')
+	log.info('Received signal SIGHUP, reloading configuration')
+	_config.reload(loop)
 
 def handle_sigusr1(loop):
-	log.info('Received signal SIGUSR1')
+	log.info('Received signal SIGUSR1, logging statistics')
+	logstats()
 
 def handle_sigusr2(loop):
 	log.info('Received signal SIGUSR2')
@@ -43,8 +50,21 @@ def handle_sigusr2(loop):
 def handle_sigterm(loop):
 	log.info('Shutting down: Received signal SIGTERM')
 	_modules.shutdown(loop)
+	_executor.shutdown()
 	loop.call_later(2, loop.stop)
 
+def logstats():
+	stats = _modules.getstats()
+
+	log.info('Events pending delivery: ' + str(stats['pending']))
+	for name in stats['subscribers']:
+		log.info('Event queue for module ' + name + ': ' + str(stats['subscribers'][name]))
+	for name in stats['modules']:
+		log.info('Statistics for module ' + name + ': ' + str(stats['modules'][name]))
+	for name, backoff in _reconnect.getstats().items():
+		log.info('Reconnects for ' + name + ': ' + str(backoff))
+	log.info('Connections: ' + str(_connect.getstats()))
+
 def init_signals(loop):
 	if not os.name == 'nt':
 		log.debug('Adding signal handlers')
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, core/timers.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Named deadlines sharing one event loop timer
+#
+# Every call_later() puts a handle on the loop's heap, and a cancelled one
+# stays there until it would have run. Timers keeps its deadlines in a dict
+# and has a single handle on the loop for the earliest of them. Setting a
+# later deadline or cancelling one never touches the loop, the handle just
+# finds nothing due when it fires and is armed again for the next one.
+#
+# Setting a name that is already pending replaces its deadline, so the same
+# thing is never scheduled twice.
+
+import core.logging as _logging
+
+log = _logging.log.getChild(__name__)
+
+# Deadlines this close are run together rather than arming another handle
+slack = 0.001
+
+class Timers:
+	def __init__(self, loop):
+		self.loop = loop
+		# Name: (loop time, callback, args)
+		self.deadlines = {}
+		self.handle = None
+		self.when = None
+
+		self.fired = 0
+		self.armed = 0
+
+	def set(self, name, delay, callback, *args):
+		when = self.loop.time() + delay
+		self.deadlines[name] = (when, callback, args)
+		if self.handle is None or when < self.when - slack:
+			self._arm(when)
+
+	def cancel(self, name):
+		self.deadlines.pop(name, None)
+
+	def pending(self, name):
+		return name in self.deadlines
+
+	def clear(self):
+		self.deadlines.clear()
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+
+	def _arm(self, when):
+		if self.handle is not None:
+			self.handle.cancel()
+		self.when = when
+		self.handle = self.loop.call_at(when, self._fire)
+		self.armed += 1
+
+	def _fire(self):
+		self.handle = None
+
+		try:
+			now = self.loop.time() + slack
+			deadlines = self.deadlines
+			for name in [name for name in deadlines if deadlines[name][0] <= now]:
+				# An earlier callback may have cancelled or replaced it
+				entry = deadlines.get(name, None)
+				if entry is None or entry[0] > now:
+					continue
+				del deadlines[name]
+				self.fired += 1
+				try:
+					entry[1](*entry[2])
+				except Exception as e:
+					log.exception('Error running timer ' + str(name) + ': ' + str(e))
+		finally:
+			# Whatever happened above, the remaining deadlines still need a handle
+			if self.deadlines:
+				when = min(entry[0] for entry in self.deadlines.values())
+				if self.handle is None or when < self.when - slack:
+					self._arm(when)
+
+	def getstats(self):
+		return {'pending': len(self.deadlines), 'fired': self.fired, 'armed': self.armed}
@@ -20,16 +20,29 @@
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
 import core.logging as _logging
-import ssl
+import core.config as _config
+import core.modules as _modules
+import core.shard as _shard
+import modules.irc.tls as _tls
+import codecs
 
 log = _logging.log.getChild(__name__)
 
 configs = {}
+active = set()
+
+subscriptions = [(None, None, 'IRC_SENDCMD')]
 
 def loadconfig(config, module):
 	global configs
+
+	configs = _loadconfigs(config)
+
+def _loadconfigs(config):
 	global log
 
+	configs = {}
+
 	for irccfg in config:
 		if not 'name' in irccfg.attrib:
 			log.warning('IRC client config missing name attribute')
@@ -73,13 +86,21 @@ def loadconfig(config, module):
 					tkey = conf['server']['tlskey']
 				conf['server']['tlscert'] = None
 				conf['server']['tlskey'] = None
-				try:
-					sctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-					sctx.load_cert_chain(tcert, tkey)
-					conf['server']['tlscert'] = tcert
-					conf['server']['tlskey'] = tkey
-				except:
-					pass
+				if tcert:
+					# Kept for the first connect
+					try:
+						_tls.getcontext(name, tcert, tkey)
+						conf['server']['tlscert'] = tcert
+						conf['server']['tlskey'] = tkey
+					except:
+						pass
+		if not 'charset' in conf['server']:
+			conf['server']['charset'] = 'latin-1'
+		try:
+			codecs.lookup(conf['server']['charset'])
+		except LookupError:
+			log.warning('IRC client ' + name + ' has an unknown charset "' + conf['server']['charset'] + '", using latin-1')
+			conf['server']['charset'] = 'latin-1'
 		if not 'password' in conf['server']:
 			conf['server']['password'] = None
 		if conf['server']['password'] == '':
@@ -101,6 +122,12 @@ def loadconfig(config, module):
 			log.warning('IRC client ' + name + ' user missing gecos attribute')
 			continue
 		conf['user'] = user
+		conf['usercfg'] = user.copy()
+
+		conf['flood'] = _loadflood(irccfg, name)
+		conf['sync'] = _loadsync(irccfg, name)
+		conf['pool'] = _loadpool(irccfg, name)
+		conf['keepalive'] = _loadkeepalive(irccfg, name)
 
 		chans = irccfg.findall('./channel')
 		if not chans:
@@ -124,49 +151,210 @@ def loadconfig(config, module):
 
 		configs[name] = conf
 		log.debug('Loaded config: ' + str(conf))
-	return
+	return configs
+
+def _loadflood(irccfg, name):
+	global log
+
+	import modules.irc.sendqueue as _sendqueue
+
+	flood = _sendqueue.flooddefaults.copy()
+
+	node = irccfg.find('./flood')
+	if node is None:
+		return flood
+
+	attrs = _config.getattrs(node, log, {
+		'burst': {'type': _config.TYPE_FLOAT, 'def': flood['burst']},
+		'rate': {'type': _config.TYPE_FLOAT, 'def': flood['rate']},
+		'cost': {'type': _config.TYPE_FLOAT, 'def': flood['cost']},
+		'bytes': {'type': _config.TYPE_INT, 'def': flood['bytes']}
+		})
+
+	for key in flood:
+		if attrs[key] > 0 or (attrs[key] == 0 and key in ['cost', 'bytes']):
+			flood[key] = attrs[key]
+		else:
+			log.warning('IRC client ' + name + ' has an invalid flood ' + key + ' value, using ' + str(flood[key]))
+
+	return flood
+
+def _loadsync(irccfg, name):
+	global log
+
+	import modules.irc.sync as _sync
+
+	sync = _sync.syncdefaults.copy()
+
+	node = irccfg.find('./sync')
+	if node is None:
+		return sync
+
+	attrs = _config.getattrs(node, log, {
+		'burst': {'type': _config.TYPE_FLOAT, 'def': sync['burst']},
+		'rate': {'type': _config.TYPE_FLOAT, 'def': sync['rate']},
+		'timeout': {'type': _config.TYPE_FLOAT, 'def': sync['timeout']}
+		})
+
+	for key in sync:
+		if attrs[key] > 0:
+			sync[key] = attrs[key]
+		else:
+			log.warning('IRC client ' + name + ' has an invalid sync ' + key + ' value, using ' + str(sync[key]))
+
+	return sync
+
+def _loadkeepalive(irccfg, name):
+	global log
+
+	import modules.irc.lag as _lag
+
+	keepalive = _lag.keepalivedefaults.copy()
+
+	node = irccfg.find('./keepalive')
+	if node is None:
+		return keepalive
+
+	attrs = _config.getattrs(node, log, {
+		'interval': {'type': _config.TYPE_FLOAT, 'def': keepalive['interval']},
+		'min': {'type': _config.TYPE_FLOAT, 'def': keepalive['min']},
+		'max': {'type': _config.TYPE_FLOAT, 'def': keepalive['max']},
+		'factor': {'type': _config.TYPE_FLOAT, 'def': keepalive['factor']},
+		'pause': {'type': _config.TYPE_FLOAT, 'def': keepalive['pause']}
+		})
+
+	for key in keepalive:
+		if attrs[key] > 0 or (attrs[key] == 0 and key == 'pause'):
+			keepalive[key] = attrs[key]
+		else:
+			log.warning('IRC client ' + name + ' has an invalid keepalive ' + key + ' value, using ' + str(keepalive[key]))
+
+	if keepalive['min'] > keepalive['max']:
+		log.warning('IRC client ' + name + ' has a keepalive min above its max, using ' + str(keepalive['max']))
+		keepalive['min'] = keepalive['max']
+
+	return keepalive
+
+def _loadpool(irccfg, name):
+	global log
+
+	node = irccfg.find('./pool')
+	if node is None:
+		return 1
+
+	attrs = _config.getattrs(node, log, {
+		'size': {'type': _config.TYPE_INT, 'def': 1}
+		})
+
+	if not 'size' in attrs or attrs['size'] < 1:
+		log.warning('IRC client ' + name + ' has an invalid pool size, using 1')
+		return 1
+	return attrs['size']
 
 def applyconfig(loop, module):
-	global configs
+	global configs, active
 	global log
 
 	import modules.irc.protocol as _protocol
 
 	for name in configs:
 		conf = configs[name]
+		if not _shard.owns(module.name, name):
+			log.debug('IRC client ' + name + ' is handled by shard ' + str(_shard.owner(module.name, name)))
+			continue
 		log.info('Creating IRC client ' + name)
 
 		_protocol.createclient(loop, conf, module)
+		active.add(name)
+	return
+
+def reloadconfig(loop, config, module):
+	global configs, active
+	global log
+
+	import modules.irc.protocol as _protocol
+
+	newconfigs = _loadconfigs(config)
+
+	for name in list(configs):
+		if not name in newconfigs:
+			if name in active:
+				log.info('Removing IRC client ' + name)
+				_protocol.removeclient(loop, configs[name])
+				active.discard(name)
+			del configs[name]
+
+	for name in newconfigs:
+		conf = newconfigs[name]
+
+		if not _shard.owns(module.name, name):
+			if name in active:
+				log.info('IRC client ' + name + ' moved to shard ' + str(_shard.owner(module.name, name)))
+				_protocol.removeclient(loop, configs[name])
+				active.discard(name)
+			configs[name] = conf
+			continue
+
+		if not name in active:
+			log.info('Creating IRC client ' + name)
+			configs[name] = conf
+			_protocol.createclient(loop, conf, module)
+			active.add(name)
+			continue
+
+		old = configs[name]
+		if old['server'] != conf['server'] or old['usercfg']['user'] != conf['usercfg']['user'] or old['usercfg']['gecos'] != conf['usercfg']['gecos'] or old['pool'] != conf['pool']:
+			# Only a new connection picks up server, ident or pool changes
+			log.info('Reconnecting IRC client ' + name + ' to apply configuration changes')
+			_protocol.removeclient(loop, old)
+			configs[name] = conf
+			_protocol.createclient(loop, conf, module)
+			continue
+
+		_protocol.updateclient(loop, old, conf)
 	return
 
 def shutdown(loop):
+	global configs
 	global log
 	import modules.irc.protocol as _protocol
-	
+
+	# Stop any reconnects that are still pending
+	for name in configs:
+		configs[name]['removed'] = True
+
 	for cli in _protocol.clients:
 		_protocol.clients[cli].shutdown(loop)
 
+def getstats():
+	stats = {}
+
+	for name, prot, cli in _modules.getclients('irc'):
+		stats[name] = {'sendq': cli.sendq.getstats(), 'state': cli.state.getstats(), 'sync': cli.sync.getstats(), 'lag': cli.lag.getstats()}
+		if cli.pool is not None:
+			stats[name]['pool'] = cli.pool.getstats()
+		if cli.config['server']['tls']:
+			stats[name]['tls'] = _tls.getstats(name)
+
+	return stats
+
 def handle_event(loop, module, sender, protocol, event, data):
 	global log
-	import modules.irc.protocol as _protocol
-	
-	for cli in _protocol.clients:
-		if module.name == 'irc' and protocol == 'irc' and sender == cli:
+
+	for name, prot, cli in _modules.getclients('irc'):
+		if module.name == 'irc' and protocol == prot and sender == name:
 			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '"')
-		_protocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
+		log.debug('Sending event "%s" to client "%s"', event, name)
+		cli.handle_event(loop, module, sender, protocol, event, data)
 
 def handle_event_target(loop, target, module, sender, protocol, event, data):
 	global log
-	import modules.irc.protocol as _protocol
 
 	if 'module' in target and target['module'] != 'irc':
 		return
 
-	for cli in _protocol.clients:
-		if module.name == 'irc' and protocol == 'irc' and sender == cli:
-			continue
-		if 'name' in target and target['name'] != cli:
+	for name, prot, cli in _modules.getclients('irc', target.get('name', None), target.get('protocol', None)):
+		if module.name == 'irc' and protocol == prot and sender == name:
 			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '"')
-		_protocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
+		log.debug('Sending event "%s" to client "%s"', event, name)
+		cli.handle_event(loop, module, sender, protocol, event, data)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, modules/irc/lag.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Round trip times to an IRC server
+#
+# A PING carrying a token of ours goes out at most every 'interval' seconds
+# and the time until its PONG is one sample. The lag is the last sample, or
+# how long the PING we are waiting on has been out if that is longer.
+#
+# A connection that has been silent for 'interval' seconds is pinged and
+# dropped if still nothing arrives within 'factor' times the 95th percentile
+# of recent samples, kept between 'min' and 'max' seconds. A link that
+# answers in 50ms is given up on long before one that takes 5 seconds.
+
+import collections
+
+keepalivedefaults = {'interval': 30.0, 'min': 10.0, 'max': 60.0, 'factor': 4.0, 'pause': 0.0}
+
+samplesize = 64
+
+class LagMeter:
+	def __init__(self, loop, conf):
+		self.loop = loop
+		self.setconfig(conf)
+
+		self.samples = collections.deque(maxlen=samplesize)
+		self.avg = None
+		self.last = None
+		self.count = 0
+		# Token and loop time of the PING we are waiting on
+		self.token = None
+		self.sent = None
+		self.lastping = loop.time()
+
+		self.pings = 0
+		self.lost = 0
+
+	def setconfig(self, conf):
+		self.interval = conf['interval']
+		self.min = conf['min']
+		self.max = conf['max']
+		self.factor = conf['factor']
+		self.pause = conf['pause']
+
+	def due(self, now):
+		if self.sent is not None:
+			# Servers answer every PING, but do not wait forever
+			return now - self.sent >= self.max
+		return now - self.lastping >= self.interval
+
+	# Returns the token to send
+	def ping(self, now):
+		if self.sent is not None:
+			# Never answered, only one is kept track of
+			self.lost += 1
+		self.count += 1
+		self.token = 'LAG' + str(self.count)
+		self.sent = now
+		self.lastping = now
+		self.pings += 1
+		return self.token
+
+	# Returns the round trip time, or None if the PONG was not for our PING
+	def pong(self, token, now):
+		if self.sent is None or token != self.token:
+			return None
+
+		rtt = now - self.sent
+		self.sent = None
+		self.token = None
+		self.last = rtt
+		self.samples.append(rtt)
+		if self.avg is None:
+			self.avg = rtt
+		else:
+			self.avg += (rtt - self.avg) * 0.2
+		return rtt
+
+	def current(self, now):
+		lag = self.last or 0.0
+		if self.sent is not None and now - self.sent > lag:
+			return now - self.sent
+		return lag
+
+	def lagging(self, now):
+		return self.pause > 0 and self.current(now) > self.pause
+
+	def percentile(self, pct):
+		if not self.samples:
+			return None
+		samples = sorted(self.samples)
+		return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+	# How long a silent connection has to answer a PING
+	def timeout(self):
+		p95 = self.percentile(95)
+		if p95 is None:
+			return self.max
+		return min(self.max, max(self.min, p95 * self.factor))
+
+	def getstats(self):
+		ret = {'pings': self.pings, 'lost': self.lost, 'samples': len(self.samples), 'lag': round(self.current(self.loop.time()), 3), 'avg': None, 'p50': None, 'p95': None, 'timeout': round(self.timeout(), 3)}
+		if self.avg is not None:
+			ret['avg'] = round(self.avg, 3)
+			ret['p50'] = round(self.percentile(50), 3)
+			ret['p95'] = round(self.percentile(95), 3)
+		return ret
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, modules/irc/message.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# IRC message parsing
+#
+# parse() splits a line into its parts in a single pass. The source prefix
+# and IRCv3 message tags are kept as raw strings and only split up the
+# first time a handler reads msg.source or msg.tags, most messages are
+# never looked at that closely.
+
+import core.events as _events
+import re
+
+__all__ = ['IRCMessage', 'parse', 'parsesource', 'splittext']
+
+tagescapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+# Formatting codes, colours take up to two digits for the foreground and
+# optionally a comma and up to two more for the background
+formatre = re.compile(rb'[\x02\x0f\x11\x16\x1d\x1e\x1f]|\x03(?:(\d\d?)(?:,(\d\d?))?)?|\x04(?:([0-9a-fA-F]{6})(?:,([0-9a-fA-F]{6}))?)?')
+formattoggles = b'\x02\x11\x16\x1d\x1e\x1f'
+
+class IRCMessage:
+	__slots__ = ('rawtags', 'prefix', 'command', 'params', '_tags', '_source')
+
+	def __init__(self, command, params, prefix='', rawtags=''):
+		self.rawtags = rawtags
+		self.prefix = prefix
+		self.command = command
+		self.params = params
+		self._tags = None
+		self._source = None
+
+	@property
+	def source(self):
+		if self._source is None:
+			self._source = parsesource(self.prefix)
+		return self._source
+
+	@property
+	def tags(self):
+		if self._tags is None:
+			self._tags = parsetags(self.rawtags)
+		return self._tags
+
+	# Dict style access for code written against the old parser output
+	def __getitem__(self, key):
+		if key == 'msg':
+			return self.command
+		if key in ('params', 'source', 'tags'):
+			return getattr(self, key)
+		raise KeyError(key)
+
+	def __repr__(self):
+		ret = 'IRCMessage('
+		if self.rawtags:
+			ret += '@' + self.rawtags + ' '
+		if self.prefix:
+			ret += ':' + self.prefix + ' '
+		return ret + self.command + ' ' + repr(self.params) + ')'
+
+def parse(line):
+	pos = 0
+	rawtags = ''
+	prefix = ''
+
+	if line[:1] == '@':
+		end = line.find(' ')
+		if end < 0:
+			return IRCMessage('', [], '', line[1:])
+		rawtags = line[1:end]
+		pos = end + 1
+		while line[pos:pos + 1] == ' ':
+			pos += 1
+
+	if line[pos:pos + 1] == ':':
+		end = line.find(' ', pos)
+		if end < 0:
+			return IRCMessage('', [], line[pos + 1:], rawtags)
+		prefix = line[pos + 1:end]
+		pos = end + 1
+
+	# Everything after the first " :" is the trailing parameter, kept as is.
+	# Only spaces separate parameters, str.split() would also split on the
+	# \x1c-\x1f formatting codes.
+	end = line.find(' :', pos)
+	if end < 0:
+		middle = line[pos:]
+	else:
+		middle = line[pos:end]
+	if '  ' in middle:
+		params = [param for param in middle.split(' ') if param]
+	else:
+		middle = middle.strip(' ')
+		params = middle.split(' ') if middle else []
+	if end >= 0:
+		params.append(line[end + 2:])
+
+	if not params:
+		return IRCMessage('', params, prefix, rawtags)
+
+	command = params.pop(0)
+	return IRCMessage(command, params, prefix, rawtags)
+
+def parsesource(prefix):
+	# Filled in directly, Event.__init__ is slow for something this common
+	src = _events.IrcSource.__new__(_events.IrcSource)
+	src.full = prefix
+	name, sep, src.host = prefix.partition('@')
+	src.name, sep, src.ident = name.partition('!')
+	src.modes = ''
+	return src
+
+def parsetags(rawtags):
+	ret = {}
+
+	if not rawtags:
+		return ret
+
+	for tag in rawtags.split(';'):
+		if not tag:
+			continue
+		key, sep, val = tag.partition('=')
+		if '\\' in val:
+			val = _unescape(val)
+		ret[key] = val
+
+	return ret
+
+def _unescape(val):
+	ret = ''
+	pos = 0
+
+	while True:
+		end = val.find('\\', pos)
+		if end < 0:
+			return ret + val[pos:]
+		ret += val[pos:end]
+		# A lone backslash at the end is dropped, unknown escapes lose the backslash
+		c = val[end + 1:end + 2]
+		ret += tagescapes.get(c, c)
+		pos = end + 2
+
+# Splits text into chunks of at most maxbytes bytes of UTF-8
+#
+# Chunks end at the last space that leaves them at least half full, else
+# at a character boundary, never inside a colour code. Formatting that is
+# still on at the end of a chunk is turned back on at the start of the next
+# one. The text is encoded once and each chunk is only looked at once.
+def splittext(text, maxbytes):
+	data = text.encode('utf-8')
+	total = len(data)
+
+	if total <= maxbytes:
+		return [data]
+
+	ret = []
+	start = 0
+	state = b''
+	fmt = None
+
+	while start < total:
+		budget = maxbytes - len(state)
+		end = start + budget
+
+		if end >= total:
+			ret.append(state + data[start:])
+			break
+
+		cut = data.rfind(b' ', start + budget // 2, end + 1)
+		if cut > start:
+			nextstart = cut + 1
+		else:
+			cut = end
+			# Back up to the first byte of a UTF-8 sequence
+			while cut > start and (data[cut] & 0xc0) == 0x80:
+				cut -= 1
+			nextstart = cut
+
+		# Colour codes are at most 14 bytes long
+		pos = max(data.rfind(b'\x03', max(start, cut - 6), cut), data.rfind(b'\x04', max(start, cut - 14), cut))
+		if pos > start:
+			m = formatre.match(data, pos)
+			if m.end() > cut:
+				cut = nextstart = pos
+
+		chunk = data[start:cut]
+		ret.append(state + chunk)
+		fmt = _formatstate(chunk, fmt)
+		state = _formatcodes(fmt)
+		start = nextstart
+
+	return ret
+
+# Returns [toggles, colour, hex colour] in effect after chunk, given the
+# state before it
+def _formatstate(chunk, fmt):
+	if fmt is None:
+		fmt = [set(), b'', b'']
+	else:
+		fmt = [set(fmt[0]), fmt[1], fmt[2]]
+
+	for m in formatre.finditer(chunk):
+		code = m.group(0)[0]
+		if code == 0x0f:
+			fmt = [set(), b'', b'']
+		elif code == 0x03:
+			if m.group(1) is None:
+				fmt[1] = b''
+			else:
+				# Two digit colours cannot run into digits in the next chunk
+				fg = m.group(1).rjust(2, b'0')
+				bg = m.group(2)
+				if bg is not None:
+					fmt[1] = b'\x03' + fg + b',' + bg.rjust(2, b'0')
+				elif fmt[1][3:4] == b',':
+					fmt[1] = b'\x03' + fg + fmt[1][3:]
+				else:
+					fmt[1] = b'\x03' + fg
+		elif code == 0x04:
+			if m.group(3) is None:
+				fmt[2] = b''
+			else:
+				fmt[2] = m.group(0)
+		elif code in fmt[0]:
+			fmt[0].discard(code)
+		else:
+			fmt[0].add(code)
+
+	return fmt
+
+def _formatcodes(fmt):
+	ret = fmt[1] + fmt[2]
+	for code in formattoggles:
+		if code in fmt[0]:
+			ret += bytes([code])
+	return ret
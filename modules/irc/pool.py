@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, modules/irc/pool.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Several connections to one IRC network
+#
+# Each connection has its own send queue, so relayed lines get the flood
+# budget of every connection in the pool. One member is the leader: it
+# tracks channel members in the state the pool shares, answers commands
+# and passes channel messages on to other modules. The others only keep
+# themselves connected and in the channels.
+#
+# Relayed messages for a channel always go out through the same member so
+# they arrive in order. A channel is given to the member with the fewest
+# channels when it is first sent to, and moved only if that member drops.
+# Lines still queued on a member that drops are handed to the others, and
+# if it was the leader the next member takes over.
+
+import modules.irc.state as _state
+
+# Commands spread over the pool, anything else goes through the leader
+balancecmds = {'PRIVMSG', 'NOTICE'}
+
+class ConnectionPool:
+	def __init__(self, loop, config, module, log, connect):
+		self.loop = loop
+		self.config = config
+		self.module = module
+		self.log = log
+		self.connect = connect
+
+		self.isshutdown = False
+		self.members = [None] * config['pool']
+		self.leader = None
+		self.state = _state.IRCState()
+
+		# Folded channel name: index of the member sending to it
+		self.targets = {}
+
+		self.failovers = 0
+		self.moved = 0
+		self.dropped = 0
+
+	def start(self):
+		for index in range(len(self.members)):
+			self.connect(self, index)
+
+	# Each member needs a nick of its own
+	def nick(self, index, nick):
+		if index == 0:
+			return nick
+		return nick + str(index)
+
+	def connected(self):
+		return [member for member in self.members if member is not None]
+
+	def attach(self, member):
+		self.members[member.index] = member
+		if self.leader is None:
+			self.leader = member
+			member.lead()
+
+	def detach(self, member, lines):
+		if self.members[member.index] is not member:
+			return
+		self.members[member.index] = None
+
+		for chan in [chan for chan in self.targets if self.targets[chan] == member.index]:
+			del self.targets[chan]
+
+		if self.isshutdown:
+			return
+
+		if self.leader is member:
+			self.leader = None
+			for other in self.members:
+				if other is not None:
+					self.log.info('Connection ' + str(other.index) + ' taking over from connection ' + str(member.index))
+					self.failovers += 1
+					self.leader = other
+					other.lead()
+					break
+
+		for prio, key, data in lines:
+			# Other lines only make sense on the connection that queued them
+			parts = data.split(b' ', 2)
+			if len(parts) < 3 or not parts[0].decode('utf-8', 'replace') in balancecmds:
+				continue
+			other = self._pick(parts[1].decode('utf-8', 'replace'))
+			if other is None:
+				self.dropped += 1
+				continue
+			other.sendq.put(data, prio, key)
+			self.moved += 1
+
+	def send(self, command, prio):
+		member = None
+
+		cmd, sep, rest = command.partition(' ')
+		if cmd.upper() in balancecmds:
+			member = self._pick(rest.partition(' ')[0])
+
+		if member is None:
+			member = self.leader
+		if member is not None:
+			member._send(command, prio=prio)
+
+	def _pick(self, target):
+		chan = self.state.fold(target)
+
+		index = self.targets.get(chan, None)
+		if index is not None:
+			member = self.members[index]
+			if member is not None and member.injoined(chan):
+				return member
+
+		best = None
+		count = 0
+		for member in self.members:
+			if member is None or not member.injoined(chan):
+				continue
+			mine = sum(1 for other in self.targets.values() if other == member.index)
+			if best is None or mine < count:
+				best = member
+				count = mine
+
+		if best is None:
+			# Private messages and channels no member is in yet
+			return self.leader
+
+		self.targets[chan] = best.index
+		return best
+
+	def shutdown(self, loop):
+		self.isshutdown = True
+		for member in self.connected():
+			member.shutdown(loop)
+
+	def setnick(self, nick):
+		if self.members[0] is None:
+			self.config['user']['nick'] = nick
+		for member in self.connected():
+			member.setnick(self.nick(member.index, nick))
+
+	def setflood(self, conf):
+		for member in self.connected():
+			member.setflood(conf)
+
+	def setsync(self, conf):
+		for member in self.connected():
+			member.setsync(conf)
+
+	def setkeepalive(self, conf):
+		for member in self.connected():
+			member.setkeepalive(conf)
+
+	def addchan(self, chan, attrs):
+		if self.members[0] is None:
+			self.config['channels'][chan] = attrs
+		for member in self.connected():
+			if member.index == 0:
+				member.addchan(chan, attrs)
+			else:
+				member.addchan(chan, dict(attrs))
+
+	def delchan(self, chan):
+		self.targets.pop(chan, None)
+		if self.members[0] is None:
+			self.config['channels'].pop(chan, None)
+		for member in self.connected():
+			if chan in member.chans:
+				member.delchan(chan)
+
+	def getstats(self):
+		members = {}
+		for index in range(len(self.members)):
+			member = self.members[index]
+			if member is None:
+				members[index] = {'connected': False}
+				continue
+			members[index] = {'connected': True, 'nick': member.user['nick'], 'targets': sum(1 for other in self.targets.values() if other == index), 'depth': member.sendq.depth, 'bytes': member.sendq.sentbytes, 'lag': member.lag.getstats()['lag']}
+		leader = None
+		if self.leader is not None:
+			leader = self.leader.index
+		return {'leader': leader, 'failovers': self.failovers, 'moved': self.moved, 'dropped': self.dropped, 'members': members}
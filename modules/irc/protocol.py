@@ -20,34 +20,110 @@
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
 import core.logging as _logging
+import core.connect as _connect
 import core.modules as _modules
-import asyncio, re, ssl
+import core.reconnect as _reconnect
+import core.timers as _timers
+import core.events as _events
+import modules.irc.lag as _lag
+import modules.irc.message as _message
+import modules.irc.pool as _pool
+import modules.irc.sendqueue as _sendqueue
+import modules.irc.state as _state
+import modules.irc.sync as _sync
+import modules.irc.tls as _tls
+import asyncio, re
 
 log = _logging.log.getChild(__name__)
 
 clients = {}
 
+# Name: IRCState kept while a client reconnects
+states = {}
+
+# Lines the connection depends on, sent ahead of anything else queued
+criticalcmds = {'PING', 'PONG', 'CAP', 'NICK', 'JOIN', 'PASS', 'USER', 'QUIT'}
+
+# Messages too long for one line are split over several
+splitcmds = {'PRIVMSG', 'NOTICE'}
+
+# Longest line a server accepts or relays, including the source prefix it
+# adds and the CRLF
+maxline = 512
+
+# Batch types applied as one membership update when the batch ends
+bulkbatches = {'netsplit', 'netjoin'}
+
+# Servers without the batch capability send netsplit QUITs one by one with
+# the two server names as the reason. Those arriving within splitwindow
+# seconds of each other are applied together.
+splitre = re.compile('^[^ ]+\\.[^ ]+ [^ ]+\\.[^ ]+$')
+splitwindow = 0.5
+
 class IRCClientProtocol(asyncio.Protocol):
-	def __init__(self, loop, config, module):
+	def __init__(self, loop, config, module, pool=None, index=0):
 		global clients
 		self.loop = loop
 		self.config = config
 		self.module = module
+		self.pool = pool
+		self.index = index
 		self.transport = None
-		self.log = log.getChildObj(self.config['name'])
+		if pool is None:
+			self.log = log.getChildObj(self.config['name'])
+		else:
+			self.log = log.getChildObj(self.config['name'] + '/' + str(index))
 
 		self.isshutdown = False
 		self.hasperformed = False
+		self.relaying = False
+		if pool is None:
+			self.backoff = _reconnect.backoff(backoffname(config))
+		else:
+			self.backoff = _reconnect.backoff(backoffname(config, index))
 		self.errormsg = None
 		self.capendhandle = None
-		self.pingcheck = False
+		# Loop time of the last data from the server, and of the PING sent
+		# when it went quiet
+		self.lastrecv = loop.time()
+		self.idleping = None
 
 		self.rejoindelay = 30
-		self.pingfrequency = 60
+		self.lag = _lag.LagMeter(loop, config['keepalive'])
+
+		# Received bytes that do not make a complete line yet
+		self.buf = bytearray()
+		self.maxbuf = 16384
+		self.charset = config['server']['charset']
+
+		self.sendq = _sendqueue.SendQueue(loop, config['flood'], self.log)
 
 		self.chans = config['channels']
 		self.user = config['user']
+		if pool is None:
+			# Members are checked against NAMES again after rejoining
+			self.state = states.pop(config['name'], None)
+			if self.state is None:
+				self.state = _state.IRCState()
+		else:
+			# Pool members share what they know about users, but each is in
+			# the channels on its own and has a nick of its own
+			self.state = pool.state
+			if index > 0:
+				self.chans = {chan: dict(self.chans[chan]) for chan in self.chans}
+				self.user = dict(self.user)
+				self.user['nick'] = pool.nick(index, self.user['nick'])
+				self.user.pop('inc', None)
 		self.user['newnick'] = self.user['nick']
+		self.sync = _sync.SyncScheduler(loop, config['sync'], self.log, self._send, self._whoexpired)
+		# Folded nick: [(target, nick)], ?account requests waiting on a WHO
+		self.lookups = {}
+
+		# user@host as the server shows us to others, used to work out how
+		# much text fits in a line. Until we see it assume the longest
+		# ident and host most servers allow
+		self.userhost = None
+		self.userhostguess = 'x' * 11 + '@' + 'x' * 63
 
 		self.n005kv = re.compile('^(?P<key>[^=]+?)(?:=(?P<value>.*?))?$')
 
@@ -57,18 +133,26 @@ class IRCClientProtocol(asyncio.Protocol):
 		self.chanmodes = ['b', 'k', 'l', 'imnpst']
 		self.haswhox = False
 
-		self.rejointimer = None
-		self.pingtimer = None
-		self.timers = []
+		# Batch reference: [type, params, [messages]]
+		self.batches = {}
+		# Folded nicks that quit in what looks like a netsplit
+		self.splitquits = []
 
-		self.handlers = {
+		# Keepalive, join retries and the netsplit window
+		self.timers = _timers.Timers(loop)
+
+		self.leadhandlers = {
 			'005': self.m_005,
+			'315': self.m_315,
 			'353': self.m_353,
 			'354': self.m_354,
 			'366': self.m_366,
 			'433': self.m_433,
+			'396': self.m_396,
 			'ACCOUNT': self.m_account,
+			'BATCH': self.m_batch,
 			'CAP': self.m_cap,
+			'CHGHOST': self.m_chghost,
 			'ERROR': self.m_error,
 			'JOIN': self.m_join,
 			'KICK': self.m_kick,
@@ -77,34 +161,63 @@ class IRCClientProtocol(asyncio.Protocol):
 			'NICK': self.m_nick,
 			'PART': self.m_part,
 			'PING': self.m_ping,
+			'PONG': self.m_pong,
 			'PRIVMSG': self.m_privmsg,
 			'QUIT': self.m_quit
 		}
 
+		# Pool members other than the leader only look after themselves
+		self.followhandlers = {
+			'005': self.m_005,
+			'433': self.m_433,
+			'396': self.m_396,
+			'CAP': self.m_cap,
+			'CHGHOST': self.m_chghost,
+			'ERROR': self.m_error,
+			'JOIN': self.f_join,
+			'KICK': self.f_kick,
+			'NICK': self.f_nick,
+			'PART': self.f_part,
+			'PING': self.m_ping,
+			'PONG': self.m_pong
+		}
+
+		self.handlers = self.leadhandlers
+		if pool is not None:
+			self.handlers = self.followhandlers
+
 		self.caps = {
 			'away-notify': False,
+			'batch': False,
 			'account-notify': False,
 			'extended-join': False,
 			'multi-prefix': False,
 			'userhost-in-names': False,
-			'cap-notify': False
+			'cap-notify': False,
+			'chghost': False
 		}
 
-		clients[self.config['name']] = self
+		if pool is None:
+			clients[self.config['name']] = self
 
 		for chan in self.chans:
 			self.chans[chan]['joined'] = False
-			self.chans[chan]['users'] = {}
-			self.chans[chan]['jointimer'] = None
+		self._rekeychans()
 
 	def connection_made(self, transport):
 		self.transport = transport
+		self.sendq.connect(transport)
 		self.log.info('Connection established')
-		self._resetping()
+		if self.pool is None:
+			_modules.register_client(self.module.name, self.config['name'], 'irc', self)
+		else:
+			self.pool.attach(self)
+		self.lastrecv = self.loop.time()
+		self.timers.set('idle', self.lag.interval, self._checkidle)
 		self._send('CAP', 'LS')
 		if self.config['server']['password'] is not None:
 			self._send('PASS', self.config['server']['password'])
-		self._send('NICK', self.config['user']['nick'])
+		self._send('NICK', self.user['nick'])
 		self._send('USER', self.config['user']['user'], '0', '*', self.config['user']['gecos'])
 		return
 
@@ -116,72 +229,174 @@ class IRCClientProtocol(asyncio.Protocol):
 			self.log.info('Lost connection: ' + self.errormsg)
 		else:
 			self.log.info('Lost connection')
-		if self.config['name'] in clients:
+		_modules.unregister_client(self.module.name, self.config['name'], 'irc', self)
+		if self.pool is not None:
+			self.pool.detach(self, self.sendq.drain())
+		self.sendq.close()
+		self.sync.clear()
+		self.lookups.clear()
+		if self.splitquits:
+			self._flushsplit()
+		self.timers.clear()
+		if clients.get(self.config['name'], None) is self:
 			del clients[self.config['name']]
+		elif self.pool is not None and self.pool.isshutdown and not self.pool.connected():
+			if clients.get(self.config['name'], None) is self.pool:
+				del clients[self.config['name']]
 
 		if self.capendhandle is not None:
 			self.capendhandle.cancel()
 
-		if self.isshutdown:
+		if self.isshutdown or self.config.get('removed', False):
 			return
 
-		self.log.info('Reconnecting in 30 seconds')
-		self.loop.call_later(30, createclient, self.loop, self.config, self.module)
+		delay = self.backoff.delay(self.loop)
+		self.log.info('Reconnecting in ' + str(round(delay, 1)) + ' seconds')
+		if self.pool is None:
+			states[self.config['name']] = self.state
+			self.loop.call_later(delay, createclient, self.loop, self.config, self.module)
+		else:
+			self.loop.call_later(delay, connectmember, self.pool, self.index)
 		return
 
+	def pause_writing(self):
+		self.log.debug('Pausing send queue, transport buffer is full')
+		self.sendq.pause()
+
+	def resume_writing(self):
+		self.log.debug('Resuming send queue')
+		self.sendq.resume()
+
 	def eof_received(self):
 		self.log.debug('EOF received')
 		return
 
 	def data_received(self, data):
-		lines = data.decode('utf-8').replace('\r', '\n').split('\n')
-
-		self._resetping()
-
-		for line in lines:
-			if len(line) > 0:
-				self.log.protocol('Received line: ' + line)
-				msg = self._parse_raw_irc(line)
-				self.log.protocol('Parsed message: ' + str(msg))
-
-				if msg['msg'] in self.handlers:
-					self.handlers[msg['msg']](msg)
-
-				#_modules.send_event(self.loop, self.module, self.config['name'], 'irc', 'IRC_RAW', msg)
+		buf = self.buf
+		buf += data
+
+		self._received()
+
+		start = 0
+		with memoryview(buf) as view:
+			while True:
+				end = buf.find(b'\n', start)
+				if end < 0:
+					break
+
+				linestart = start
+				lineend = end
+				start = end + 1
+				if lineend > linestart and buf[lineend - 1] == 13:
+					lineend -= 1
+
+				if lineend > linestart:
+					line = self._decode(view[linestart:lineend])
+					self.log.protocol('Received line: %s', line)
+					msg = _message.parse(line)
+					self.log.protocol('Parsed message: %s', msg)
+
+					# Quits held back for a netsplit must not be reordered
+					# with anything else
+					if self.splitquits and msg.command != 'QUIT':
+						self._flushsplit()
+
+					if self.batches and msg.rawtags and self._addtobatch(msg):
+						continue
+
+					handler = self.handlers.get(msg.command, None)
+					if handler is not None:
+						handler(msg)
+
+					#_modules.send_event(self.loop, self.module, self.config['name'], 'irc', 'IRC_RAW', msg)
+
+		# Only the incomplete tail is kept, deleting from the front of a
+		# bytearray does not copy it
+		if start > 0:
+			del buf[:start]
+
+		if len(buf) > self.maxbuf:
+			self.log.warning('Discarding ' + str(len(buf)) + ' bytes received without a line ending')
+			del buf[:]
 		return
 
+	def _decode(self, line):
+		try:
+			return str(line, 'utf-8')
+		except UnicodeDecodeError:
+			return str(line, self.charset, 'replace')
+
 	def disconnect(self, reason):
+		# Relayed lines are left to the rest of a pool, anything else still
+		# waiting is dropped so the QUIT goes out straight away
+		if self.pool is not None:
+			self.pool.detach(self, self.sendq.drain())
+		dropped = self.sendq.clear()
+		if dropped > 0:
+			self.log.debug('Discarding ' + str(dropped) + ' queued line(s)')
 		self._send('QUIT', reason)
+		self.sendq.flush(True)
 		if self.transport:
 			self.transport.close()
-		for chan in self.chans:
-			try:
-				if self.chans[chan]['jointimer']:
-					self.chans[chan]['jointimer'].cancel()
-			except:
-				pass
-		for timer in self.timers:
-			try:
-				timer.cancel()
-			except:
-				pass
-		if self.rejointimer:
-			try:
-				self.rejointimer.cancel()
-			except:
-				pass
-			self.rejointimer = None
-		if self.pingtimer:
-			try:
-				self.pingtimer.cancel()
-			except:
-				pass
-			self.pingtimer = None
+		self.timers.clear()
 
 	def shutdown(self, loop):
 		self.isshutdown = True
 		self.disconnect('Shutting down')
 
+	def addchan(self, chan, attrs):
+		self.chans[chan] = attrs
+		attrs['joined'] = False
+
+		# Until the server has sent 005 the channel is joined with the rest
+		if self.hasperformed:
+			self._joinchan(chan)
+
+	def delchan(self, chan):
+		attrs = self.chans.pop(chan)
+		self.state.clearchan(chan)
+		self.sync.parted(chan)
+
+		self.timers.cancel(('join', chan))
+
+		if attrs['joined']:
+			self.log.info('Parting channel ' + attrs['name'])
+			self._send('PART', attrs['name'], 'Channel removed from configuration')
+
+	def setflood(self, conf):
+		self.sendq.setconfig(conf)
+
+	def setsync(self, conf):
+		self.sync.setconfig(conf)
+
+	def setkeepalive(self, conf):
+		self.lag.setconfig(conf)
+		self.sendq.hold(self.lag.lagging(self.loop.time()))
+
+	# Takes over tracking the channels for the rest of a pool
+	def lead(self):
+		self.handlers = self.leadhandlers
+		_modules.register_client(self.module.name, self.config['name'], 'irc', self)
+
+		# Whatever the last leader knew may be out of date by now
+		for chan in self.chans:
+			attrs = self.chans[chan]
+			if attrs['joined']:
+				self.state.beginsync(chan)
+				self.sync.joined(chan, attrs['name'])
+				self._send('NAMES', attrs['name'])
+
+	def injoined(self, chan):
+		attrs = self.chans.get(chan, None)
+		return attrs is not None and attrs['joined']
+
+	def setnick(self, nick):
+		self.user['newnick'] = nick
+		if self.hasperformed:
+			self._send('NICK', nick)
+		else:
+			self.user['nick'] = nick
+
 	def handle_event(self, loop, module, sender, protocol, event, data):
 		if event != 'IRC_SENDCMD':
 			return
@@ -190,11 +405,15 @@ class IRCClientProtocol(asyncio.Protocol):
 			self.log.warning('Event ' + event + ' missing command to execute')
 			return
 
-		self._send(data['command'])
+		prio = data.get('priority', _sendqueue.PRIO_BULK)
+		if self.pool is not None:
+			self.pool.send(data['command'], prio)
+		else:
+			self._send(data['command'], prio=prio)
 
 	#RPL_ISUPPORT
 	def m_005(self, msg):
-		for isup in msg['params'][1:-1]:
+		for isup in msg.params[1:-1]:
 			m = self.n005kv.match(isup)
 			if not m:
 				self.log.warning('Numeric 005 option failed parsing: ' + isup)
@@ -207,8 +426,6 @@ class IRCClientProtocol(asyncio.Protocol):
 				if value:
 					self.chantypes = value
 			elif key == 'PREFIX':
-				self.log.debug(str(key))
-				self.log.debug(str(value))
 				if value:
 					pfxparts = value.split(')')
 					self.chanusrpfx = pfxparts[1]
@@ -218,10 +435,17 @@ class IRCClientProtocol(asyncio.Protocol):
 					self.chanmodes = value.split(',')
 			elif key == 'WHOX':
 				self.haswhox = True
+			elif key == 'CASEMAPPING':
+				if value:
+					self._setcasemapping(value)
 
 		if self.hasperformed:
 			return
 
+		# Session tickets have arrived by now
+		if self.config['server']['tls']:
+			_tls.keepsession(self.config['name'], self.transport)
+
 		for chan in self.chans:
 			self.chans[chan]['joined'] = False
 
@@ -229,88 +453,116 @@ class IRCClientProtocol(asyncio.Protocol):
 
 		self.hasperformed = True
 
+	#RPL_ENDOFWHO
+	def m_315(self, msg):
+		key = self.state.fold(msg.params[1])
+		self.sync.endofwho(key)
+
+		for target, who in self.lookups.pop(key, ()):
+			self._replyaccount(target, who, self.state.getuser(key))
+
+	# A WHO that was never answered, ?account requests waiting on it still get
+	# a reply
+	def _whoexpired(self, key):
+		for target, who in self.lookups.pop(key, ()):
+			self._replyaccount(target, who, None)
+
 	#RPL_NAMREPLY
 	def m_353(self, msg):
-		chan = msg['params'][-2].lower()
-		usrlist = msg['params'][-1]
+		chan = self.state.fold(msg.params[-2])
 
 		if chan in self.chans:
-			users = usrlist.split(' ')
-
-			for user in users:
-				pfx = ''
-				pfxm = ''
-
-				for c in range(0, len(user)):
-					if not user[c] in self.chanusrpfx:
-						pfx = user[:c]
-						user = user[c:]
-						break
+			fold = self.state.fold
+			addmember = self.state.addmember
+			pfxchars = self.chanusrpfx
 
-				nuh = self._parse_nuh(user)
+			for user in msg.params[-1].split(' '):
+				nuh = user.lstrip(pfxchars)
+				# userhost-in-names gives us nick!user@host
+				nick = nuh.partition('!')[0]
+				if not nick:
+					continue
 
-				for p in pfx:
-					pfxm = pfxm + self.chanusrpfxmodes[self.chanusrpfx.index(p)]
+				pfxm = ''
+				for p in user[:len(user) - len(nuh)]:
+					pfxm = pfxm + self.chanusrpfxmodes[pfxchars.index(p)]
 
-				if nuh['name'].lower() in self.chans[chan]['users']:
-					self.chans[chan]['users'][nuh['name'].lower()]['status'] = pfxm
-				else:
-					self.chans[chan]['users'][nuh['name'].lower()] = {'nick': nuh['name'], 'status': pfxm, 'account': ''}
+				addmember(chan, fold(nick), nick, pfxm)
 
 	#RPL_WHOSPCRPL:
 	def m_354(self, msg):
-		tag = msg['params'][1]
+		tag = msg.params[1]
 
 		if tag != '696':
 			return
 
-		who = msg['params'][2].lower()
-		account = msg['params'][3]
+		account = msg.params[3]
 
 		if account == '0':
 			account = ''
 
-		for chan in self.chans:
-			if who in self.chans[chan]['users']:
-				self.chans[chan]['users'][who]['account'] = account
+		self.state.setaccount(self.state.fold(msg.params[2]), account)
 
 	#RPL_ENDOFNAMES
 	def m_366(self, msg):
-		if self.haswhox:
-			chan = msg['params'][-2]
-			if chan.lower() in self.chans:
-				self._send('WHO', chan, '%tna,696')
+		chan = self.state.fold(msg.params[-2])
+		if chan in self.chans:
+			gone = self.state.endsync(chan)
+			if gone > 0:
+				self.log.debug('Removed %d user(s) no longer in %s', gone, self.chans[chan]['name'])
+
+			members = self.state.members(chan)
+			# extended-join and account-notify keep accounts up to date from
+			# here on, anyone we still need is looked up when asked about.
+			# After a reconnect only users we have not seen before need WHO.
+			needwho = self.haswhox and not (self.caps['extended-join'] and self.caps['account-notify'])
+			if needwho:
+				needwho = any(user.account is None for user in members)
+			self.sync.endofnames(chan, len(members), needwho)
 
 	#ERR_NICKNAMEINUSE
 	def m_433(self, msg):
-		targ = msg['params'][0]
-		newnick = msg['params'][1]
-		if targ == '*' or targ.lower() == self.user['nick'].lower() or newnick.lower() == self.user['newnick'].lower():
+		fold = self.state.fold
+		targ = msg.params[0]
+		newnick = msg.params[1]
+		if targ == '*' or fold(targ) == fold(self.user['nick']) or fold(newnick) == fold(self.user['newnick']):
 			if not 'inc' in self.user:
 				self.user['inc'] = 0
 			else:
 				self.user['inc'] += 1
-			self.user['newnick'] = self.config['user']['nick'] + ('%04d' % self.user['inc'])
+			self.user['newnick'] = self.user['nick'] + ('%04d' % self.user['inc'])
 			self._send('NICK', self.user['newnick'])
 
 	def m_account(self, msg):
-		who = msg['source']['name'].lower()
-		account = msg['params'][0]
+		account = msg.params[0]
 
 		if account == '*':
 			account = ''
 
-		for chan in self.chans:
-			if who in self.chans[chan]['users']:
-				self.chans[chan]['users'][who]['account'] = account
+		self.state.setaccount(self.state.fold(msg.source.name), account)
+
+	def m_batch(self, msg):
+		ref = msg.params[0]
+
+		if ref[:1] == '+':
+			if len(msg.params) > 1 and msg.params[1] in bulkbatches:
+				self.batches[ref[1:]] = [msg.params[1], msg.params[2:], []]
+		elif ref[:1] == '-':
+			batch = self.batches.pop(ref[1:], None)
+			if batch is None:
+				return
+			if batch[0] == 'netsplit':
+				self._netsplit(batch[1], batch[2])
+			else:
+				self._netjoin(batch[1], batch[2])
 
 	def m_cap(self, msg):
-		verb = msg['params'][1]
+		verb = msg.params[1]
 		if verb == 'LS' or verb == 'NEW':
 			if self.capendhandle is not None:
 				self.capendhandle.cancel()
 
-			caps = msg['params'][-1].split(' ')
+			caps = msg.params[-1].split(' ')
 			req = []
 			for cap in caps:
 				if cap in self.caps:
@@ -321,26 +573,27 @@ class IRCClientProtocol(asyncio.Protocol):
 			if verb == 'LS':
 				self.capendhandle = self.loop.call_later(2, self._capend)
 		elif verb == 'DEL':
-			caps = msg['params'][-1].split(' ')
+			caps = msg.params[-1].split(' ')
 			for cap in caps:
 				if cap in self.caps:
 					self.caps[cap] = False
 		elif verb == 'ACK':
-			caps = msg['params'][-1].split(' ')
+			caps = msg.params[-1].split(' ')
 			for cap in caps:
 				if cap in self.caps:
 					self.caps[cap] = True
 
 	def m_error(self, msg):
-		self.errormsg = msg['params'][-1]
+		self.errormsg = msg.params[-1]
 		self.log.error('Received error: ' + self.errormsg)
 
 	def m_mode(self, msg):
-		target = msg['params'][0]
-		modes = msg['params'][1]
+		target = msg.params[0]
+		modes = msg.params[1]
 		nextparam = 2
 
-		if target.lower() in self.chans:
+		chan = self.state.fold(target)
+		if chan in self.chans:
 			add = True
 			for m in modes:
 				if m == '+':
@@ -349,13 +602,14 @@ class IRCClientProtocol(asyncio.Protocol):
 					add = False
 
 				if m in self.chanusrpfxmodes:
-					who = msg['params'][nextparam]
-					if who.lower() in self.chans[target.lower()]['users']:
+					user = self.state.getmember(chan, self.state.fold(msg.params[nextparam]))
+					if user is not None:
+						status = self.state.getstatus(chan, user)
 						if add:
-							if not m in self.chans[target.lower()]['users'][who.lower()]['status']:
-								self.chans[target.lower()]['users'][who.lower()]['status'] = self.chans[target.lower()]['users'][who.lower()]['status'] + m
+							if not m in status:
+								self.state.setstatus(chan, user, status + m)
 						else:
-							self.chans[target.lower()]['users'][who.lower()]['status'] = self.chans[target.lower()]['users'][who.lower()]['status'].replace(m, '')
+							self.state.setstatus(chan, user, status.replace(m, ''))
 					nextparam = nextparam + 1
 				elif m in self.chanmodes[0]:
 					nextparam = nextparam + 1
@@ -365,144 +619,184 @@ class IRCClientProtocol(asyncio.Protocol):
 					nextparam = nextparam + 1
 
 	def m_join(self, msg):
-		chan = msg['params'][0].lower()
-		account = ''
-		who = msg['source']['name'].lower()
-
-		if len(msg['params']) > 1:
-			if msg['params'][1] != '*':
-				account = msg['params'][1]
-
-		if who == self.user['nick'].lower():
-			if chan in self.chans:
-				log.info('Joined channel ' + self.chans[chan]['name'])
-				self.chans[chan]['joined'] = True
-				self.chans[chan]['users'] = {}
-				try:
-					self.chans[chan]['jointimer'].cancel()
-				except:
-					pass
-				self.chans[chan]['jointimer'] = None
+		fold = self.state.fold
+		chan = fold(msg.params[0])
+		account = None
+		who = fold(msg.source.name)
+
+		# extended-join
+		if len(msg.params) > 1:
+			account = msg.params[1]
+			if account == '*':
+				account = ''
+
+		if who == fold(self.user['nick']):
+			if self._selfjoin(chan, msg.source):
+				# Anyone still here from before is kept if NAMES lists them
+				self.state.beginsync(chan)
+				self.sync.joined(chan, self.chans[chan]['name'])
 
 		if chan in self.chans:
-			self.chans[chan]['users'][who] = {'nick': msg['source']['name'], 'status': '', 'account': account}
-			log.debug('Added user ' + who + ' to channel ' + chan + ': ' + str(self.chans[chan]['users'][who]))
+			user = self.state.addmember(chan, who, msg.source.name, '', account)
+			log.debug('Added user %s to channel %s: %s', who, chan, user)
 
-	def m_kick(self, msg):
-		chan = msg['params'][0].lower()
-		victim = msg['params'][1].lower()
+	def f_join(self, msg):
+		fold = self.state.fold
+		if fold(msg.source.name) == fold(self.user['nick']):
+			self._selfjoin(fold(msg.params[0]), msg.source)
 
-		if victim == self.user['nick'].lower():
-			if chan in self.chans:
-				log.info('Kicked from channel ' + self.chans[chan]['name'])
-				self.chans[chan]['joined'] = False
+	#RPL_VISIBLEHOST
+	def m_396(self, msg):
+		if self.userhost is not None and len(msg.params) > 1:
+			self.userhost = self.userhost.partition('@')[0] + '@' + msg.params[1]
+
+	def m_chghost(self, msg):
+		fold = self.state.fold
+		if fold(msg.source.name) == fold(self.user['nick']) and len(msg.params) > 1:
+			self.userhost = msg.params[0] + '@' + msg.params[1]
 
-			self.chans[chan]['jointimer'] = self.loop.call_later(self.rejoindelay, self._joinchan, chan)
+	def m_kick(self, msg):
+		fold = self.state.fold
+		chan = fold(msg.params[0])
+		victim = fold(msg.params[1])
+
+		if victim == fold(self.user['nick']):
+			if self._selfkick(chan):
+				self.state.clearchan(chan)
+				self.sync.parted(chan)
 		else:
-			if chan in self.chans:
-				del self.chans[chan]['users'][victim]
+			self.state.removemember(chan, victim)
+
+	def f_kick(self, msg):
+		fold = self.state.fold
+		if fold(msg.params[1]) == fold(self.user['nick']):
+			self._selfkick(fold(msg.params[0]))
 
 	def m_nick(self, msg):
-		who = msg['source']['name'].lower()
-		newnick = msg['params'][0]
+		fold = self.state.fold
+		who = fold(msg.source.name)
+		newnick = msg.params[0]
 
-		if who == self.user['nick'].lower():
-			self.user['nick'] = newnick
-			self.user['newnick'] = newnick
-			log.info('Changed nick to ' + newnick)
+		if who == fold(self.user['nick']):
+			self._selfnick(msg.source, newnick)
 
-		for chan in self.chans:
-			if who in self.chans[chan]['users']:
-				self.chans[chan]['users'][newnick.lower()] = self.chans[chan]['users'][who]
-				self.chans[chan]['users'][newnick.lower()]['nick'] = newnick
-				del self.chans[chan]['users'][who]
+		self.state.rename(who, fold(newnick), newnick)
 
-	def m_part(self, msg):
-		chan = msg['params'][0].lower()
-		who = msg['source']['name'].lower()
+	def f_nick(self, msg):
+		fold = self.state.fold
+		if fold(msg.source.name) == fold(self.user['nick']):
+			self._selfnick(msg.source, msg.params[0])
 
-		if who == self.user['nick'].lower():
-			if chan in self.chans:
-				log.info('Parted channel ' + self.chans[chan]['name'])
-				self.chans[chan]['joined'] = False
-				if 'key' in self.chans[chan]:
-					self._send('JOIN', self.chans[chan]['name'], self.chans[chan]['key'])
-				else:
-					self._send('JOIN', self.chans[chan]['name'])
+	def m_part(self, msg):
+		fold = self.state.fold
+		chan = fold(msg.params[0])
+		who = fold(msg.source.name)
+
+		if who == fold(self.user['nick']):
+			if self._selfpart(chan):
+				self.state.clearchan(chan)
+				self.sync.parted(chan)
 		else:
-			if chan in self.chans:
-				del self.chans[chan]['users'][who]
+			self.state.removemember(chan, who)
+
+	def f_part(self, msg):
+		fold = self.state.fold
+		if fold(msg.source.name) == fold(self.user['nick']):
+			self._selfpart(fold(msg.params[0]))
 
 	def m_quit(self, msg):
-		who = msg['source']['name'].lower()
+		fold = self.state.fold
+		who = fold(msg.source.name)
 
-		if who == self.user['nick'].lower():
+		if who == fold(self.user['nick']):
 			self.log.debug('I Quit! *Storms off in a huff*')
 			return
+		elif msg.params and splitre.match(msg.params[-1]):
+			self.splitquits.append(who)
+			if not self.timers.pending('split'):
+				self.timers.set('split', splitwindow, self._flushsplit)
 		else:
-			for chan in self.chans:
-				if who in self.chans[chan]['users']:
-					del self.chans[chan]['users'][who]
+			self.state.quit(who)
 
 	def m_kill(self, msg):
-		victim = msg['params'][0]
+		fold = self.state.fold
+		victim = fold(msg.params[0])
 
-		if victim == self.user['nick'].lower():
+		if victim == fold(self.user['nick']):
 			self.log.debug('Death comes for me!')
 			return
 		else:
-			for chan in self.chans:
-				if victim in self.chans[chan]['users']:
-					del self.chans[chan]['users'][victim.lower()]
+			self.state.quit(victim)
 
 	def m_ping(self, msg):
-		self._send('PONG', msg['params'][0])
+		self._send('PONG', msg.params[0])
+
+	def m_pong(self, msg):
+		if not msg.params:
+			return
+		now = self.loop.time()
+		rtt = self.lag.pong(msg.params[-1], now)
+		if rtt is None:
+			return
+		self.log.debug('Lag is %.3f seconds', rtt)
+		if self.sendq.held and not self.lag.lagging(now):
+			self.log.info('Lag down to %.3f seconds, resuming relayed messages', rtt)
+			self.sendq.hold(False)
 
 	def m_privmsg(self, msg):
-		text = msg['params'][-1]
-		target = msg['params'][0]
+		text = msg.params[-1]
+		target = msg.params[0]
 		if len(text) > 0:
-			if target.lower() in self.chans:
+			fold = self.state.fold
+			chan = fold(target)
+			if chan in self.chans:
 				statusmodes = ''
-				if msg['source']['name'].lower() in self.chans[target.lower()]['users']:
-					statusmodes = self.chans[target.lower()]['users'][msg['source']['name'].lower()]['status']
+				user = self.state.getmember(chan, fold(msg.source.name))
+				if user is not None:
+					statusmodes = self.state.getstatus(chan, user)
 
-				src = msg['source'].copy()
-				src['modes'] = statusmodes
+				src = _events.IrcSource(msg.source.full, msg.source.name, msg.source.ident, msg.source.host, statusmodes)
 
 				textparts = text.split(' ')
 
 				if textparts[0] == '?ops':
-					if self._isop(msg['source']['name'], target):
+					if 'o' in statusmodes:
 						ops = []
-						for user in self.chans[target.lower()]['users']:
-							if self._isop(user, target):
-								ops.append(self.chans[target.lower()]['users'][user]['nick'])
+						members = self.state.members(chan)
+						for user in members:
+							if 'o' in members[user]:
+								ops.append(user.nick)
+						ops.sort(key=str.lower)
 
 						self._send('PRIVMSG', target, 'Ops: ' + ', '.join(ops))
 				elif textparts[0] == '?account':
-					if self._isop(msg['source']['name'], target):
+					if 'o' in statusmodes:
 						if len(textparts) > 1:
 							who = textparts[1]
-							if not who.lower() in self.chans[target.lower()]['users']:
+							key = fold(who)
+							user = self.state.getmember(chan, key)
+							if user is None:
 								self._send('PRIVMSG', target, 'There is no user named ' + who)
+							elif user.account is None and self.haswhox:
+								# Not asked for when we joined, the reply waits for the WHO
+								self.lookups.setdefault(key, []).append((target, who))
+								self.sync.lookup(key, user.nick)
 							else:
-								account = self.chans[target.lower()]['users'][who.lower()]['account']
-								if account == '':
-									self._send('PRIVMSG', target, 'I do not know what account ' + who + ' is logged in as')
-								else:
-									self._send('PRIVMSG', target, who + ' is logged in as ' + account)
+								self._replyaccount(target, who, user)
 
-				if self.chans[target]['joined']:
+				if self.chans[chan]['joined']:
 					event = 'CHANNEL_MESSAGE'
+					evtcls = _events.ChannelMessage
 					if text[:7] == '\x01ACTION':
 						if len(text) > 8:
 							text = text[8:]
 							if text[-1] == '\x01':
 								text = text[:-1]
 							event = 'CHANNEL_ACTION'
-					evt = {'name': msg['source']['name'], 'target': target.lower(), 'message': text, 'source': src}
-					self.log.debug('Event "' + event + '": ' + str(evt))
+							evtcls = _events.ChannelAction
+					# Other modules match channels with str.lower()
+					evt = evtcls(msg.source.name, target.lower(), text, src)
+					self.log.debug('Event "%s": %s', event, evt)
 
 					_modules.send_event(self.loop, self.module, self.config['name'], 'irc', event, evt)
 			else:
@@ -515,123 +809,284 @@ class IRCClientProtocol(asyncio.Protocol):
 					if len(vtext) > 0:
 						words = vtext.split(' ')
 						if words[0].upper() == 'VERSION':
-							self._send('NOTICE', msg['source']['name'], '\x01VERSION RelayBot 2.0 https://github.com/jobe1986/relaybot\x01')
+							self._send('NOTICE', msg.source.name, '\x01VERSION RelayBot 2.0 https://github.com/jobe1986/relaybot\x01')
 
 				if not self._ischannel(target):
 					event = 'USER_MESSAGE'
+					evtcls = _events.UserMessage
 					if text[:7] == '\x01ACTION':
 						if len(text) > 8:
 							text = text[8:]
 							if text[-1] == '\x01':
 								text = text[:-1]
 							event = 'USER_ACTION'
-					evt = {'name': msg['source']['name'], 'target': target, 'message': text, 'source': msg['source']}
-					self.log.debug('Event "' + event + '": ' + str(evt))
+							evtcls = _events.UserAction
+					src = msg.source
+					evt = evtcls(msg.source.name, target, text, src)
+					self.log.debug('Event "%s": %s', event, evt)
 
 					_modules.send_event(self.loop, self.module, self.config['name'], 'irc', event, evt)
 
-	def _resetping(self):
-		self.pingcheck = True
-		if self.pingtimer:
-			try:
-				self.pingtimer.cancel()
-			except:
-				pass
-		self.pingtimer = self.loop.call_later(self.pingfrequency, self._doping)
-
-	def _doping(self):
-		if self.pingcheck:
-			self._send('PING', 'CHECKCONN')
-			self.pingcheck = False
-			self.pingtimer = self.loop.call_later(self.pingfrequency, self._doping)
+	# Our own joins, parts, kicks and nick changes, the part of handling them
+	# every pool member does for itself
+	def _selfjoin(self, chan, source):
+		self._setuserhost(source)
+		if not chan in self.chans:
+			return False
+
+		self.log.info('Joined channel ' + self.chans[chan]['name'])
+		self.chans[chan]['joined'] = True
+		self.timers.cancel(('join', chan))
+
+		if not self.relaying:
+			for attrs in self.chans.values():
+				if not attrs['joined']:
+					break
+			else:
+				self._relayagain()
+		return True
+
+	def _selfkick(self, chan):
+		if not chan in self.chans:
+			return False
+
+		self.log.info('Kicked from channel ' + self.chans[chan]['name'])
+		self.chans[chan]['joined'] = False
+		self.timers.set(('join', chan), self.rejoindelay, self._joinchan, chan)
+		return True
+
+	def _selfpart(self, chan):
+		if not chan in self.chans:
+			return False
+
+		self.log.info('Parted channel ' + self.chans[chan]['name'])
+		self.chans[chan]['joined'] = False
+		if 'key' in self.chans[chan]:
+			self._send('JOIN', self.chans[chan]['name'], self.chans[chan]['key'])
+		else:
+			self._send('JOIN', self.chans[chan]['name'])
+		return True
+
+	def _selfnick(self, source, newnick):
+		self._setuserhost(source)
+		self.user['nick'] = newnick
+		self.user['newnick'] = newnick
+		self.log.info('Changed nick to ' + newnick)
+
+	def _addtobatch(self, msg):
+		# Batch references never need unescaping, so skip parsing every tag
+		rawtags = msg.rawtags
+		if not 'batch=' in rawtags:
+			return False
+		# Other tags such as +draft/batch= may end in the same text
+		for tag in rawtags.split(';'):
+			key, sep, ref = tag.partition('=')
+			if key == 'batch':
+				break
 		else:
-			self.disconnect('Ping Timeout')
+			return False
+
+		batch = self.batches.get(ref, None)
+		if batch is None:
+			return False
+		batch[2].append(msg)
+		return True
+
+	def _netsplit(self, servers, msgs):
+		fold = self.state.fold
+		nick = fold(self.user['nick'])
+		keys = []
+
+		for msg in msgs:
+			if msg.command != 'QUIT':
+				self._handle(msg)
+				continue
+			who = fold(msg.prefix.partition('!')[0])
+			if who != nick:
+				keys.append(who)
+
+		count = self.state.quitmany(keys)
+		self.log.info('Netsplit ' + ' '.join(servers) + ': ' + str(count) + ' user(s) quit')
+
+	def _netjoin(self, servers, msgs):
+		fold = self.state.fold
+		nick = fold(self.user['nick'])
+		joins = {}
+		count = 0
+
+		for msg in msgs:
+			if msg.command != 'JOIN':
+				self._handle(msg)
+				continue
+			name = msg.prefix.partition('!')[0]
+			chan = fold(msg.params[0])
+			who = fold(name)
+			if who == nick:
+				self.m_join(msg)
+				continue
+			if not chan in self.chans:
+				continue
+
+			# extended-join
+			account = None
+			if len(msg.params) > 1:
+				account = msg.params[1]
+				if account == '*':
+					account = ''
+
+			if chan in joins:
+				joins[chan].append((who, name, account))
+			else:
+				joins[chan] = [(who, name, account)]
+			count += 1
+
+		for chan in joins:
+			self.state.addmembers(chan, joins[chan])
+		self.log.info('Netjoin ' + ' '.join(servers) + ': ' + str(count) + ' user(s) rejoined')
+
+	def _flushsplit(self):
+		self.timers.cancel('split')
+
+		keys = self.splitquits
+		self.splitquits = []
+		count = self.state.quitmany(keys)
+		self.log.debug('Applied %d netsplit quit(s)', count)
+
+	def _handle(self, msg):
+		handler = self.handlers.get(msg.command, None)
+		if handler is not None:
+			handler(msg)
+
+	# Called for every chunk of data, the idle check only looks at lastrecv
+	# when it next runs
+	def _received(self):
+		now = self.loop.time()
+		self.lastrecv = now
+
+		# A busy connection is never silent long enough to be pinged
+		if self.lag.due(now):
+			self._sendping(now)
+		if self.lag.pause > 0 and not self.sendq.held and self.lag.lagging(now):
+			self.log.info('Lag over %.3f seconds, holding relayed messages', self.lag.pause)
+			self.sendq.hold(True)
+
+	def _checkidle(self):
+		now = self.loop.time()
+
+		if self.idleping is not None:
+			if self.lastrecv < self.idleping:
+				timeout = self.lag.timeout()
+				if now - self.idleping >= timeout:
+					self.disconnect('Ping timeout: ' + str(round(timeout, 1)) + ' seconds')
+					return
+				self.timers.set('idle', self.idleping + timeout - now, self._checkidle)
+				return
+			self.idleping = None
+
+		idle = now - self.lastrecv
+		if idle < self.lag.interval:
+			self.timers.set('idle', self.lag.interval - idle, self._checkidle)
+			return
+
+		if self.lag.sent is None:
+			self._sendping(now)
+		self.idleping = now
+		self.timers.set('idle', self.lag.timeout(), self._checkidle)
 
 	def _capend(self):
 		self._send('CAP', 'END')
 		self.capendhandle = None
 
-	def _joinchans(self):
+	def _joinchans(self, retry=False):
 		self.log.debug('Checking channels to JOIN')
-		self.rejointimer = None
 
-		j = 0
-		chans = []
-		chank = {}
-		for chan in self.chans:
-			if self.chans[chan]['joined']:
+		keyed = []
+		unkeyed = []
+		for attrs in self.chans.values():
+			if attrs['joined']:
 				continue
-			chan = self.chans[chan]
-
-			if 'key' in chan:
-				chank[chan['name']] = chan['key']
+			if 'key' in attrs:
+				keyed.append((attrs['name'], attrs['key']))
 			else:
-				chans.append(chan['name'])
+				unkeyed.append((attrs['name'], None))
 
-			j = j + 1
-
-		if j <= 0:
+		# Channels we still cannot get into do not hold up the rest
+		if retry or (not keyed and not unkeyed):
+			self._relayagain()
+		if not keyed and not unkeyed:
 			return
 
-		i = 0
-		chanlst = ''
-		for chan in chans:
-			if len(chanlst) > 0:
-				chanlst += ','
-			chanlst += chan
-			i += 1
-
-			if i >= 5:
-				self.log.debug('Joining channels: ' + chanlst)
-				self._send('JOIN', chanlst)
-				chanlst = ''
-				i = 0
-		if i > 0:
-			self.log.debug('Joining channels: ' + chanlst)
-			self._send('JOIN', chanlst)
-
-		i = 0
+		# As few lines as the channels fit in, those with keys go first so
+		# the keys line up with them
 		chanlst = ''
 		keylst = ''
-		for chan in chank:
-			if len(chanlst) > 0:
-				chanlst += ','
-				keylst += ' '
-			chanlst += chan
-			keylst += chank[chan]
-			i += 1
-
-			if i >= 5:
-				self.log.debug('Joining channels: ' + chanlst)
-				self._send('JOIN', chanlst, keylst)
+		for name, key in keyed + unkeyed:
+			if chanlst and len(chanlst) + len(keylst) + len(name) + len(key or '') + 10 > maxline:
+				self._sendjoin(chanlst, keylst)
 				chanlst = ''
 				keylst = ''
-				i = 0
-		if i > 0:
-			self.log.debug('Joining channels: ' + chanlst)
+			if chanlst:
+				chanlst += ','
+			chanlst += name
+			if key is not None:
+				if keylst:
+					keylst += ','
+				keylst += key
+		self._sendjoin(chanlst, keylst)
+
+		self.timers.set('rejoin', self.rejoindelay, self._joinchans, True)
+
+	def _sendjoin(self, chanlst, keylst):
+		self.log.debug('Joining channels: ' + chanlst)
+		if keylst:
 			self._send('JOIN', chanlst, keylst)
+		else:
+			self._send('JOIN', chanlst)
 
-		self.rejointimer = self.loop.call_later(self.rejoindelay, self._joinchans)
+	# Every channel is joined, or as many as are going to be for now
+	def _relayagain(self):
+		if self.relaying:
+			return
+		self.relaying = True
+
+		down = self.backoff.success(self.loop)
+		if down is not None:
+			self.log.info('Relaying again ' + str(round(down, 3)) + ' seconds after losing the connection')
 
 	def _joinchan(self, chan):
 		if self.chans[chan]['joined']:
 			return
 
-		log.debug('Attempting to join channel ' + chan)
+		# chan is only our folded key, the server gets the name as configured
+		name = self.chans[chan]['name']
+		log.debug('Attempting to join channel ' + name)
 
 		if 'key' in self.chans[chan]:
-			self._send('JOIN', chan, self.chans[chan]['key'])
+			self._send('JOIN', name, self.chans[chan]['key'])
 		else:
-			self._send('JOIN', chan)
+			self._send('JOIN', name)
 
-		self.chans[chan]['jointimer'] = self.loop.call_later(self.rejoindelay, self._joinchan, chan)
+		self.timers.set(('join', chan), self.rejoindelay, self._joinchan, chan)
 
-	def _send(self, msg, *params, **kwargs):
+	def _send(self, msg, *params, prio=_sendqueue.PRIO_INTERACTIVE):
 		line = msg
 
 		if len(msg) <= 0:
 			return
 
+		# msg may be a whole line from IRC_SENDCMD
+		cmd, sep, rest = msg.partition(' ')
+		if cmd.upper() in criticalcmds:
+			prio = _sendqueue.PRIO_CRITICAL
+
+		# Bulk lines take turns by target
+		key = ''
+		if prio == _sendqueue.PRIO_BULK:
+			if len(params) > 0:
+				key = params[0].lower()
+			else:
+				key = rest.partition(' ')[0].lower()
+
 		for param in params:
 			if len(param) <= 0:
 				continue
@@ -640,18 +1095,95 @@ class IRCClientProtocol(asyncio.Protocol):
 				line += ':'
 			line += param
 
-		if self.transport:
-			self.transport.write((line + '\r\n').encode('utf-8'))
-		self.log.protocol('Sent line: ' + line)
+		if not self.transport:
+			return
 
-	def _isop(self, nick, chan):
-		if not chan.lower() in self.chans:
-			return False
-		if not nick.lower() in self.chans[chan.lower()]['users']:
-			return False
-		if 'o' in self.chans[chan.lower()]['users'][nick.lower()]['status']:
-			return True
-		return False
+		data = (line + '\r\n').encode('utf-8')
+		if len(data) > self._maxsend() and cmd.upper() in splitcmds:
+			self._sendsplit(line, prio, key)
+			return
+
+		self.sendq.put(data, prio, key)
+		self.log.protocol('Queued line: %s', line)
+
+	def _sendping(self, now):
+		line = 'PING ' + self.lag.ping(now)
+		self.sendq.urgent((line + '\r\n').encode('utf-8'))
+		self.log.protocol('Sent line: %s', line)
+
+	# Bytes we can send in one line without the server cutting it short once
+	# it adds ":nick!user@host " in front
+	def _maxsend(self):
+		userhost = self.userhost
+		if userhost is None:
+			userhost = self.userhostguess
+		return maxline - len(self.user['nick']) - len(userhost.encode('utf-8')) - 3
+
+	def _sendsplit(self, line, prio, key):
+		msg = _message.parse(line)
+		if len(msg.params) != 2:
+			self.sendq.put((line + '\r\n').encode('utf-8'), prio, key)
+			self.log.protocol('Queued line: %s', line)
+			return
+
+		target, text = msg.params
+		head = (msg.command + ' ' + target + ' :').encode('utf-8')
+		tail = b'\r\n'
+		budget = self._maxsend() - len(head) - len(tail)
+
+		# Each part of a CTCP ACTION is sent as an ACTION of its own
+		if text[:8] == '\x01ACTION ' and text[-1:] == '\x01' and len(text) > 9:
+			head += b'\x01ACTION '
+			tail = b'\x01' + tail
+			budget -= 9
+			text = text[8:-1]
+
+		chunks = _message.splittext(text, budget)
+		self.log.protocol('Splitting line into %d: %s', len(chunks), line)
+		for chunk in chunks:
+			self.sendq.put(head + chunk + tail, prio, key)
+
+	def _replyaccount(self, target, who, user):
+		if user is None or not user.account:
+			self._send('PRIVMSG', target, 'I do not know what account ' + who + ' is logged in as')
+		else:
+			self._send('PRIVMSG', target, who + ' is logged in as ' + user.account)
+
+	def _setuserhost(self, source):
+		if source.host:
+			self.userhost = source.ident + '@' + source.host
+
+	def _setcasemapping(self, casemapping):
+		if self.state.setcasemapping(casemapping):
+			self.log.debug('Using casemapping ' + casemapping)
+		# Another pool member may have changed the shared state already
+		self._rekeychans()
+
+	# Channels are keyed by their folded name, which changes if the server
+	# uses a different casemapping from the one we assumed
+	def _rekeychans(self):
+		fold = self.state.fold
+		chanmap = {}
+		for chan in self.chans:
+			key = fold(self.chans[chan]['name'])
+			if key != chan:
+				chanmap[chan] = key
+
+		if not chanmap:
+			return
+
+		chans = list(self.chans.items())
+		self.chans.clear()
+		for chan, attrs in chans:
+			newchan = chanmap.get(chan, chan)
+			self.chans[newchan] = attrs
+			# Pending rejoins hold the old key
+			if newchan != chan and self.timers.pending(('join', chan)):
+				self.timers.cancel(('join', chan))
+				self.timers.set(('join', newchan), self.rejoindelay, self._joinchan, newchan)
+
+		self.state.rekeychans(chanmap)
+		self.sync.rekeychans(chanmap)
 
 	def _ischannel(self, name):
 		if len(name) < 1:
@@ -660,81 +1192,140 @@ class IRCClientProtocol(asyncio.Protocol):
 			return False
 		return True
 
-	def _parse_nuh(self, nuh):
-		ret = {'full': nuh, 'name': '', 'ident': '', 'host': ''}
-
-		val = nuh
-		if val.find('@') >= 0:
-			ret['host'] = val[val.find('@')+1:]
-			val = val[:val.find('@')]
-		if val.find('!') >= 0:
-			ret['ident'] = val[val.find('!')+1:]
-			val = val[:val.find('!')]
-		ret['name'] = val
-
-		return ret
-
-	def _parse_raw_irc(self, line):
-		ret = {'source': {'full': '', 'name': '', 'ident': '', 'host': ''}, 'msg': '', 'params': []}
-		stat = 0
-		words = line.split(' ')
-
-		for word in words:
-			if ((stat < 3) and (len(word) == 0)):
-				continue
-
-			if (stat == 0):
-				stat += 1
-				if (word[0] == ':'):
-					ret['source']['full'] = word[1:]
-				else:
-					ret['msg'] = word
-					stat += 1
-			elif (stat == 1):
-				ret['msg'] = word
-				stat += 1
-			elif (stat == 2):
-				if (word[0] == ':'):
-					ret['params'].append(word[1:])
-					stat += 1
-				else:
-					ret['params'].append(word)
-			else:
-				ret['params'][-1] = ret['params'][-1] + ' ' + word
-
-		if (len(ret['source']['full']) > 0):
-			src = ret['source']['full']
-			if (src.find('@') >= 0):
-				ret['source']['host'] = src[src.find('@')+1:]
-				src = src[:src.find('@')]
-			if (src.find('!') >= 0):
-				ret['source']['ident'] = src[src.find('!')+1:]
-				src = src[:src.find('!')]
-			ret['source']['name'] = src
-
-		return ret
-
-async def connectclient(loop, conf, module):
+async def connectclient(loop, conf, module, pool=None, index=0):
 	try:
 		serv = '[' + conf['server']['host'] + ']:'
 		if conf['server']['tls']:
 			serv = serv + '+'
 		serv = serv + str(conf['server']['port'])
 		log.info('Connecting IRC client ' + conf['name'] + ' to ' + serv)
-		tls = conf['server']['tls']
-		if tls:
-			if conf['server']['tlscert']:
-				try:
-					tls = ssl.create_default_context()
-					tls.load_cert_chain(conf['server']['tlscert'], conf['server']['tlskey'])
-				except Exception as e:
-					log.warning('Exception occurred attempting to load client tls certificate or key for IRC client  ' + conf['name'] + ': ' + str(e))
-					tls = True
-		await loop.create_connection(lambda: IRCClientProtocol(loop, conf, module), conf['server']['host'], conf['server']['port'], ssl=tls)
+		tls = None
+		if conf['server']['tls']:
+			try:
+				tls = _tls.getcontext(conf['name'], conf['server']['tlscert'], conf['server']['tlskey'])
+			except Exception as e:
+				log.warning('Exception occurred attempting to load client tls certificate or key for IRC client  ' + conf['name'] + ': ' + str(e))
+				tls = _tls.getcontext(conf['name'], None, None)
+		start = loop.time()
+		transport, protocol = await _connect.connect(loop, lambda: IRCClientProtocol(loop, conf, module, pool, index), conf['server']['host'], conf['server']['port'], ssl=tls)
+		if tls is not None:
+			elapsed = loop.time() - start
+			if _tls.connected(conf['name'], transport, elapsed):
+				protocol.log.info('Connected in %.3f seconds, resumed TLS session', elapsed)
+			else:
+				protocol.log.info('Connected in %.3f seconds, full TLS handshake', elapsed)
+		if conf.get('removed', False) or (pool is not None and pool.isshutdown):
+			protocol.shutdown(loop)
 	except Exception as e:
 		log.warning('Exception occurred attempting to connect IRC client ' + conf['name'] + ': ' + str(e))
-		log.info('Reconnecting in 30 seconds')
-		loop.call_later(10, createclient, loop, conf, module)
+		if pool is None:
+			delay = _reconnect.backoff(backoffname(conf)).delay(loop)
+			log.info('Reconnecting in ' + str(round(delay, 1)) + ' seconds')
+			loop.call_later(delay, createclient, loop, conf, module)
+		else:
+			delay = _reconnect.backoff(backoffname(conf, index)).delay(loop)
+			log.info('Reconnecting in ' + str(round(delay, 1)) + ' seconds')
+			loop.call_later(delay, connectmember, pool, index)
 
 def createclient(loop, conf, module):
+	global clients
+
+	# Pending reconnects for a config dropped by a reload end here
+	if conf.get('removed', False):
+		return
+
+	if conf['pool'] > 1:
+		pool = _pool.ConnectionPool(loop, conf, module, log.getChildObj(conf['name']), connectmember)
+		clients[conf['name']] = pool
+		pool.start()
+		return
+
 	loop.create_task(connectclient(loop, conf, module))
+
+# Pool members back off on their own
+def backoffname(conf, index=None):
+	if index is None:
+		return 'irc/' + conf['name']
+	return 'irc/' + conf['name'] + '/' + str(index)
+
+def connectmember(pool, index):
+	if pool.isshutdown or pool.config.get('removed', False):
+		return
+	pool.loop.create_task(connectclient(pool.loop, pool.config, pool.module, pool, index))
+
+def removeclient(loop, conf):
+	global clients
+
+	conf['removed'] = True
+
+	# A new config may be for a different server, start afresh
+	states.pop(conf['name'], None)
+	_tls.forget(conf['name'])
+	_reconnect.forget(backoffname(conf))
+	for index in range(conf['pool']):
+		_reconnect.forget(backoffname(conf, index))
+
+	cli = clients.get(conf['name'], None)
+	if cli is not None and cli.config is conf:
+		cli.shutdown(loop)
+
+def updateclient(loop, conf, newconf):
+	global clients
+
+	cli = clients.get(conf['name'], None)
+	if cli is not None and not cli.config is conf:
+		cli = None
+
+	if conf['usercfg']['nick'] != newconf['usercfg']['nick']:
+		log.info('Changing nick for IRC client ' + conf['name'] + ' to ' + newconf['usercfg']['nick'])
+		conf['usercfg'] = newconf['usercfg']
+		if cli is not None:
+			cli.setnick(newconf['usercfg']['nick'])
+		else:
+			conf['user']['nick'] = newconf['usercfg']['nick']
+
+	if conf['flood'] != newconf['flood']:
+		conf['flood'] = newconf['flood']
+		if cli is not None:
+			cli.setflood(newconf['flood'])
+
+	if conf['sync'] != newconf['sync']:
+		conf['sync'] = newconf['sync']
+		if cli is not None:
+			cli.setsync(newconf['sync'])
+
+	if conf['keepalive'] != newconf['keepalive']:
+		conf['keepalive'] = newconf['keepalive']
+		if cli is not None:
+			cli.setkeepalive(newconf['keepalive'])
+
+	chans = conf['channels']
+
+	# A connected client keys channels by the server's casemapping
+	newchans = newconf['channels']
+	if cli is not None:
+		newchans = {cli.state.fold(attrs['name']): attrs for attrs in newchans.values()}
+
+	for chan in list(chans):
+		if chan in newchans:
+			continue
+		log.info('Removing channel ' + chans[chan]['name'] + ' from IRC client ' + conf['name'])
+		if cli is not None:
+			cli.delchan(chan)
+		else:
+			del chans[chan]
+
+	for chan in newchans:
+		attrs = newchans[chan]
+		if chan in chans:
+			# Picked up by the next JOIN attempt
+			if 'key' in attrs:
+				chans[chan]['key'] = attrs['key']
+			elif 'key' in chans[chan]:
+				del chans[chan]['key']
+			continue
+		log.info('Adding channel ' + attrs['name'] + ' to IRC client ' + conf['name'])
+		if cli is not None:
+			cli.addchan(chan, attrs)
+		else:
+			chans[chan] = attrs
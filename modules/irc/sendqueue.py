@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, modules/irc/sendqueue.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Outgoing line queue for an IRC connection
+#
+# Lines are paced with a token bucket so bursts of relayed messages do not
+# get the bot killed for flooding. The bucket holds up to 'burst' tokens and
+# refills at 'rate' tokens a second. Each line costs 'cost' tokens plus one
+# more for every 'bytes' bytes, modelled on the ircu penalty of 2 seconds plus
+# one second per 120 bytes with 10 seconds of slack.
+#
+# Lines queued in the same loop iteration go out in a single write, and
+# nothing is written while the transport has asked us to pause.
+#
+# Every line is put in one of three lanes and a lane is only served once
+# the ones before it are empty, so a relay backlog cannot hold up a PONG or
+# a reply to a command. Bulk lines are grouped by target and the targets
+# take turns, one busy channel does not starve the others. Bulk lines can
+# be held back on their own while the server is lagging.
+
+import core.events as _events
+import collections
+
+flooddefaults = {'burst': 10.0, 'rate': 1.0, 'cost': 2.0, 'bytes': 120}
+
+PRIO_CRITICAL = _events.IRC_PRIORITY_CRITICAL
+PRIO_INTERACTIVE = _events.IRC_PRIORITY_INTERACTIVE
+PRIO_BULK = _events.IRC_PRIORITY_BULK
+
+lanenames = ['critical', 'interactive', 'bulk']
+
+class SendQueue:
+	def __init__(self, loop, conf, log):
+		self.loop = loop
+		self.log = log
+		self.transport = None
+		self.lanes = [collections.deque(), collections.deque()]
+		self.bulk = collections.OrderedDict()
+		self.depth = 0
+		self.paused = False
+		self.held = False
+		self.handle = None
+
+		self.setconfig(conf)
+		self.tokens = self.burst
+		self.last = loop.time()
+
+		self.highwater = 0
+		self.sent = [0, 0, 0]
+		self.sentbytes = 0
+		self.writes = 0
+		self.throttled = 0
+		self.waittotal = [0.0, 0.0, 0.0]
+		self.waitmax = [0.0, 0.0, 0.0]
+
+	def setconfig(self, conf):
+		self.burst = conf['burst']
+		self.rate = conf['rate']
+		self.cost = conf['cost']
+		self.bytes = conf['bytes']
+
+	def connect(self, transport):
+		self.transport = transport
+		self.tokens = self.burst
+		self.last = self.loop.time()
+
+	def close(self):
+		self.clear()
+		self.transport = None
+
+	def put(self, data, prio=PRIO_BULK, key=''):
+		item = (self.loop.time(), data)
+		if prio == PRIO_CRITICAL or prio == PRIO_INTERACTIVE:
+			self.lanes[prio].append(item)
+		elif key in self.bulk:
+			self.bulk[key].append(item)
+		else:
+			self.bulk[key] = collections.deque([item])
+
+		self.depth += 1
+		if self.depth > self.highwater:
+			self.highwater = self.depth
+		if self.handle is None and not self.paused:
+			self.handle = self.loop.call_soon(self.flush)
+
+	# Writes a line straight away, for lag checks that must not count time
+	# spent in the queue. Its tokens are still taken, so what is queued waits
+	# for them.
+	def urgent(self, data):
+		if self.transport is None:
+			return
+		if self.paused:
+			self.put(data, PRIO_CRITICAL)
+			return
+
+		now = self.loop.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - self.linecost(data)
+		self.last = now
+		self.sent[PRIO_CRITICAL] += 1
+		self.sentbytes += len(data)
+		self.writes += 1
+		self.transport.write(data)
+
+	def clear(self):
+		count = self.depth
+		for lane in self.lanes:
+			lane.clear()
+		self.bulk.clear()
+		self.depth = 0
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+		return count
+
+	# Empties the queue, returning the (prio, key, data) of relayed lines so
+	# another connection can send them
+	def drain(self):
+		lines = [(PRIO_INTERACTIVE, '', data) for queued, data in self.lanes[PRIO_INTERACTIVE]]
+		for key in self.bulk:
+			lines.extend((PRIO_BULK, key, data) for queued, data in self.bulk[key])
+		self.clear()
+		return lines
+
+	def pause(self):
+		self.paused = True
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+
+	def resume(self):
+		self.paused = False
+		if self.depth > 0 and self.handle is None:
+			self.handle = self.loop.call_soon(self.flush)
+
+	def hold(self, held):
+		self.held = held
+		if not held and not self.paused and self.depth > 0 and self.handle is None:
+			self.handle = self.loop.call_soon(self.flush)
+
+	def linecost(self, data):
+		if self.bytes > 0:
+			return self.cost + len(data) // self.bytes
+		return self.cost
+
+	def flush(self, force=False):
+		self.handle = None
+
+		if self.transport is None or (self.paused and not force):
+			return
+
+		lanes = self.lanes
+		bulk = self.bulk
+		now = self.loop.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+		out = []
+		need = 0
+		held = False
+		while self.depth > 0:
+			if lanes[PRIO_CRITICAL]:
+				prio = PRIO_CRITICAL
+				lane = lanes[prio]
+			elif lanes[PRIO_INTERACTIVE]:
+				prio = PRIO_INTERACTIVE
+				lane = lanes[prio]
+			elif self.held and not force:
+				held = True
+				break
+			else:
+				prio = PRIO_BULK
+				key = next(iter(bulk))
+				lane = bulk[key]
+
+			queued, data = lane[0]
+			cost = self.linecost(data)
+			# A line costing more than the whole bucket waits for a full one
+			need = min(cost, self.burst)
+			if self.tokens < need and not force:
+				break
+			self.tokens -= cost
+			lane.popleft()
+			self.depth -= 1
+
+			# The target just served goes to the back of the line
+			if prio == PRIO_BULK:
+				if lane:
+					bulk.move_to_end(key)
+				else:
+					del bulk[key]
+
+			wait = now - queued
+			self.sent[prio] += 1
+			self.waittotal[prio] += wait
+			if wait > self.waitmax[prio]:
+				self.waitmax[prio] = wait
+			self.sentbytes += len(data)
+			out.append(data)
+
+		if out:
+			self.writes += 1
+			self.transport.write(b''.join(out))
+
+		if self.depth > 0 and not self.paused and not held:
+			self.throttled += 1
+			self.handle = self.loop.call_later((need - self.tokens) / self.rate, self.flush)
+
+	def getstats(self):
+		depths = [len(self.lanes[PRIO_CRITICAL]), len(self.lanes[PRIO_INTERACTIVE]), self.depth - len(self.lanes[PRIO_CRITICAL]) - len(self.lanes[PRIO_INTERACTIVE])]
+		lanes = {}
+		for prio in range(len(lanenames)):
+			waitavg = 0.0
+			if self.sent[prio] > 0:
+				waitavg = self.waittotal[prio] / self.sent[prio]
+			lanes[lanenames[prio]] = {'depth': depths[prio], 'sent': self.sent[prio], 'waitavg': round(waitavg, 3), 'waitmax': round(self.waitmax[prio], 3)}
+		return {'depth': self.depth, 'highwater': self.highwater, 'targets': len(self.bulk), 'bytes': self.sentbytes, 'writes': self.writes, 'throttled': self.throttled, 'paused': self.paused, 'held': self.held, 'lanes': lanes}
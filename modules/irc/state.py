@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, modules/irc/state.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Users seen in our channels
+#
+# Every user has one record no matter how many channels they share with
+# us, indexed by folded nick. Each channel maps the records in it to their
+# status there and each record lists its channels, so a nick change,
+# account change or quit only touches that one user.
+#
+# Nicks and channel names are folded according to the server's CASEMAPPING
+# with a str.translate table. Callers fold a name once per message and pass
+# the folded key to everything that needs it.
+
+import string, sys
+
+# Characters folded on top of A-Z for each casemapping
+casemappings = {
+	'ascii': ('', ''),
+	'rfc1459': ('[]\\~', '{}|^'),
+	'strict-rfc1459': ('[]\\', '{}|')
+	}
+
+# Servers that do not send CASEMAPPING use rfc1459
+defcasemapping = 'rfc1459'
+
+foldcachesize = 8192
+
+def makefold(casemapping):
+	if not casemapping in casemappings:
+		# rfc7613 and friends fold the rest of Unicode as well
+		return str.lower
+
+	upper, lower = casemappings[casemapping]
+	table = str.maketrans(string.ascii_uppercase + upper, string.ascii_lowercase + lower)
+
+	# str.translate is several times slower than str.lower, but the same
+	# few hundred nicks and channels make up nearly every lookup
+	cache = {}
+
+	def fold(name):
+		try:
+			return cache[name]
+		except KeyError:
+			pass
+		if len(cache) >= foldcachesize:
+			cache.clear()
+		key = cache[name] = name.translate(table)
+		return key
+	return fold
+
+class User:
+	__slots__ = ('key', 'nick', 'account', 'chans')
+
+	def __init__(self, key, nick, account=None):
+		self.key = key
+		self.nick = nick
+		# None until the server tells us, '' if not logged in
+		self.account = account
+		# Folded names of the channels the user is in, most users are only
+		# in one or two and a tuple is far smaller than a set
+		self.chans = ()
+
+	def __repr__(self):
+		return 'User' + repr({'nick': self.nick, 'account': self.account, 'chans': self.chans})
+
+class IRCState:
+	def __init__(self):
+		self.users = {}
+		# Folded channel name: {User: status mode letters}
+		self.chans = {}
+		# Folded channel name: members not yet seen in NAMES since we joined
+		self.stale = {}
+		self.casemapping = defcasemapping
+		self.fold = makefold(defcasemapping)
+
+	# Returns True if the folding changed, the caller must then rekey its
+	# own channel names and pass them to rekeychans()
+	def setcasemapping(self, casemapping):
+		if casemapping == self.casemapping:
+			return False
+
+		self.casemapping = casemapping
+		self.fold = makefold(casemapping)
+
+		users = {}
+		for user in self.users.values():
+			user.key = self._key(user.nick)
+			other = users.get(user.key, None)
+			if other is None:
+				users[user.key] = user
+			else:
+				# Two nicks that were different are the same one now
+				self._merge(other, user)
+		self.users = users
+		return True
+
+	# Moves everything known about dup over to user, which keeps its nick
+	def _merge(self, user, dup):
+		if user.account is None:
+			user.account = dup.account
+
+		for chan in dup.chans:
+			members = self.chans[chan]
+			status = members.pop(dup)
+			# Seen in NAMES under either nick means the user is there
+			stale = self.stale.get(chan, None)
+			dupstale = stale is not None and dup in stale
+			if dupstale:
+				stale.discard(dup)
+
+			if chan in user.chans:
+				members[user] = ''.join(sorted(set(members[user] + status)))
+				if stale is not None and not dupstale:
+					stale.discard(user)
+			else:
+				members[user] = status
+				user.chans += (chan,)
+				if dupstale:
+					stale.add(user)
+		dup.chans = ()
+
+	def rekeychans(self, chanmap):
+		self.chans = {chanmap.get(chan, chan): self.chans[chan] for chan in self.chans}
+		self.stale = {chanmap.get(chan, chan): self.stale[chan] for chan in self.stale}
+		for user in self.users.values():
+			user.chans = tuple(chanmap.get(chan, chan) for chan in user.chans)
+
+	def _key(self, nick):
+		key = self.fold(nick)
+		# Most nicks are already folded, no need to keep two copies
+		if key == nick:
+			return nick
+		return key
+
+	def getuser(self, key):
+		return self.users.get(key, None)
+
+	def getmember(self, chan, key):
+		user = self.users.get(key, None)
+		if user is None or not chan in user.chans:
+			return None
+		return user
+
+	def getstatus(self, chan, user):
+		return self.chans[chan][user]
+
+	def members(self, chan):
+		return self.chans.get(chan, {})
+
+	def addmember(self, chan, key, nick, status='', account=None):
+		user = self.users.get(key, None)
+		if user is None:
+			if key == nick:
+				key = nick
+			user = User(key, nick)
+			self.users[key] = user
+		if account is not None:
+			user.account = sys.intern(account)
+
+		if not chan in user.chans:
+			user.chans += (chan,)
+		if chan in self.chans:
+			self.chans[chan][user] = sys.intern(status)
+		else:
+			self.chans[chan] = {user: sys.intern(status)}
+		if self.stale and chan in self.stale:
+			self.stale[chan].discard(user)
+		return user
+
+	# Joins of (key, nick, account) in one go, as after a netsplit
+	def addmembers(self, chan, joins):
+		users = self.users
+		members = self.chans.get(chan, None)
+		if members is None:
+			members = self.chans[chan] = {}
+
+		stale = self.stale.get(chan, None)
+		for key, nick, account in joins:
+			user = users.get(key, None)
+			if user is None:
+				if key == nick:
+					key = nick
+				user = User(key, nick)
+				users[key] = user
+			if account is not None:
+				user.account = sys.intern(account)
+			if not chan in user.chans:
+				user.chans += (chan,)
+			if not user in members:
+				members[user] = ''
+			if stale:
+				stale.discard(user)
+
+	def setstatus(self, chan, user, status):
+		self.chans[chan][user] = sys.intern(status)
+
+	def setaccount(self, key, account):
+		user = self.users.get(key, None)
+		if user is not None:
+			user.account = sys.intern(account)
+		return user
+
+	def removemember(self, chan, key):
+		user = self.users.get(key, None)
+		if user is None or not chan in user.chans:
+			return None
+
+		user.chans = tuple(c for c in user.chans if c != chan)
+		del self.chans[chan][user]
+		if not user.chans:
+			del self.users[key]
+		return user
+
+	# Members from before a rejoin stay until NAMES ends without them
+	def beginsync(self, chan):
+		self.stale[chan] = set(self.chans.get(chan, ()))
+
+	def endsync(self, chan):
+		stale = self.stale.pop(chan, None)
+		if not stale:
+			return 0
+
+		members = self.chans.get(chan, {})
+		count = 0
+		for user in stale:
+			if not user in members:
+				continue
+			del members[user]
+			user.chans = tuple(c for c in user.chans if c != chan)
+			if not user.chans and self.users.get(user.key, None) is user:
+				del self.users[user.key]
+			count += 1
+		return count
+
+	def clearchan(self, chan):
+		self.stale.pop(chan, None)
+		members = self.chans.pop(chan, None)
+		if not members:
+			return
+
+		for user in members:
+			user.chans = tuple(c for c in user.chans if c != chan)
+			if not user.chans and self.users.get(user.key, None) is user:
+				del self.users[user.key]
+
+	def rename(self, key, newkey, newnick):
+		user = self.users.pop(key, None)
+		if user is None:
+			return None
+
+		if newkey == newnick:
+			newkey = newnick
+		user.key = newkey
+		user.nick = newnick
+		self.users[newkey] = user
+		return user
+
+	def quit(self, key):
+		user = self.users.pop(key, None)
+		if user is None:
+			return None
+
+		for chan in user.chans:
+			del self.chans[chan][user]
+		user.chans = ()
+		return user
+
+	def quitmany(self, keys):
+		users = self.users
+		chans = self.chans
+		count = 0
+
+		for key in keys:
+			user = users.pop(key, None)
+			if user is None:
+				continue
+			for chan in user.chans:
+				del chans[chan][user]
+			user.chans = ()
+			count += 1
+		return count
+
+	def getstats(self):
+		return {'users': len(self.users), 'channels': len(self.chans), 'memberships': sum(len(self.chans[chan]) for chan in self.chans), 'casemapping': self.casemapping}
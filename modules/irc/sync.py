@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, modules/irc/sync.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Channel member synchronisation after a join
+#
+# NAMES gives us who is in a channel, a WHOX request then fills in their
+# accounts. Asking for every channel at once has the server send us every
+# user on it in one go, which some servers throttle or penalise, so WHO
+# requests go out one at a time and are paced with a token bucket counted
+# in reply lines: a channel of 300 users costs 300 tokens, the bucket holds
+# up to 'burst' and refills at 'rate' a second. A request that is not
+# answered within 'timeout' seconds is given up on, and 'expired' is called
+# with its key.
+#
+# A channel is synced once its NAMES, and WHO if one was needed, have ended.
+
+import collections
+
+syncdefaults = {'burst': 500.0, 'rate': 50.0, 'timeout': 30.0}
+
+class SyncScheduler:
+	def __init__(self, loop, conf, log, send, expired=None):
+		self.loop = loop
+		self.log = log
+		self.send = send
+		self.expired = expired
+
+		# Folded channel name: [name, time joined, time synced, users]
+		self.chans = {}
+		# Folded mask: (mask, cost), channels and single nicks waiting for WHO
+		self.queue = collections.OrderedDict()
+		self.current = None
+		self.handle = None
+
+		self.setconfig(conf)
+		self.tokens = self.burst
+		self.last = loop.time()
+
+		self.whosent = 0
+		self.whoskipped = 0
+		self.timeouts = 0
+
+	def setconfig(self, conf):
+		self.burst = conf['burst']
+		self.rate = conf['rate']
+		self.timeout = conf['timeout']
+
+	def clear(self):
+		self.chans.clear()
+		self.queue.clear()
+		self.current = None
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+
+	def joined(self, chan, name):
+		self.chans[chan] = [name, self.loop.time(), None, 0]
+		self.queue.pop(chan, None)
+
+	def parted(self, chan):
+		self.chans.pop(chan, None)
+		self.queue.pop(chan, None)
+
+	def endofnames(self, chan, users, needwho):
+		sync = self.chans.get(chan, None)
+		# NAMES we asked for later does not start a new sync
+		if sync is None or sync[2] is not None:
+			return
+
+		sync[3] = users
+		if not needwho:
+			self.whoskipped += 1
+			self._synced(chan)
+			return
+
+		self.queue[chan] = (sync[0], max(users, 1))
+		self._next()
+
+	# WHO for a single nick, for accounts we did not get when joining
+	def lookup(self, key, nick):
+		if key in self.queue or (self.current is not None and self.current[0] == key):
+			return
+		self.queue[key] = (nick, 1)
+		self._next()
+
+	def endofwho(self, key):
+		if self.current is None or self.current[0] != key:
+			return
+
+		self.current = None
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+
+		if key in self.chans:
+			self._synced(key)
+		self._next()
+
+	def rekeychans(self, chanmap):
+		self.chans = {chanmap.get(chan, chan): self.chans[chan] for chan in self.chans}
+		queue = collections.OrderedDict()
+		for key in self.queue:
+			queue[chanmap.get(key, key)] = self.queue[key]
+		self.queue = queue
+		if self.current is not None and self.current[0] in chanmap:
+			self.current = (chanmap[self.current[0]], self.current[1])
+
+	def _synced(self, chan):
+		sync = self.chans[chan]
+		sync[2] = self.loop.time()
+		self.log.info('Synced channel %s (%d users) in %.3f seconds', sync[0], sync[3], sync[2] - sync[1])
+
+	def _next(self):
+		if self.current is not None or self.handle is not None or not self.queue:
+			return
+
+		now = self.loop.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+		key = next(iter(self.queue))
+		mask, cost = self.queue[key]
+		# A channel bigger than the whole bucket waits for a full one
+		need = min(cost, self.burst)
+		if self.tokens < need:
+			self.handle = self.loop.call_later((need - self.tokens) / self.rate, self._wake)
+			return
+
+		del self.queue[key]
+		self.tokens -= cost
+		self.current = (key, now)
+		self.whosent += 1
+		self.send('WHO', mask, '%tna,696')
+		self.handle = self.loop.call_later(self.timeout, self._expire)
+
+	def _wake(self):
+		self.handle = None
+		self._next()
+
+	def _expire(self):
+		self.handle = None
+		if self.current is None:
+			return
+
+		key = self.current[0]
+		self.current = None
+		self.timeouts += 1
+		self.log.warning('No end of WHO for ' + key + ' after ' + str(self.timeout) + ' seconds')
+		if self.expired is not None:
+			self.expired(key)
+		self._next()
+
+	def getstats(self):
+		now = self.loop.time()
+		chans = {}
+		for chan in self.chans:
+			name, joined, synced, users = self.chans[chan]
+			if synced is None:
+				chans[name] = {'synced': False, 'users': users, 'time': round(now - joined, 3)}
+			else:
+				chans[name] = {'synced': True, 'users': users, 'time': round(synced - joined, 3)}
+		return {'queued': len(self.queue), 'whosent': self.whosent, 'whoskipped': self.whoskipped, 'timeouts': self.timeouts, 'channels': chans}
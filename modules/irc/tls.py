@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Relay Service, modules/irc/tls.py
+#
+# Copyright (C) 2023 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# TLS contexts for IRC connections
+#
+# Each IRC client keeps one SSL context for as long as its config stays the
+# same instead of building one, loading the system CA store and its client
+# certificate on every connect. The certificate and key files are loaded
+# again only when their modification times change.
+#
+# The session from the last connection is offered on the next one so the
+# server can resume it with an abbreviated handshake. It is taken once the
+# server has sent RPL_ISUPPORT, by which time TLS 1.3 session tickets have
+# arrived.
+
+import core.logging as _logging
+import os, ssl
+
+log = _logging.log.getChild(__name__)
+
+# Name: TLSCache
+caches = {}
+
+class ResumingContext(ssl.SSLContext):
+	# asyncio does not pass a session through, so the context supplies it
+	session = None
+
+	def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+		if session is None and not server_side:
+			session = self.session
+		return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+class TLSCache:
+	def __init__(self, name, cert, key):
+		self.name = name
+		self.cert = cert
+		self.key = key
+		self.context = None
+		self.mtimes = None
+
+		self.loads = 0
+		self.connects = 0
+		self.resumed = 0
+		self.fulltime = 0.0
+		self.resumedtime = 0.0
+		self.last = None
+
+	def _mtimes(self):
+		ret = []
+		for path in [self.cert, self.key]:
+			if path is None:
+				ret.append(None)
+				continue
+			try:
+				ret.append(os.stat(path).st_mtime_ns)
+			except OSError:
+				ret.append(None)
+		return tuple(ret)
+
+	def getcontext(self):
+		mtimes = self._mtimes()
+		if self.context is not None and mtimes == self.mtimes:
+			return self.context
+
+		context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+		context.load_default_certs()
+		if self.cert is not None:
+			try:
+				context.load_cert_chain(self.cert, self.key)
+			except Exception as e:
+				if self.context is None:
+					raise
+				# Keep the certificate we have until the files are fixed
+				log.warning('Exception occurred reloading client tls certificate or key for IRC client ' + self.name + ': ' + str(e))
+				self.mtimes = mtimes
+				return self.context
+			if self.context is not None:
+				log.info('Reloaded client tls certificate for IRC client ' + self.name)
+
+		# Sessions belong to the context they came from
+		self.context = context
+		self.mtimes = mtimes
+		self.loads += 1
+		return context
+
+	def connected(self, transport, elapsed):
+		sslobj = transport.get_extra_info('ssl_object')
+		if sslobj is None:
+			return None
+
+		self.connects += 1
+		self.last = elapsed
+		if sslobj.session_reused:
+			self.resumed += 1
+			self.resumedtime += elapsed
+			return True
+		self.fulltime += elapsed
+		return False
+
+	def keepsession(self, transport):
+		sslobj = transport.get_extra_info('ssl_object')
+		if sslobj is None or not sslobj.context is self.context:
+			return
+		session = sslobj.session
+		if session is not None:
+			self.context.session = session
+
+	def getstats(self):
+		ret = {'loads': self.loads, 'connects': self.connects, 'resumed': self.resumed, 'last': None, 'full': None, 'resumedavg': None}
+		if self.last is not None:
+			ret['last'] = round(self.last, 3)
+		full = self.connects - self.resumed
+		if full:
+			ret['full'] = round(self.fulltime / full, 3)
+		if self.resumed:
+			ret['resumedavg'] = round(self.resumedtime / self.resumed, 3)
+		return ret
+
+# Raises if the certificate or key cannot be loaded, the cache is then left
+# as it was
+def getcontext(name, cert, key):
+	global caches
+
+	cache = caches.get(name, None)
+	if cache is None or cache.cert != cert or cache.key != key:
+		cache = TLSCache(name, cert, key)
+		context = cache.getcontext()
+		caches[name] = cache
+		return context
+
+	return cache.getcontext()
+
+def connected(name, transport, elapsed):
+	global caches
+
+	cache = caches.get(name, None)
+	if cache is None:
+		return None
+	return cache.connected(transport, elapsed)
+
+def keepsession(name, transport):
+	global caches
+
+	cache = caches.get(name, None)
+	if cache is not None:
+		cache.keepsession(transport)
+
+def forget(name):
+	global caches
+
+	caches.pop(name, None)
+
+def getstats(name):
+	global caches
+
+	cache = caches.get(name, None)
+	if cache is None:
+		return None
+	return cache.getstats()
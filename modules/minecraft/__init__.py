@@ -20,15 +20,32 @@
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
 import core.logging as _logging
+import core.modules as _modules
+import core.shard as _shard
 
 log = _logging.log.getChild(__name__)
 
 configs = {}
+active = set()
+
+parts = ['logreader', 'udp', 'rcon']
+
+subscriptions = [
+	(None, None, 'RCON_SENDCMD'),
+	('minecraft', None, 'PLAYER_CONNECT'),
+	('minecraft', None, 'PLAYERS_OFFLINE')
+	]
 
 def loadconfig(config, module):
 	global configs
+
+	configs = _loadconfigs(config)
+
+def _loadconfigs(config):
 	global log
 
+	configs = {}
+
 	for mccfg in config:
 		if not 'name' in mccfg.attrib:
 			log.warning('Minecraft client config missing name attribute')
@@ -87,30 +104,105 @@ def loadconfig(config, module):
 
 		configs[name] = conf
 		log.debug('Loaded config: ' + str(conf))
-	return
+	return configs
 
 def applyconfig(loop, module):
-	global configs
+	global configs, active
 	global log
 
-	import modules.minecraft.logprotocol as _logprotocol
-	import modules.minecraft.udpprotocol as _udpprotocol
-	import modules.minecraft.rconprotocol as _rconprotocol
-
 	for name in configs:
 		conf = configs[name]
+		if not _shard.owns(module.name, name):
+			log.debug('Minecraft client ' + name + ' is handled by shard ' + str(_shard.owner(module.name, name)))
+			continue
 		log.info('Creating Minecraft client ' + name)
-		if conf['logreader'] is not None:
-			_logprotocol.createclient(loop, conf, module)
-		if conf['udp'] is not None:
-			_udpprotocol.createclient(loop, conf, module)
-		if conf['rcon'] is not None:
-			_rconprotocol.createclient(loop, conf, module)
+		for part in parts:
+			_startpart(loop, conf, module, part)
+		active.add(name)
+	return
+
+def reloadconfig(loop, config, module):
+	global configs, active, parts
+	global log
+
+	newconfigs = _loadconfigs(config)
+
+	for name in list(configs):
+		if not name in newconfigs:
+			if name in active:
+				log.info('Removing Minecraft client ' + name)
+				for part in parts:
+					_stoppart(loop, configs[name], part)
+				active.discard(name)
+			del configs[name]
+
+	for name in newconfigs:
+		conf = newconfigs[name]
+
+		if not _shard.owns(module.name, name):
+			if name in active:
+				log.info('Minecraft client ' + name + ' moved to shard ' + str(_shard.owner(module.name, name)))
+				for part in parts:
+					_stoppart(loop, configs[name], part)
+				active.discard(name)
+			configs[name] = conf
+			continue
+
+		if not name in active:
+			log.info('Creating Minecraft client ' + name)
+			configs[name] = conf
+			for part in parts:
+				_startpart(loop, conf, module, part)
+			active.add(name)
+			continue
+
+		# Only restart the parts whose configuration changed, the rest keep
+		# their connections
+		old = configs[name]
+		for part in parts:
+			if old[part] == conf[part]:
+				continue
+			log.info('Restarting ' + part + ' for Minecraft client ' + name + ' to apply configuration changes')
+			_stoppart(loop, old, part)
+			old[part] = conf[part]
+			_startpart(loop, old, module, part)
 	return
 
+def _getprotocol(part):
+	if part == 'logreader':
+		import modules.minecraft.logprotocol as _logprotocol
+		return _logprotocol
+	elif part == 'udp':
+		import modules.minecraft.udpprotocol as _udpprotocol
+		return _udpprotocol
+	import modules.minecraft.rconprotocol as _rconprotocol
+	return _rconprotocol
+
+def _startpart(loop, conf, module, part):
+	if conf[part] is not None:
+		_getprotocol(part).createclient(loop, conf, module)
+
+def _stoppart(loop, conf, part):
+	if conf[part] is None:
+		return
+
+	prot = _getprotocol(part)
+	cli = prot.clients.get(conf['name'], None)
+
+	# Setting the part to None also stops any retry that is still pending
+	conf[part] = None
+	if cli is not None and cli.config is conf:
+		cli.shutdown(loop)
+
 def shutdown(loop):
+	global configs, parts
 	global log
 
+	# Stop any retries that are still pending
+	for name in configs:
+		for part in parts:
+			configs[name][part] = None
+
 	import modules.minecraft.logprotocol as _logprotocol
 	import modules.minecraft.udpprotocol as _udpprotocol
 	import modules.minecraft.rconprotocol as _rconprotocol
@@ -127,58 +219,20 @@ def shutdown(loop):
 def handle_event(loop, module, sender, protocol, event, data):
 	global log
 
-	import modules.minecraft.logprotocol as _logprotocol
-	import modules.minecraft.udpprotocol as _udpprotocol
-	import modules.minecraft.rconprotocol as _rconprotocol
-
-	for cli in _logprotocol.clients:
-		if module.name == 'minecraft' and protocol == 'udp' and sender == cli:
-			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '" logreader')
-		_logprotocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
-
-	for cli in _udpprotocol.clients:
-		if module.name == 'minecraft' and protocol == 'udp' and sender == cli:
+	for name, prot, cli in _modules.getclients('minecraft'):
+		if module.name == 'minecraft' and protocol == prot and sender == name:
 			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '" udp')
-		_udpprotocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
-
-	for cli in _rconprotocol.clients:
-		if module.name == 'minecraft' and protocol == 'rcon' and sender == cli:
-			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '" rcon')
-		_rconprotocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
+		log.debug('Sending event "%s" to client "%s" %s', event, name, prot)
+		cli.handle_event(loop, module, sender, protocol, event, data)
 
 def handle_event_target(loop, target, module, sender, protocol, event, data):
 	global log
 
-	import modules.minecraft.logprotocol as _logprotocol
-	import modules.minecraft.udpprotocol as _udpprotocol
-	import modules.minecraft.rconprotocol as _rconprotocol
-
 	if 'module' in target and target['module'] != 'minecraft':
 		return
 
-	for cli in _logprotocol.clients:
-		if module.name == 'minecraft' and protocol == 'udp' and sender == cli:
-			continue
-		if 'name' in target and target['name'] != cli:
-			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '" logreader')
-		_logprotocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
-
-	for cli in _udpprotocol.clients:
-		if module.name == 'minecraft' and protocol == 'udp' and sender == cli:
-			continue
-		if 'name' in target and target['name'] != cli:
-			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '" udp')
-		_udpprotocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
-
-	for cli in _rconprotocol.clients:
-		if module.name == 'minecraft' and protocol == 'rcon' and sender == cli:
-			continue
-		if 'name' in target and target['name'] != cli:
+	for name, prot, cli in _modules.getclients('minecraft', target.get('name', None), target.get('protocol', None)):
+		if module.name == 'minecraft' and protocol == prot and sender == name:
 			continue
-		log.debug('Sending event "' + event + '" to client "' + cli + '" rcon')
-		_rconprotocol.clients[cli].handle_event(loop, module, sender, protocol, event, data)
+		log.debug('Sending event "%s" to client "%s" %s', event, name, prot)
+		cli.handle_event(loop, module, sender, protocol, event, data)
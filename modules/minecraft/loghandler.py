@@ -21,6 +21,7 @@
 
 import core.logging as _logging
 import core.modules as _modules
+import core.events as _events
 import asyncio, re
 
 log = _logging.log.getChild(__name__)
@@ -38,6 +39,17 @@ class LogHandler:
 		players[self.config['name']] = {}
 
 		self.ipre = re.compile('^\[?(?P<ip>.+?)(?:%.*)?\]??$')
+		self.msgcls = {
+			'PLAYER_IP': _events.PlayerIP,
+			'PLAYER_CONNECT': _events.PlayerConnect,
+			'PLAYER_DISCONNECT': _events.PlayerDisconnect,
+			'PLAYER_UUID': _events.PlayerUUID,
+			'WHITELIST_FAIL': _events.WhitelistFail,
+			'MESSAGE': _events.Message,
+			'ACTION': _events.Action,
+			'ADVANCEMENT': _events.Advancement,
+			'DEATH': _events.Death
+			}
 		self.msgcb = {
 			'PLAYER_IP': self.e_player_ip,
 			'PLAYER_CONNECT': self.e_player_connect,
@@ -175,38 +187,38 @@ class LogHandler:
 	def handle_msg(self, msg):
 		global players
 
-		if not msg['thread'] in self.msgre:
+		if not msg.thread in self.msgre:
 			return
 
-		thread = msg['thread']
+		thread = msg.thread
 		for event in self.msgre[thread]:
 			for rec in self.msgre[thread][event]:
-				match = rec.match(msg['message'])
+				match = rec.match(msg.message)
 				if match:
-					if event == 'MESSAGE' and msg['level'] == 'WARN':
+					if event == 'MESSAGE' and msg.level == 'WARN':
 						break
-					evt = match.groupdict()
+					evt = self.msgcls[event].frommatch(match)
 					if event == 'PLAYER_CONNECT' or event == 'PLAYER_DISCONNECT':
-						uuid = playeruuidfromname(self.config['name'], evt['name'])
+						uuid = playeruuidfromname(self.config['name'], evt.name)
 						if uuid:
-							evt['ip'] = players[self.config['name']][uuid]['ip']
-							evt['port'] = players[self.config['name']][uuid]['port']
-							evt['uuid'] = uuid
+							evt.ip = players[self.config['name']][uuid]['ip']
+							evt.port = players[self.config['name']][uuid]['port']
+							evt.uuid = uuid
 					elif event == 'PLAYER_IP':
-						ipmatch = self.ipre.match(evt['ip'])
+						ipmatch = self.ipre.match(evt.ip)
 						if ipmatch:
-							evt['ip'] = ipmatch.group('ip')
+							evt.ip = ipmatch.group('ip')
 					elif event == 'WHITELIST_FAIL':
-						uuid = playeruuidfromname(self.config['name'], evt['name'])
+						uuid = playeruuidfromname(self.config['name'], evt.name)
 						if uuid:
-							evt['uuid'] = uuid
+							evt.uuid = uuid
 						else:
-							evt['uuid'] = '00000000-0000-0000-0000-000000000000'
-					self.log.debug('Event "' + event + '": ' + str(evt))
+							evt.uuid = '00000000-0000-0000-0000-000000000000'
+					self.log.debug('Event "%s": %s', event, evt)
 
 					if event in self.msgcb:
 						if self.msgcb[event]:
-							self.log.debug('Calling callback for event "' + event + '"')
+							self.log.debug('Calling callback for event "%s"', event)
 							self.msgcb[event](evt)
 
 					_modules.send_event(self.loop, self.module, self.config['name'], self.prot, event, evt)
@@ -227,44 +239,44 @@ class LogHandler:
 					players[self.config['name']][data['uuid']]['ip'] = data['ip']
 					players[self.config['name']][data['uuid']]['port'] = data['port']
 					players[self.config['name']][data['uuid']]['online'] = True
-					evt = {'name': players[self.config['name']][data['uuid']]['name'], 'uuid': data['uuid'], 'ip': players[self.config['name']][data['uuid']]['ip'], 'port': players[self.config['name']][data['uuid']]['port'], 'message': 'joined the game'}
+					evt = _events.PlayerConnect(players[self.config['name']][data['uuid']]['name'], data['uuid'], players[self.config['name']][data['uuid']]['ip'], players[self.config['name']][data['uuid']]['port'], 'joined the game')
 					self.e_player_connect(evt)
 			elif event == 'PLAYERS_OFFLINE':
 				for uuid in players[self.config['name']]:
 					if players[self.config['name']][uuid]['online']:
-						evt = {'name': players[self.config['name']][uuid]['name'], 'uuid': uuid, 'ip': players[self.config['name']][uuid]['ip'], 'port': players[self.config['name']][uuid]['port'], 'message': 'left the game'}
+						evt = _events.PlayerDisconnect(players[self.config['name']][uuid]['name'], uuid, players[self.config['name']][uuid]['ip'], players[self.config['name']][uuid]['port'], 'left the game')
 						_modules.send_event(self.loop, self.module, self.config['name'], self.prot, 'PLAYER_DISCONNECT', evt)
 						self.e_player_disconnect(evt)
 
 	def e_player_ip(self, evt):
 		global players
 
-		uuid = playeruuidfromname(self.config['name'], evt['name'])
+		uuid = playeruuidfromname(self.config['name'], evt.name)
 		if uuid:
-			players[self.config['name']][uuid]['ip'] = evt['ip']
-			players[self.config['name']][uuid]['port'] = evt['port']
-			log.debug('Updated player "' + uuid + '": ' + str(players[self.config['name']][uuid]))
+			players[self.config['name']][uuid]['ip'] = evt.ip
+			players[self.config['name']][uuid]['port'] = evt.port
+			log.debug('Updated player "%s": %s', uuid, players[self.config['name']][uuid])
 
 	def e_player_uuid(self, evt):
 		global players
 
-		if not evt['uuid'] in players[self.config['name']]:
-			players[self.config['name']][evt['uuid']] = {'name': '', 'ip': '0.0.0.0', 'port': '', 'online': False}
+		if not evt.uuid in players[self.config['name']]:
+			players[self.config['name']][evt.uuid] = {'name': '', 'ip': '0.0.0.0', 'port': '', 'online': False}
 
-		players[self.config['name']][evt['uuid']]['name'] = evt['name']
-		log.debug('Cached player "' + evt['uuid'] + '": ' + str(players[self.config['name']][evt['uuid']]))
+		players[self.config['name']][evt.uuid]['name'] = evt.name
+		log.debug('Cached player "%s": %s', evt.uuid, players[self.config['name']][evt.uuid])
 
 	def e_player_connect(self, evt):
 		global players
 
-		uuid = playeruuidfromname(self.config['name'], evt['name'])
+		uuid = playeruuidfromname(self.config['name'], evt.name)
 		if uuid:
 			players[self.config['name']][uuid]['online'] = True
 
 	def e_player_disconnect(self, evt):
 		global players
 
-		uuid = playeruuidfromname(self.config['name'], evt['name'])
+		uuid = playeruuidfromname(self.config['name'], evt.name)
 		if uuid:
 			players[self.config['name']][uuid]['online'] = False
 
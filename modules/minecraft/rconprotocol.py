@@ -20,18 +20,25 @@
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
 import core.logging as _logging
+import core.connect as _connect
 import core.modules as _modules
+import core.reconnect as _reconnect
+import core.timers as _timers
+import core.events as _events
 import asyncio, binascii, queue, re, struct
 
 log = _logging.log.getChild(__name__)
 
 clients = {}
+# Client name: pending reconnect, created with the first one
+reconnects = None
 
 class MCRConProtocol(asyncio.Protocol):
 	def __init__(self, loop, config, module):
 		global clients
 		self.loop = loop
 		self.config = config
+		self.rconconf = config['rcon']
 		self.module = module
 		self.transport = None
 		self.log = log.getChildObj(self.config['name'])
@@ -50,13 +57,15 @@ class MCRConProtocol(asyncio.Protocol):
 			}
 
 		self.isshutdown = False
+		self.backoff = _reconnect.backoff('minecraft/' + self.config['name'] + '/rcon')
 
 		clients[self.config['name']] = self
 
 	def connection_made(self, transport):
 		self.transport = transport
+		_modules.register_client(self.module.name, self.config['name'], 'rcon', self)
 		self.log.debug('Connected to RCON, sending login')
-		self._sendcmd(self.config['rcon']['password'], type=3, callback=self._rcon_login_callback)
+		self._sendcmd(self.rconconf['password'], type=3, callback=self._rcon_login_callback)
 
 	def connection_lost(self, exc):
 		global clients
@@ -64,20 +73,20 @@ class MCRConProtocol(asyncio.Protocol):
 			self.log.info('Lost connection: ' + str(exc))
 		else:
 			self.log.info('Lost connection')
-		if self.config['name'] in clients:
+		_modules.unregister_client(self.module.name, self.config['name'], 'rcon', self)
+		if clients.get(self.config['name'], None) is self:
 			del clients[self.config['name']]
 
 		if self.isshutdown:
 			return
 
-		self.log.info('Reconnecting in 30 seconds')
-		self.loop.call_later(30, createclient, self.loop, self.config, self.module)
+		reconnect(self.loop, self.config, self.module, self.rconconf)
 
 	def eof_received(self):
 		self.log.debug('EOF received')
 
 	def data_received(self, data):
-		self.log.protocol('Received RCON data: ' + binascii.hexlify(data).decode('utf-8'))
+		self.log.protocol('Received RCON data: %s', _logging.lazy(binascii.hexlify, data))
 		self.buf = self.buf + data
 
 		while True:
@@ -92,24 +101,25 @@ class MCRConProtocol(asyncio.Protocol):
 			dbuf = self.buf[:length + 4]
 			self.buf = self.buf[length + 4:]
 
-			self.log.protocol('Parsing RCON packet: ' + binascii.hexlify(dbuf).decode('utf-8'))
+			self.log.protocol('Parsing RCON packet: %s', _logging.lazy(binascii.hexlify, dbuf))
 
 			pkt = self._rcondecode(dbuf)
-			self.log.protocol('Parsed RCON packet: ' + str(pkt))
+			self.log.protocol('Parsed RCON packet: %s', pkt)
 
-			if pkt['id'] in self.rconcallbacks:
-				self.rconcallbacks[pkt['id']](pkt)
-				del self.rconcallbacks[pkt['id']]
+			if pkt.id in self.rconcallbacks:
+				self.rconcallbacks[pkt.id](pkt)
+				del self.rconcallbacks[pkt.id]
 			# TODO: handle payload fragmentation (4096 max size payload)
 
-			if self.rconwaitid != pkt['id']:
-				seld.log.warning("Received unexpected RCON reply")
+			if self.rconwaitid != pkt.id:
+				self.log.warning("Received unexpected RCON reply")
 			self.rconwaitid = -1
 			self._sendnextcmd()
 
 	def shutdown(self, loop):
 		self.isshutdown = True
-		self.transport.close()
+		if self.transport:
+			self.transport.close()
 
 	def handle_event(self, loop, module, sender, protocol, event, data):
 		if event != 'RCON_SENDCMD':
@@ -128,21 +138,24 @@ class MCRConProtocol(asyncio.Protocol):
 		self._sendcmd(cmd, callback=cb)
 
 	def _rcon_login_callback(self, pkt):
-		if pkt['type'] != 2:
+		if pkt.type != 2:
 			return
 		del self.rconcallbacks[-1]
 		self.log.info('RCON login successful')
+		down = self.backoff.success(self.loop)
+		if down is not None:
+			self.log.info('RCON working again ' + str(round(down, 3)) + ' seconds after losing the connection')
 		self._sendcmd('list uuids', callback=self._rcon_list_uuids)
 
 	def _rcon_login_failure(self, pkt):
-		if pkt['type'] != 2:
+		if pkt.type != 2:
 			return
 		self.log.warning('RCON login failed, password incorrect?')
-		self.log.info('Reconnecting in 30 seconds')
-		self.loop.call_later(30, createclient, self.loop, self.config, self.module)
+		# connection_lost() schedules the next attempt
+		self.transport.close()
 
 	def _rcon_list_uuids(self, pkt):
-		payload = pkt['payload'].decode('utf-8')
+		payload = pkt.payload.decode('utf-8')
 		match = self.listre['main'].match(payload)
 		if match:
 			players = match.group('list')
@@ -150,13 +163,14 @@ class MCRConProtocol(asyncio.Protocol):
 			for player in players.split(', '):
 				matchp = self.listre['player'].match(player)
 				if matchp:
-					puuid = {'name': matchp.group('name'), 'uuid': matchp.group('uuid')}
-					pip = {'name': matchp.group('name'), 'ip': '0.0.0.0', 'port': '0'}
-					pcon = {'name': matchp.group('name'), 'uuid': matchp.group('uuid'), 'ip': '0.0.0.0', 'port': '0', 'message': 'joined the game'}
-
-					self.loop.call_soon(_modules.send_event, self.loop, self.module, self.config['name'], 'rcon', 'PLAYER_UUID', puuid)
-					self.loop.call_soon(_modules.send_event, self.loop, self.module, self.config['name'], 'rcon', 'PLAYER_IP', pip)
-					self.loop.call_soon(_modules.send_event, self.loop, self.module, self.config['name'], 'rcon', 'PLAYER_CONNECT', pcon)
+					name, uuid = matchp.group('name', 'uuid')
+					puuid = _events.PlayerUUID(name, uuid)
+					pip = _events.PlayerIP(name, '0.0.0.0', '0')
+					pcon = _events.PlayerConnect(name, uuid, '0.0.0.0', '0', 'joined the game')
+
+					_modules.send_event(self.loop, self.module, self.config['name'], 'rcon', 'PLAYER_UUID', puuid)
+					_modules.send_event(self.loop, self.module, self.config['name'], 'rcon', 'PLAYER_IP', pip)
+					_modules.send_event(self.loop, self.module, self.config['name'], 'rcon', 'PLAYER_CONNECT', pcon)
 		return
 
 	def _resetid(self):
@@ -166,7 +180,7 @@ class MCRConProtocol(asyncio.Protocol):
 		qcmd = self.id, self._rconpacket(self.id, type, cmd), callback
 		self.id += 1
 
-		self.log.protocol('Queued RCON packet: ' + binascii.hexlify(qcmd[1]).decode('utf-8'))
+		self.log.protocol('Queued RCON packet: %s', _logging.lazy(binascii.hexlify, qcmd[1]))
 		self.rconqueue.put(qcmd)
 
 		self._sendnextcmd()
@@ -184,9 +198,9 @@ class MCRConProtocol(asyncio.Protocol):
 
 		if qcmd[2] is not None:
 			self.rconcallbacks[qcmd[0]] = qcmd[2]
-		self.log.protocol('Sending RCON packet: ' + binascii.hexlify(qcmd[1]).decode('utf-8'))
+		self.log.protocol('Sending RCON packet: %s', _logging.lazy(binascii.hexlify, qcmd[1]))
 		self.transport.write(qcmd[1])
-		self.log.protocol('Parsed RCON packet: ' + str(self._rcondecode(qcmd[1])))
+		self.log.protocol('Parsed RCON packet: %s', _logging.lazy(self._rcondecode, qcmd[1]))
 
 		return
 
@@ -203,25 +217,45 @@ class MCRConProtocol(asyncio.Protocol):
 		return pkt
 
 	def _rcondecode(self, raw):
-		pkt = {'id': -1, 'type': -1, 'payload': 'ERROR'}
+		pkt = _events.RconPacket(-1, -1, 'ERROR')
 
 		try:
 			(length,) = struct.unpack('<i', raw[:4])
 			fmt = '<ii%ds2s' % (length-10)
-			(pkt['id'], pkt['type'], pkt['payload'], pad,) = struct.unpack(fmt, raw[4:])
+			(pkt.id, pkt.type, pkt.payload, pad,) = struct.unpack(fmt, raw[4:])
 		except Exception as e:
 			self.log.warning('Exception unpacking RCON packet: ' + str(e))
 		return pkt
 
 async def connectclient(loop, conf, module):
+	rconconf = conf['rcon']
 	try:
-		log.info('Connecting RCON client ' + conf['name'] + ' to ' + '[' + conf['rcon']['host'] + ']:' + conf['rcon']['port'])
-		await loop.create_connection(lambda: MCRConProtocol(loop, conf, module), conf['rcon']['host'], conf['rcon']['port'])
+		log.info('Connecting RCON client ' + conf['name'] + ' to ' + '[' + rconconf['host'] + ']:' + rconconf['port'])
+		transport, protocol = await _connect.connect(loop, lambda: MCRConProtocol(loop, conf, module), rconconf['host'], rconconf['port'])
+		if conf['rcon'] is not rconconf:
+			protocol.shutdown(loop)
 	except Exception as e:
 		log.warning('Exception occurred attempting to connect RCON client ' + conf['name'] + ': ' + str(e))
-		log.info('Reconnecting in 30 seconds')
-		loop.call_later(10, createclient, loop, conf, module)
+		reconnect(loop, conf, module, rconconf)
 	return
 
-def createclient(loop, conf, module):
+# A failed login is followed by the connection closing, both ask for a
+# reconnect but only one is wanted
+def reconnect(loop, conf, module, rconconf):
+	global reconnects
+
+	if reconnects is None:
+		reconnects = _timers.Timers(loop)
+	if reconnects.pending(conf['name']):
+		return
+
+	delay = _reconnect.backoff('minecraft/' + conf['name'] + '/rcon').delay(loop)
+	log.info('Reconnecting RCON client ' + conf['name'] + ' in ' + str(round(delay, 1)) + ' seconds')
+	reconnects.set(conf['name'], delay, createclient, loop, conf, module, rconconf)
+
+def createclient(loop, conf, module, rconconf=None):
+	# Retries pass the rcon config they were made for, a reload that changed
+	# or removed it since then has already started its own client
+	if rconconf is not None and conf['rcon'] is not rconconf:
+		return
 	loop.create_task(connectclient(loop, conf, module))
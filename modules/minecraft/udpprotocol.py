@@ -21,6 +21,8 @@
 
 import core.logging as _logging
 import core.modules as _modules
+import core.reconnect as _reconnect
+import core.events as _events
 import asyncio, re
 
 from modules.minecraft.loghandler import LogHandler
@@ -34,12 +36,14 @@ class MCUDPProtocol(asyncio.Protocol):
 		global clients
 		self.loop = loop
 		self.config = config
+		self.partconf = config['udp']
 		self.module = module
 		self.handler = handler
 		self.transport = None
 		self.log = log.getChildObj(self.config['name'])
 
 		self.isshutdown = False
+		self.backoff = _reconnect.backoff('minecraft/' + self.config['name'] + '/udp')
 
 		self.logre = re.compile('^\[(?P<time>[^\]]+)\] \[(?P<thread>[^\]]+?)(?: #[0-9]+)?/(?P<level>[A-Z]+)\]: (?P<message>[^\\r\\n]+)$')
 
@@ -47,6 +51,8 @@ class MCUDPProtocol(asyncio.Protocol):
 
 	def connection_made(self, transport):
 		self.transport = transport
+		_modules.register_client(self.module.name, self.config['name'], 'udp', self)
+		self.backoff.success(self.loop)
 
 	def connection_lost(self, exc):
 		global clients
@@ -55,14 +61,16 @@ class MCUDPProtocol(asyncio.Protocol):
 			self.log.info('Lost UDP connection: ' + str(exc))
 		else:
 			self.log.info('Lost UDP connection')
-		if self.config['name'] in clients:
+		_modules.unregister_client(self.module.name, self.config['name'], 'udp', self)
+		if clients.get(self.config['name'], None) is self:
 			del clients[self.config['name']]
 
 		if self.isshutdown:
 			return
 
-		self.log.info('Retrying in 30 seconds')
-		self.loop.call_later(30, createclient, self.loop, self.config, self.module)
+		delay = self.backoff.delay(self.loop)
+		self.log.info('Retrying in ' + str(round(delay, 1)) + ' seconds')
+		self.loop.call_later(delay, createclient, self.loop, self.config, self.module, self.partconf)
 
 	def error_received(self, ex):
 		self.log.debug('Error received: ' + str(ex))
@@ -72,17 +80,18 @@ class MCUDPProtocol(asyncio.Protocol):
 		for line in lines:
 			if len(line) <= 0:
 				continue
-			self.log.protocol('Received UDP message from ' + str(addr) + ': ' + line)
+			self.log.protocol('Received UDP message from %s: %s', addr, line)
 			match = self.logre.match(line)
 			if match:
-				self.log.protocol('Parsed UDP message: ' + str(match.groupdict()))
-				self.handler.handle_msg(match.groupdict())
+				msg = _events.LogLine.frommatch(match)
+				self.log.protocol('Parsed UDP message: %s', msg)
+				self.handler.handle_msg(msg)
 			else:
 				self.log.warning('Unable to parse UDP message')
 
 	def shutdown(self, loop):
 		self.isshutdown = True
-		self.log.info('Shutting down UDP listener on ' + self.config['udp']['host'] + ']:' + self.config['udp']['port'])
+		self.log.info('Shutting down UDP listener on ' + self.partconf['host'] + ']:' + self.partconf['port'])
 		self.transport.close()
 
 	def handle_event(self, loop, module, sender, protocol, event, data):
@@ -90,16 +99,24 @@ class MCUDPProtocol(asyncio.Protocol):
 
 
 async def connectclient(loop, conf, module):
+	partconf = conf['udp']
 	try:
 		serv = '[' + conf['udp']['host'] + ']:' + conf['udp']['port']
 		handler = LogHandler(loop, conf, module, 'udp')
 		log.info('Creating UDP listener ' + conf['name'] + ' listening on ' + serv)
-		await loop.create_datagram_endpoint(lambda: MCUDPProtocol(loop, conf, module, handler), (conf['udp']['host'], conf['udp']['port']), reuse_port=True)
+		transport, protocol = await loop.create_datagram_endpoint(lambda: MCUDPProtocol(loop, conf, module, handler), (conf['udp']['host'], conf['udp']['port']), reuse_port=True)
+		if conf['udp'] is not partconf:
+			protocol.shutdown(loop)
 	except Exception as e:
 		log.warning('Exception occurred attempting to create UDP listener ' + conf['name'] + ': ' + str(e))
-		log.info('Retrying in 30 seconds')
-		loop.call_later(30, createclient, loop, conf, module)
+		delay = _reconnect.backoff('minecraft/' + conf['name'] + '/udp').delay(loop)
+		log.info('Retrying in ' + str(round(delay, 1)) + ' seconds')
+		loop.call_later(delay, createclient, loop, conf, module, partconf)
 	return
 
-def createclient(loop, conf, module):
+def createclient(loop, conf, module, partconf=None):
+	# Retries pass the config they were made for, a reload that changed or
+	# removed it since then has already started its own UDP listener
+	if partconf is not None and conf['udp'] is not partconf:
+		return
 	loop.create_task(connectclient(loop, conf, module))
@@ -21,14 +21,19 @@
 
 import core.logging as _logging
 import core.modules as _modules
-import functools, json, re
+import core.events as _events
+import asyncio, json, re
 
 log = _logging.log.getChild(__name__)
 
 configs = {}
 
+subscriptions = [('irc', 'irc', 'CHANNEL_MESSAGE')]
+
 moduleobj = None
 
+rcontimeout = 10
+
 def loadconfig(config, module):
 	global configs
 	global log
@@ -88,23 +93,23 @@ def applyconfig(loop, module):
 		log.info('Creating Minecraft IRC Whitelist ' + name)
 	return
 
+def reloadconfig(loop, config, module):
+	global configs
+	global log
+
+	configs = {}
+	loadconfig(config, module)
+	log.info('Reloaded ' + str(len(configs)) + ' Minecraft IRC Whitelist config(s)')
+
 def shutdown(loop):
 	return
 
-def handle_event(loop, module, sender, protocol, event, data):
+async def handle_event(loop, module, sender, protocol, event, data):
 	global log
 	global configs
 	global moduleobj
 	
-	events = ['CHANNEL_MESSAGE']
-
-	if module.name != 'irc':
-		return
-
-	if not event in events:
-		return
-
-	log.debug('Received event ' + event + ' from irc: ' + str(data))
+	log.debug('Received event %s from irc: %s', event, data)
 
 	for conf in configs:
 		if configs[conf]['irc'] != sender:
@@ -123,36 +128,37 @@ def handle_event(loop, module, sender, protocol, event, data):
 		target = {'module': module.name, 'name': sender}
 
 		if len(parts) < 2:
-			evt = {'command': 'PRIVMSG ' + data['target'] + ' :Whitelist: Missing sub command (add or remove)', 'callback': None}
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :Whitelist: Missing sub command (add or remove)', priority=_events.IRC_PRIORITY_INTERACTIVE)
 			_modules.send_event_target(loop, target, moduleobj, conf, 'whitelist', 'IRC_SENDCMD', evt)
 			break
 		if not parts[1].lower() in ['add', 'remove']:
-			evt = {'command': 'PRIVMSG ' + data['target'] + ' :Whitelist: Invalid sub command, must be add or remove', 'callback': None}
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :Whitelist: Invalid sub command, must be add or remove', priority=_events.IRC_PRIORITY_INTERACTIVE)
 			_modules.send_event_target(loop, target, moduleobj, conf, 'whitelist', 'IRC_SENDCMD', evt)
 			break
 		if len(parts) < 3:
-			evt = {'command': 'PRIVMSG ' + data['target'] + ' :Whitelist: Missing sub command parameter', 'callback': None}
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :Whitelist: Missing sub command parameter', priority=_events.IRC_PRIORITY_INTERACTIVE)
 			_modules.send_event_target(loop, target, moduleobj, conf, 'whitelist', 'IRC_SENDCMD', evt)
 			break
 
-		cbsourcemod = _modules.getmodule('minecraft')
-		if not cbsourcemod:
+		mcmod = _modules.getmodule('minecraft')
+		if not mcmod:
 			continue
-		cbtarget = {'module': module.name, 'name': sender}
-		cbsource = {'module': cbsourcemod, 'name': configs[conf]['minecraft'], 'protocol': 'rcon'}
-
-		target = {'module': 'minecraft', 'name': configs[conf]['minecraft']}
-		evt = {'command': 'whitelist ' + parts[1] + ' ' + parts[2], 'callback': functools.partial(_rcon_whitelist_reply, loop=loop, source=cbsource, target=cbtarget, irctarget=data['target'])}
 
-		_modules.send_event_target(loop, target, module, sender, 'whitelist', 'RCON_SENDCMD', evt)
+		rcontarget = {'module': 'minecraft', 'name': configs[conf]['minecraft'], 'protocol': 'rcon'}
+		evt = _events.RconCommand('whitelist ' + parts[1] + ' ' + parts[2])
 
-def _rcon_whitelist_reply(packet, loop, source, target, irctarget):
-	global log
+		try:
+			packet = await _modules.send_request(loop, rcontarget, module, sender, 'whitelist', 'RCON_SENDCMD', evt, timeout=rcontimeout)
+		except asyncio.TimeoutError:
+			log.warning('Timed out waiting for RCON reply from ' + configs[conf]['minecraft'])
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :Whitelist: No reply from ' + configs[conf]['minecraft'], priority=_events.IRC_PRIORITY_INTERACTIVE)
+			_modules.send_event_target(loop, target, moduleobj, conf, 'whitelist', 'IRC_SENDCMD', evt)
+			break
 
-	log.debug(str(packet) + ' ' + str(source) + ' ' + str(target) + ' ' + irctarget)
+		log.debug('RCON reply for whitelist command: %s', packet)
 
-	reply = packet['payload'].decode('utf-8')
+		reply = packet['payload'].decode('utf-8')
 
-	if reply and len(reply) > 0:
-		evt = {'command': 'PRIVMSG ' + irctarget + ' :' + reply, 'callback': None}
-		_modules.send_event_target(loop, target, source['module'], source['name'], 'whitelist', 'IRC_SENDCMD', evt)
+		if reply and len(reply) > 0:
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :' + reply, priority=_events.IRC_PRIORITY_INTERACTIVE)
+			_modules.send_event_target(loop, target, mcmod, configs[conf]['minecraft'], 'whitelist', 'IRC_SENDCMD', evt)
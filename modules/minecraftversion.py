@@ -21,14 +21,20 @@
 
 import core.logging as _logging
 import core.modules as _modules
-import datetime, json, os, re, urllib.request, zipfile
+import core.events as _events
+import core.executor as _executor
+import asyncio, datetime, json, os, re, urllib.request, zipfile
 
 log = _logging.log.getChild(__name__)
 
 configs = {}
 
+subscriptions = [('irc', 'irc', 'CHANNEL_MESSAGE')]
+
 moduleobj = None
 
+manifesturl = 'https://launchermeta.mojang.com/mc/game/version_manifest.json'
+
 def loadconfig(config, module):
 	global configs
 	global log
@@ -45,7 +51,15 @@ def loadconfig(config, module):
 			continue
 
 		name = relaycfg.attrib['name']
-		conf = {'name': name, 'irc': '', 'minecraft': '', 'channels': [], 'jarfile': '', 'lastcheck': None}
+		conf = {'name': name, 'irc': '', 'minecraft': '', 'channels': [], 'jarfile': '', 'lastcheck': None, 'refresh': None, 'manifest': manifesturl, 'timeout': 10.0}
+
+		if 'manifest' in relaycfg.attrib:
+			conf['manifest'] = relaycfg.attrib['manifest']
+		if 'timeout' in relaycfg.attrib:
+			try:
+				conf['timeout'] = float(relaycfg.attrib['timeout'])
+			except:
+				log.warning('Minecraft Version ' + name + ' has an invalid timeout, assuming ' + str(conf['timeout']) + ' seconds')
 
 		irc = relaycfg.findall('./irc')
 		if not irc:
@@ -95,30 +109,44 @@ def applyconfig(loop, module):
 		log.info('Creating Minecraft Version ' + name)
 	return
 
+def reloadconfig(loop, config, module):
+	global configs
+	global log
+
+	oldconfigs = configs
+	configs = {}
+	loadconfig(config, module)
+
+	# Keep the cached versions if the jar and manifest are the same
+	for name in configs:
+		if not name in oldconfigs:
+			continue
+		old = oldconfigs[name]
+		conf = configs[name]
+		if old['jarfile'] != conf['jarfile'] or old['manifest'] != conf['manifest'] or old['lastcheck'] is None:
+			continue
+		for key in ['lastcheck', 'jarver', 'latestver', 'latestsnap']:
+			conf[key] = old[key]
+
+	log.info('Reloaded ' + str(len(configs)) + ' Minecraft Version config(s)')
+
 def shutdown(loop):
 	return
 
-def handle_event(loop, module, sender, protocol, event, data):
+async def handle_event(loop, module, sender, protocol, event, data):
 	global log
 	global configs
 	global moduleobj
 
-	events = ['CHANNEL_MESSAGE']
-
-	if module.name != 'irc':
-		return
+	log.debug('Received event %s from irc: %s', event, data)
 
-	if not event in events:
-		return
-
-	log.debug('Received event ' + event + ' from irc: ' + str(data))
-
-	for conf in configs:
-		if configs[conf]['irc'] != sender:
+	# A reload while a lookup is awaited replaces configs, keep using these
+	for conf, c in list(configs.items()):
+		if c['irc'] != sender:
 			continue
 
-		if len(configs[conf]['channels']) > 0:
-			if not data['target'].lower() in configs[conf]['channels']:
+		if len(c['channels']) > 0:
+			if not data['target'].lower() in c['channels']:
 				break
 
 		parts = data['message'].split(' ')
@@ -132,35 +160,56 @@ def handle_event(loop, module, sender, protocol, event, data):
 		if parts[0] == '?snapshot':
 			type = 'snapshot'
 
-		if (configs[conf]['lastcheck'] is None) or ((datetime.datetime.utcnow() - configs[conf]['lastcheck']).seconds > 300):
-			configs[conf]['jarver'] = _getjarversion(configs[conf]['jarfile'])
-			configs[conf]['latestver'], configs[conf]['latestsnap'] = _getlatestver('https://launchermeta.mojang.com/mc/game/version_manifest.json')
-			configs[conf]['lastcheck'] = datetime.datetime.utcnow()
+		if (c['lastcheck'] is None) or ((datetime.datetime.utcnow() - c['lastcheck']).seconds > 300):
+			# Share one lookup between requests that arrive while it is running
+			if c['refresh'] is None:
+				c['refresh'] = loop.create_task(_refresh(loop, c))
+			await asyncio.shield(c['refresh'])
 		else:
 			cached = ' (cached)'
 
-		if configs[conf]['jarver'] is None:
-			evt = {'command': 'PRIVMSG ' + data['target'] + ' :Unable to retrive the current ' + type + ' for ' + configs[conf]['minecraft'], 'callback': None}
+		if c['jarver'] is None:
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :Unable to retrive the current ' + type + ' for ' + c['minecraft'], priority=_events.IRC_PRIORITY_INTERACTIVE)
 			_modules.send_event_target(loop, target, moduleobj, conf, 'version', 'IRC_SENDCMD', evt)
 			break
-		if configs[conf]['latestver'] is None:
-			evt = {'command': 'PRIVMSG ' + data['target'] + ' :Unable to retrieve the latest available ' + type, 'callback': None}
+		if c['latestver'] is None:
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :Unable to retrieve the latest available ' + type, priority=_events.IRC_PRIORITY_INTERACTIVE)
 			_modules.send_event_target(loop, target, moduleobj, conf, 'version', 'IRC_SENDCMD', evt)
 			break
 
 		if type == 'snapshot':
-			evt = {'command': 'PRIVMSG ' + data['target'] + ' :The latest available minecraft snapshot is: ' + configs[conf]['latestsnap'] + cached, 'callback': None}
+			evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :The latest available minecraft snapshot is: ' + c['latestsnap'] + cached, priority=_events.IRC_PRIORITY_INTERACTIVE)
 			_modules.send_event_target(loop, target, moduleobj, conf, 'version', 'IRC_SENDCMD', evt)
 		else:
-			if configs[conf]['jarver'] == configs[conf]['latestver']:
-				evt = {'command': 'PRIVMSG ' + data['target'] + ' :' + configs[conf]['minecraft'] + ' is currently up to date and running: ' + configs[conf]['jarver'] + cached, 'callback': None}
+			if c['jarver'] == c['latestver']:
+				evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :' + c['minecraft'] + ' is currently up to date and running: ' + c['jarver'] + cached, priority=_events.IRC_PRIORITY_INTERACTIVE)
 				_modules.send_event_target(loop, target, moduleobj, conf, 'version', 'IRC_SENDCMD', evt)
 			else:
-				evt = {'command': 'PRIVMSG ' + data['target'] + ' :' + configs[conf]['minecraft'] + ' is currently running: ' + configs[conf]['jarver'] + cached, 'callback': None}
+				evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :' + c['minecraft'] + ' is currently running: ' + c['jarver'] + cached, priority=_events.IRC_PRIORITY_INTERACTIVE)
 				_modules.send_event_target(loop, target, moduleobj, conf, 'version', 'IRC_SENDCMD', evt)
-				evt = {'command': 'PRIVMSG ' + data['target'] + ' :The latest available minecraft version is: ' + configs[conf]['latestver'] + cached, 'callback': None}
+				evt = _events.IrcCommand('PRIVMSG ' + data['target'] + ' :The latest available minecraft version is: ' + c['latestver'] + cached, priority=_events.IRC_PRIORITY_INTERACTIVE)
 				_modules.send_event_target(loop, target, moduleobj, conf, 'version', 'IRC_SENDCMD', evt)
 
+async def _refresh(loop, conf):
+	try:
+		jarver, latest = await asyncio.gather(
+			_executor.run(loop, _getjarversion, conf['jarfile'], timeout=conf['timeout']),
+			_executor.run(loop, _getlatestver, conf['manifest'], conf['timeout'], timeout=conf['timeout']),
+			return_exceptions=True)
+
+		if isinstance(jarver, BaseException):
+			log.warning('Unable to read version from ' + conf['jarfile'] + ': ' + repr(jarver))
+			jarver = None
+		if isinstance(latest, BaseException):
+			log.warning('Unable to retrieve version manifest ' + conf['manifest'] + ': ' + repr(latest))
+			latest = (None, None)
+
+		conf['jarver'] = jarver
+		conf['latestver'], conf['latestsnap'] = latest
+		conf['lastcheck'] = datetime.datetime.utcnow()
+	finally:
+		conf['refresh'] = None
+
 def _getjarversion(file):
 	try:
 		z = zipfile.ZipFile(file, 'r')
@@ -171,12 +220,12 @@ def _getjarversion(file):
 	except:
 		return None
 
-def _getlatestver(url):
+def _getlatestver(url, timeout=None):
 	try:
 		jsontxt = ''
 		relval = None
 		snapval = None
-		with urllib.request.urlopen(url) as f:
+		with urllib.request.urlopen(url, timeout=timeout) as f:
 			jsontxt = f.read().decode('utf-8')
 			f.close()
 		jsonobj = json.loads(jsontxt)
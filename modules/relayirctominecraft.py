@@ -21,12 +21,20 @@
 
 import core.logging as _logging
 import core.modules as _modules
-import functools, json, re
+import core.events as _events
+import asyncio, json, re
 
 log = _logging.log.getChild(__name__)
 
 configs = {}
 
+subscriptions = [
+	('irc', 'irc', 'CHANNEL_MESSAGE'),
+	('irc', 'irc', 'CHANNEL_ACTION')
+	]
+
+rcontimeout = 10
+
 rconlistre = re.compile('^(?P<header>There are \d+ of a max of \d+ players online:) ?(?P<list>.*?)$')
 
 def loadconfig(config, module):
@@ -85,6 +93,14 @@ def applyconfig(loop, module):
 		log.info('Creating Relay (IRC To Minecraft) ' + name)
 	return
 
+def reloadconfig(loop, config, module):
+	global configs
+	global log
+
+	configs = {}
+	loadconfig(config, module)
+	log.info('Reloaded ' + str(len(configs)) + ' Relay (IRC To Minecraft) config(s)')
+
 def shutdown(loop):
 	return
 
@@ -92,15 +108,7 @@ def handle_event(loop, module, sender, protocol, event, data):
 	global log
 	global configs
 
-	events = ['CHANNEL_MESSAGE', 'CHANNEL_ACTION']
-
-	if module.name != 'irc':
-		return
-
-	if not event in events:
-		return
-
-	log.debug('Relaying event ' + event + ' to minecraft: ' + str(data))
+	log.debug('Relaying event %s to minecraft: %s', event, data)
 
 	if len(data['message']) == 0:
 		return # Nothing to relay
@@ -116,16 +124,12 @@ def handle_event(loop, module, sender, protocol, event, data):
 				continue
 
 		if data['message'].split(' ')[0] == '?players':
-			cbsourcemod = _modules.getmodule('minecraft')
-			if not cbsourcemod:
+			mcmod = _modules.getmodule('minecraft')
+			if not mcmod:
 				continue
-			cbtarget = {'module': module.name, 'name': sender}
-			cbsource = {'module': cbsourcemod, 'name': conf['minecraft'], 'protocol': 'rcon'}
-
-			target = {'module': 'minecraft', 'name': conf['minecraft']}
-			evt = {'command': 'list', 'callback': functools.partial(_rcon_list_callback, loop=loop, source=cbsource, target=cbtarget, irctarget=data['target'])}
 
-			_modules.send_event_target(loop, target, module, sender, 'relay', 'RCON_SENDCMD', evt)
+			# Relaying never waits on RCON, the reply is sent when it arrives
+			loop.create_task(_rcon_list(loop, module, sender, conf, mcmod, data['target']))
 
 		parts = []
 		parts.append('[IRC] ')
@@ -143,16 +147,33 @@ def handle_event(loop, module, sender, protocol, event, data):
 				parts.append(part)
 		text = json.dumps(parts)
 
-		target = {'module': 'minecraft', 'name': conf['minecraft']}
-		evt = {'command': 'tellraw @a ' + text, 'callback': None}
+		target = {'module': 'minecraft', 'name': conf['minecraft'], 'protocol': 'rcon'}
+		evt = _events.RconCommand('tellraw @a ' + text)
+
+		_modules.send_event_target(loop, target, module, sender, 'relay', 'RCON_SENDCMD', evt)
+
+async def _rcon_list(loop, module, sender, conf, mcmod, irctarget):
+	global log
+
+	target = {'module': 'minecraft', 'name': conf['minecraft'], 'protocol': 'rcon'}
+	evt = _events.RconCommand('list')
+	irc = {'module': module.name, 'name': sender}
+
+	try:
+		packet = await _modules.send_request(loop, target, module, sender, 'relay', 'RCON_SENDCMD', evt, timeout=rcontimeout)
+	except asyncio.TimeoutError:
+		log.warning('Timed out waiting for RCON reply from ' + conf['minecraft'])
+		evt = _events.IrcCommand('PRIVMSG ' + irctarget + ' :Players: No reply from ' + conf['minecraft'], priority=_events.IRC_PRIORITY_INTERACTIVE)
+		_modules.send_event_target(loop, irc, mcmod, conf['minecraft'], 'relay', 'IRC_SENDCMD', evt)
+		return
 
-		loop.call_soon(_modules.send_event_target, loop, target, module, sender, 'relay', 'RCON_SENDCMD', evt)
+	_rcon_list_reply(loop, packet, mcmod, conf['minecraft'], irc, irctarget)
 
-def _rcon_list_callback(packet, loop, source, target, irctarget):
+def _rcon_list_reply(loop, packet, srcmodule, srcname, target, irctarget):
 	global log
 	global rconlistre
 
-	log.debug(str(packet) + ' ' + str(source) + ' ' + str(target) + ' ' + irctarget)
+	log.debug('RCON reply for list command: %s', packet)
 
 	listtext = packet['payload'].decode('utf-8')
 
@@ -160,10 +181,10 @@ def _rcon_list_callback(packet, loop, source, target, irctarget):
 	if not m:
 		return
 
-	evt = {'command': 'PRIVMSG ' + irctarget + ' :' + m.group('header'), 'callback': None}
-	_modules.send_event_target(loop, target, source['module'], source['name'], 'relay', 'IRC_SENDCMD', evt)
+	evt = _events.IrcCommand('PRIVMSG ' + irctarget + ' :' + m.group('header'), priority=_events.IRC_PRIORITY_INTERACTIVE)
+	_modules.send_event_target(loop, target, srcmodule, srcname, 'relay', 'IRC_SENDCMD', evt)
 	if m.group('list') != '':
-		evt = {'command': 'PRIVMSG ' + irctarget + ' :' + m.group('list'), 'callback': None}
-		_modules.send_event_target(loop, target, source['module'], source['name'], 'relay', 'IRC_SENDCMD', evt)
+		evt = _events.IrcCommand('PRIVMSG ' + irctarget + ' :' + m.group('list'), priority=_events.IRC_PRIORITY_INTERACTIVE)
+		_modules.send_event_target(loop, target, srcmodule, srcname, 'relay', 'IRC_SENDCMD', evt)
 
 	return
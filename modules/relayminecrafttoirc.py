@@ -21,12 +21,23 @@
 
 import core.logging as _logging
 import core.modules as _modules
+import core.events as _events
 import json, re
 
 log = _logging.log.getChild(__name__)
 
 configs = {}
 
+subscriptions = [
+	('minecraft', None, 'PLAYER_CONNECT'),
+	('minecraft', None, 'PLAYER_DISCONNECT'),
+	('minecraft', None, 'MESSAGE'),
+	('minecraft', None, 'ACTION'),
+	('minecraft', None, 'ADVANCEMENT'),
+	('minecraft', None, 'DEATH'),
+	('minecraft', None, 'WHITELIST_FAIL')
+	]
+
 def loadconfig(config, module):
 	global configs
 	global log
@@ -85,6 +96,14 @@ def applyconfig(loop, module):
 		log.info('Creating Relay (Minecraft To IRC) ' + name)
 	return
 
+def reloadconfig(loop, config, module):
+	global configs
+	global log
+
+	configs = {}
+	loadconfig(config, module)
+	log.info('Reloaded ' + str(len(configs)) + ' Relay (Minecraft To IRC) config(s)')
+
 def shutdown(loop):
 	return
 
@@ -92,23 +111,7 @@ def handle_event(loop, module, sender, protocol, event, data):
 	global log
 	global configs
 
-	events = [
-		'PLAYER_CONNECT',
-		'PLAYER_DISCONNECT',
-		'MESSAGE',
-		'ACTION',
-		'ADVANCEMENT',
-		'DEATH',
-		'WHITELIST_FAIL'
-		]
-
-	if module.name != 'minecraft':
-		return
-
-	if not event in events:
-		return
-
-	log.debug('Relaying event ' + event + ' to irc: ' + str(data))
+	log.debug('Relaying event %s to irc: %s', event, data)
 
 	for name in configs:
 		conf = configs[name]
@@ -135,5 +138,5 @@ def handle_event(loop, module, sender, protocol, event, data):
 			text = '*** Connection from ' + data['ip'] + ' rejected (not whitelisted: ' + data['name'] + ')'
 
 		for chan in conf['channels']:
-			evt = {'command': 'PRIVMSG ' + chan + ' :' + text, 'callback': None}
+			evt = _events.IrcCommand('PRIVMSG ' + chan + ' :' + text)
 			_modules.send_event_target(loop, target, module, sender, 'relay', 'IRC_SENDCMD', evt)
@@ -24,6 +24,7 @@ import core.logging as _logging
 import core.config as _config
 import core.daemon as _daemon
 import core.signals as _signals
+import core.shard as _shard
 
 import argparse, asyncio, os, sys
 
@@ -40,6 +41,7 @@ def parse_args():
 
 	args = parser.parse_args()
 	args.asynciodebug = False
+	args.shards = 1
 
 	if os.name == 'nt':
 		args.nofork = True
@@ -57,6 +59,14 @@ log.debug('Command line options: ' + str(vars(args)))
 
 _daemon.daemonize(args)
 
+if os.name == 'nt' and args.shards > 1:
+	log.warning('Sharded mode is not supported on Windows, running a single process')
+	args.shards = 1
+
+# Only returns in worker processes, the supervisor exits when they do
+if args.shards > 1:
+	_shard.supervise(args)
+
 # Create event loop
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
@@ -65,6 +75,9 @@ if args.asynciodebug:
 
 _signals.init_signals(loop)
 
+if _shard.isworker():
+	_shard.start(loop)
+
 # Begin by loading config when we start the loop
 loop.call_soon(_config.load, loop, args)
 